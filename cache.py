@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+CACHE_DIR_VARIABLE = "CLISP_CACHE_DIR"
+CACHE_MAX_SIZE = 64 * 2**20
+CACHE_ENTRY_SUFFIX = ".json"
+
+
+class CompilationCache:
+    """Кэш результатов трансляции на диске, адресуемый по содержимому.
+
+    Ключ - хэш от всех входных данных транслятора. Запись кладется во временный файл и
+    атомарно переименовывается, поэтому кэш можно использовать из нескольких процессов.
+    При превышении `max_size` удаляются записи, к которым дольше всего не обращались.
+    """
+
+    def __init__(self, directory: str, max_size: int = CACHE_MAX_SIZE):
+        self._directory = Path(directory)
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part.encode("utf-8")
+            # length prefix keeps parts boundaries
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self._directory / (key + CACHE_ENTRY_SUFFIX)
+
+    def get(self, key: str) -> tuple[list[dict], list[int]] | None:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as file:
+                content = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # access time for eviction is kept in mtime
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return content["code"], content["data"]
+
+    def put(self, key: str, code: list[dict], data: list[int]):
+        descriptor, temporary = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                json.dump({"code": code, "data": data}, file)
+            Path(temporary).replace(self._path(key))
+        except BaseException:
+            Path(temporary).unlink(missing_ok=True)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith(CACHE_ENTRY_SUFFIX):
+                with contextlib.suppress(FileNotFoundError):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self._max_size:
+                break
+            # entry may be already removed by another process
+            Path(path).unlink(missing_ok=True)
+            size -= entry_size
@@ -1,10 +1,18 @@
 from __future__ import annotations
 
-from isa import Addressing, Opcode, Register
-from lexer import TokenType
+import contextlib
+import logging
+import sys
+from collections.abc import Iterable, Iterator
+
+from isa import OPERAND_MAX, OPERAND_MIN, Addressing, Opcode, Register
+from lexer import TokenType, format_position
+from linker import ObjectModule, Section
+from optimizer import ConstantFolder, Inliner
 from parsing import (
     AllocationExpression,
     BinaryOperationExpression,
+    BlockExpression,
     ConditionExpression,
     EmptyExpression,
     Expression,
@@ -20,6 +28,22 @@ from parsing import (
     VariableValueExpression,
 )
 
+# functions with bodies of at most this number of instructions are inlined
+INLINE_THRESHOLD = 24
+
+# code generation is recursive, one level of nesting takes at most this number of Python frames
+FRAMES_PER_NESTING_LEVEL = 4
+
+
+@contextlib.contextmanager
+def recursion_limit(frames: int) -> Iterator[None]:
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(limit + frames)
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(limit)
+
 
 def unary_operators() -> dict[TokenType, Opcode]:
     return {TokenType.NOT: Opcode.NOT, TokenType.KEY_LOAD: Opcode.LD, TokenType.KEY_PUT: Opcode.PUT}
@@ -33,46 +57,83 @@ def comparison_operators() -> dict[TokenType, Opcode]:
     }
 
 
+def branch_operators() -> dict[TokenType, Opcode]:
+    # jumps taken if the comparison is true, they test the difference of the operands
+    return {
+        TokenType.EQUALS: Opcode.JZ,
+        TokenType.GREATER: Opcode.JPOS,
+        TokenType.LESS: Opcode.JNEG,
+    }
+
+
 def arithmetic_operators() -> dict[TokenType, Opcode]:
     return {
         TokenType.AND: Opcode.AND,
         TokenType.OR: Opcode.OR,
         TokenType.PLUS: Opcode.ADD,
         TokenType.SUB: Opcode.SUB,
+        TokenType.MUL: Opcode.MUL,
+        TokenType.DIV: Opcode.DIV,
+        TokenType.MOD: Opcode.MOD,
+    }
+
+
+def fixed_instruction_counts() -> dict[type, int]:
+    return {
+        BinaryOperationExpression: 3,
+        UnaryOperatorExpression: 2,
+        VariableAssignmentExpression: 2,
+        EmptyExpression: 0,
+        FunctionDefinitionExpression: 0,
     }
 
 
+# top of the stack, where a spilled value is kept
+STACK_TOP = {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +1}
+
+
 class DataSegment:
     def __init__(self, capacity):
         self._capacity = capacity
-        self._cur = 0
-        self._data = [0] * capacity
+        # grows on demand, so small sections are cheap
+        self._data = []
+        # words which hold data addresses
+        self.pointers = []
+        # read-only blocks of words (start, length), linker stores equal blocks once
+        self.constants = []
 
     def put_string(self, string: str) -> int:
-        assert self._capacity - self._cur >= len(string), "Limit of data memory exceeded"
-        ref = self._cur
-        self._data[self._cur] = len(string)
-        self._cur += 1
-        for i in range(len(string)):
-            self._data[self._cur + i] = ord(string[i])
-        self._cur += len(string)
+        assert self._capacity - len(self._data) > len(string), "Limit of data memory exceeded"
+        ref = len(self._data)
+        self._data.append(len(string))
+        self._data.extend(map(ord, string))
+        self.constants.append([ref, len(string) + 1])
+        return ref
+
+    def put_constant(self, value: int) -> int:
+        ref = self.put_word(value)
+        self.constants.append([ref, 1])
         return ref
 
     def put_word(self, value: int = 0) -> int:
-        assert self._capacity - self._cur >= 1, "Limit of data memory exceeded"
-        self._data[self._cur] = value
-        ref = self._cur
-        self._cur += 1
+        assert self._capacity - len(self._data) >= 1, "Limit of data memory exceeded"
+        ref = len(self._data)
+        self._data.append(value)
+        return ref
+
+    def put_pointer(self, address: int) -> int:
+        ref = self.put_word(address)
+        self.pointers.append(ref)
         return ref
 
     def allocate(self, size: int) -> int:
-        assert self._capacity - self._cur >= size, "Limit of data memory exceeded"
-        ref = self._cur
-        self._cur += size
+        assert self._capacity - len(self._data) >= size, "Limit of data memory exceeded"
+        ref = len(self._data)
+        self._data.extend([0] * size)
         return ref
 
     def layout(self) -> list:
-        return self._data[: self._cur]
+        return self._data
 
 
 class TextSegment:
@@ -128,31 +189,271 @@ class TextSegment:
 
 
 class Compiler:
-    def __init__(self, root: RootExpression, data_max_size: int, text_max_size: int):
+    """Компиляция модуля по одному выражению верхнего уровня: код выражения и функций, объявленных в нем,
+    генерируется сразу после его разбора, поэтому в памяти находится только текущее выражение.
+
+    Вызовы функций разрешаются при линковке, поэтому код выражения не ждет объявления вызываемых функций.
+    """
+
+    def __init__(
+        self,
+        data_max_size: int,
+        text_max_size: int,
+        entry: bool = True,
+        optimize: bool = True,
+        inline_functions: Iterable[FunctionDefinitionExpression] = (),
+        inline_threshold: int = INLINE_THRESHOLD,
+    ):
+        self._data_max_size = data_max_size
+        self._text_max_size = text_max_size
+        self._folder = ConstantFolder() if optimize else None
+        self.removed_nodes = 0
+        self.removed_instructions = 0
+        # functions of libraries are inlined as well as functions of the module declared before the call
+        self._inliner = Inliner(inline_threshold, self._instruction_count) if optimize else None
+        if self._inliner is not None:
+            for function in inline_functions:
+                self._inliner.add(function)
+        self.inlined_calls = 0
+        self._optimize = optimize
+        # function being compiled and ids of its calls in tail position
+        self._function: FunctionDefinitionExpression | None = None
+        self._tail_calls: set[int] = set()
         self.data = DataSegment(data_max_size)
         self.text = TextSegment(text_max_size)
-        self.root = root
-        self.functions = self._filter_functions(self.root, self._extract_functions(root))
-        self.symbol_table = {}
-
-    def process(self):
-        self._compile_root(self.root, self._root_variables(self.root))
-        for function in self.functions.values():
-            self._compile_function(function, self._function_variables(function))
-        self._link()
-
-    def _root_variables(self, root: RootExpression) -> dict[str, dict]:
-        variable_index = self._collect_variables(root, {})
-        variables = {}
-        for name in variable_index:
-            address = self.data.put_word()
-            variables[name] = {
-                "type": Addressing.ABSOLUTE,
-                "value": address,
-            }
-        return variables
+        self.entry = entry
+        self.functions: dict[str, Section] = {}
+        # global variables are addressed by index and placed before data of root when module is finished
+        self.globals: dict[str, dict] = {}
+        self._unassigned_globals: dict[str, int] = {}
+        self._root_calls: dict[str, None] = {}
+        # calls of root in the current form
+        self._form_calls: dict[str, None] = {}
+        self._root_text = TextSegment(text_max_size)
+        self._root_data = DataSegment(data_max_size)
+
+    def process(self, forms: Iterable[Expression]) -> ObjectModule:
+        if self.entry:
+            self._root_text.write_nop(debug="program start")
+        for form in forms:
+            self.process_form(form)
+        sections = list(self.functions.values())
+        if self.entry:
+            sections.insert(0, self._finish_root())
+        # library is compiled once and shared, so statistics are reported for programs only
+        if self.entry and self.removed_nodes:
+            logging.info(
+                "constant folding removed %d nodes and %d instructions", self.removed_nodes, self.removed_instructions
+            )
+        if self.entry and self.inlined_calls:
+            logging.info("function calls inlined: %d", self.inlined_calls)
+        inline_functions = self._inliner.candidates() if self._inliner is not None else []
+        return ObjectModule(sections, inline_functions)
+
+    def process_form(self, form: Expression):
+        if not self.entry:
+            assert isinstance(form, FunctionDefinitionExpression), "Library module must contain only functions"
+        form, functions, depth = self._analyze(form)
+        if self._folder is not None:
+            # after analysis, so variables of removed branches keep their places
+            form = self._fold(form)
+            for function in functions:
+                self._fold(function)
+        if self._inliner is not None:
+            form, depth = self._inline_form(form, functions, depth)
+        # every level of nesting takes at least one instruction, so deeper code does not fit in instruction memory
+        assert depth <= self._text_max_size, "Limit of instruction memory exceeded"
+        with recursion_limit(depth * FRAMES_PER_NESTING_LEVEL):
+            for function in functions:
+                self._begin_section()
+                self._function = function
+                self._tail_calls = self._find_tail_calls(function) if self._optimize else set()
+                self._compile_function(function, self._function_variables(function))
+                self.functions[function.name] = self._end_section(function.name, list(function.calls))
+            self._function, self._tail_calls = None, set()
+            if self.entry:
+                self._root_calls.update(self._form_calls)
+                self.text, self.data = self._root_text, self._root_data
+                self._compile_statement(form, self.globals)
+
+    def _analyze(self, form: Expression) -> tuple[Expression, list[FunctionDefinitionExpression], int]:
+        """Семантический анализ выражения верхнего уровня за один обход: объявления функций заменяются нулем,
+        для корня и каждой функции собираются переменные и вызовы, а также вычисляется глубина вложенности.
+
+        Вызовы функций собираются заново, если встраивание изменило код.
+        """
+
+        def extract(e: Expression) -> Expression:
+            if isinstance(e, FunctionDefinitionExpression):
+                functions.append(e)
+                return NumberLiteralExpression(e.position, 0)
+            return e
+
+        functions = []
+        self._form_calls = {}
+        max_depth = 0
+        holder = RootExpression([form])
+        # nodes with their depth and scope, scope is a function or None for root
+        stack = [(holder, 0, None)]
+        while stack:
+            node, depth, scope = stack.pop()
+            max_depth = max(max_depth, depth)
+            if scope is None:
+                extracted = len(functions)
+                node.apply(extract)
+                stack.extend((function, 1, function) for function in functions[extracted:])
+            children = node.children()
+            for child in children:
+                if scope is None:
+                    self._analyze_root_node(child)
+                else:
+                    self._analyze_function_node(child, scope)
+            stack.extend((child, depth + 1, scope) for child in reversed(children))
+        return holder.expressions[0], functions, max_depth
+
+    def _analyze_root_node(self, e: Expression):
+        if isinstance(e, FunctionCallExpression):
+            self._form_calls[e.name] = None
+        elif isinstance(e, VariableValueExpression | VariableAssignmentExpression):
+            if e.name not in self.globals:
+                self.globals[e.name] = {"type": Addressing.ABSOLUTE, "value": len(self.globals)}
+                self._unassigned_globals[e.name] = e.position
+            if isinstance(e, VariableAssignmentExpression):
+                self._unassigned_globals.pop(e.name, None)
 
-    def _function_variables(self, function: FunctionDefinitionExpression) -> dict[str, dict]:
+    @staticmethod
+    def _analyze_function_node(e: Expression, function: FunctionDefinitionExpression):
+        if isinstance(e, FunctionCallExpression):
+            function.calls[e.name] = None
+        elif isinstance(e, VariableValueExpression):
+            assert e.name in function.locals or e.name in function.parameters, (
+                "Unknown variable symbol [{}] @ {}".format(e.name, format_position(e.position))
+            )
+        elif isinstance(e, VariableAssignmentExpression):
+            if e.name not in function.locals and e.name not in function.parameters:
+                function.locals[e.name] = len(function.locals)
+
+    def _inline_form(
+        self, form: Expression, functions: list[FunctionDefinitionExpression], depth: int
+    ) -> tuple[Expression, int]:
+        """Встраивание вызовов в выражение верхнего уровня и его функции, возвращает новые выражение и глубину"""
+        inlined_calls = self.inlined_calls
+        for function in functions:
+            self._inline(function, function)
+            # function becomes a candidate after its own calls are inlined, so it doesn't inline itself
+            self._inliner.add(function)
+        if self.entry:
+            form = self._inline(form, None)
+        if self.inlined_calls != inlined_calls:
+            depth = max(depth, 1 + form.depth(), *(1 + function.depth() for function in functions))
+        return form, depth
+
+    def _inline(self, form: Expression, function: FunctionDefinitionExpression | None) -> Expression:
+        """Встраивание вызовов в корень (`function` равно None) или в функцию, новые переменные
+        регистрируются в ее области видимости"""
+        form, variables, inlined = self._inliner.inline(form)
+        for name in variables:
+            if function is None:
+                self.globals[name] = {"type": Addressing.ABSOLUTE, "value": len(self.globals)}
+            else:
+                function.locals[name] = len(function.locals)
+        if inlined and function is None:
+            self._form_calls = self._calls(form)
+        elif inlined:
+            function.calls = self._calls(function)
+        self.inlined_calls += inlined
+        return form
+
+    @staticmethod
+    def _find_tail_calls(function: FunctionDefinitionExpression) -> set[int]:
+        """Вызовы, значение которых сразу становится результатом функции. Фрейм функции переиспользуется, поэтому
+        число аргументов должно совпадать с числом ее параметров"""
+        tail_calls = set()
+        stack = function.body[-1:]
+        while stack:
+            e = stack.pop()
+            match e:
+                case FunctionCallExpression() if len(e.arguments) == len(function.parameters):
+                    tail_calls.add(id(e))
+                case ConditionExpression():
+                    stack.extend([e.true_expression, e.false_expression])
+                case BlockExpression():
+                    stack.append(e.body[-1])
+        return tail_calls
+
+    @staticmethod
+    def _calls(form: Expression) -> dict[str, None]:
+        nodes = [form, *form.descendants()]
+        return dict.fromkeys(e.name for e in nodes if isinstance(e, FunctionCallExpression))
+
+    def _fold(self, form: Expression) -> Expression:
+        nodes, instructions = self._code_size(form)
+        form = self._folder.fold(form)
+        folded_nodes, folded_instructions = self._code_size(form)
+        self.removed_nodes += nodes - folded_nodes
+        self.removed_instructions += instructions - folded_instructions
+        return form
+
+    def _code_size(self, form: Expression) -> tuple[int, int]:
+        nodes = [form, *form.descendants()]
+        return len(nodes), sum(map(self._instruction_count, nodes))
+
+    @staticmethod
+    def _is_branch_comparison(e: Expression) -> bool:
+        """Сравнение в условии `if` или `loop` не вычисляет 0 или 1: переход проверяет разность операндов"""
+        return isinstance(e, BinaryOperationExpression) and e.operator in branch_operators()
+
+    @staticmethod
+    def _instruction_count(e: Expression) -> int:
+        """Число инструкций, которые генерируются для самого узла, без его детей"""
+        match e:
+            case FunctionCallExpression():
+                return 3 + len(e.arguments)
+            # condition value is loaded from the stack (2 instructions), but a comparison in the condition doesn't
+            # write its result at all (1 instruction less than it is counted)
+            case ConditionExpression() | LoopExpression():
+                count = 4 if isinstance(e, ConditionExpression) else 7 + len(e.body)
+                return count - 3 * Compiler._is_branch_comparison(e.condition)
+            case BlockExpression():
+                return len(e.body) - 1
+            # literal second operand is read by the operation instead of 3 instructions of its own and 1 pop
+            case BinaryOperationExpression() if e.operator in comparison_operators():
+                return 5 - 4 * isinstance(e.second, NumberLiteralExpression)
+            case BinaryOperationExpression() if e.operator in arithmetic_operators():
+                return 4 - 4 * isinstance(e.second, NumberLiteralExpression)
+        # literals, variable values, allocations and nullary operators are loaded and pushed
+        return fixed_instruction_counts().get(type(e), 3)
+
+    def _begin_section(self):
+        self.data = DataSegment(self._data_max_size)
+        self.text = TextSegment(self._text_max_size)
+
+    def _end_section(self, name: str | None, calls: list[str]) -> Section:
+        return Section.build(
+            name, self.text.instructions, self.data.layout(), self.data.pointers, self.data.constants, calls
+        )
+
+    def _finish_root(self) -> Section:
+        for name, position in self._unassigned_globals.items():
+            assert False, "Unknown variable symbol [{}] @ {}".format(name, format_position(position))
+        self._root_text.write_instruction({"opcode": Opcode.HALT}, debug="program end")
+        # move data of root after global variables
+        global_count = len(self.globals)
+        global_addresses = {id(address) for address in self.globals.values()}
+        for instruction in self._root_text.instructions:
+            address = instruction.get("address")
+            if address and address["type"] == Addressing.ABSOLUTE and id(address) not in global_addresses:
+                instruction["address"] = {**address, "value": address["value"] + global_count}
+        data = [0] * global_count + self._root_data.layout()
+        assert len(data) <= self._data_max_size, "Limit of data memory exceeded"
+        pointers = [index + global_count for index in self._root_data.pointers]
+        for index in pointers:
+            data[index] += global_count
+        constants = [[index + global_count, length] for index, length in self._root_data.constants]
+        return Section.build(None, self._root_text.instructions, data, pointers, constants, list(self._root_calls))
+
+    @staticmethod
+    def _function_variables(function: FunctionDefinitionExpression) -> dict[str, dict]:
         variables = {}
         parameter_index = {function.parameters[i]: i for i in range(len(function.parameters))}
         for index, name in enumerate(parameter_index):
@@ -161,8 +462,7 @@ class Compiler:
                 "register": Register.FRAME_POINTER,
                 "offset": +2 - index + len(parameter_index),
             }
-        locals_index = self._collect_variables(function, parameter_index)
-        for index, name in enumerate(locals_index):
+        for index, name in enumerate(function.locals):
             variables[name] = {
                 "type": Addressing.RELATIVE,
                 "register": Register.FRAME_POINTER,
@@ -170,76 +470,8 @@ class Compiler:
             }
         return variables
 
-    @staticmethod
-    def _extract_functions(root: RootExpression) -> dict[str, FunctionDefinitionExpression]:
-        def extractor(e: Expression) -> Expression:
-            if isinstance(e, FunctionDefinitionExpression):
-                functions[e.name] = e
-                return NumberLiteralExpression(e.token, 0)
-            return e
-
-        functions = {}
-        root.apply_traverse(extractor)
-        return functions
-
-    @staticmethod
-    def _function_calls(expression: Expression) -> list[str]:
-        def traverser(e: Expression) -> Expression:
-            if isinstance(e, FunctionCallExpression):
-                ls.append(e.name)
-            return e
-
-        ls = []
-        expression.apply_traverse(traverser)
-        return ls
-
-    @staticmethod
-    def _filter_functions(root: RootExpression, functions: dict[str, FunctionDefinitionExpression]):
-        def dfs(e: FunctionDefinitionExpression):
-            visited[e.name] = True
-            calls = Compiler._function_calls(e)
-            for name in calls:
-                if not visited[name]:
-                    dfs(functions[name])
-
-        visited = {name: False for name in functions.keys()}
-        for name in Compiler._function_calls(root):
-            if not visited[name]:
-                dfs(functions[name])
-        return {name: func for name, func in functions.items() if visited[name]}
-
-    def _collect_variables(self, expression: Expression, context: dict[str, int]) -> dict[str, int]:
-        def _traverser(e: Expression):
-            if isinstance(e, FunctionCallExpression):
-                assert e.name in self.functions, "Unknown function symbol [{}]".format(e.token)
-            elif isinstance(e, VariableValueExpression):
-                assert e.name in variables or e.name in context, "Unknown variable symbol [{}]".format(e.token)
-            elif isinstance(e, VariableAssignmentExpression):
-                if e.name not in variables and e.name not in context:
-                    variables[e.name] = len(variables)
-            return e
-
-        variables = {}
-        expression.apply_traverse(_traverser)
-        return variables
-
-    def _link(self):
-        for instruction in self.text.instructions:
-            if instruction["opcode"] == Opcode.CALL:
-                symbol = instruction["symbol"]
-                instruction.pop("symbol")
-                instruction["address"] = {"type": Addressing.CONTROL_FLOW, "value": self.symbol_table[symbol]}
-
-    def _compile_root(self, root: RootExpression, variables: dict):
-        self.text.write_nop(debug="program start")
-        for expression in root.expressions:
-            self._compile_expression(expression, variables)
-            self.text.write_pop()
-        self.text.write_instruction({"opcode": Opcode.HALT}, debug="program end")
-
     def _compile_function(self, expression: FunctionDefinitionExpression, variables: dict[str, dict]):
-        function_address = self.text.write_nop(debug="function [{}]".format(expression.name))
-        self.symbol_table[expression.name] = function_address
+        self.text.write_nop(debug="function [{}]".format(expression.name))
         local_variables_length = len(variables) - len(expression.parameters)
         for i in range(local_variables_length):
             self.text.write_push(debug="allocate local variable [{}]".format(i))
@@ -255,6 +487,11 @@ class Compiler:
             self.text.write_pop(debug="clear local variable [{}]".format(i))
         self.text.write_instruction({"opcode": Opcode.RET})
 
+    def _compile_statement(self, expression: Expression, variables: dict[str, dict]):
+        """Выражение, значение которого не используется"""
+        self._compile_expression(expression, variables)
+        self.text.write_pop()
+
     def _compile_expression(self, expression: Expression, variables: dict[str, dict]):
         match expression:
             case StringLiteralExpression() as e:
@@ -279,11 +516,19 @@ class Compiler:
                 self._compile_nullary_operator(e)
             case AllocationExpression() as e:
                 self._compile_allocation(e)
+            case BlockExpression() as e:
+                self._compile_block(e, variables)
             case EmptyExpression():
                 pass
             case _:
                 assert False, "Not implemented [{}]".format(expression)
 
+    def _compile_block(self, expression: BlockExpression, variables: dict[str, dict]):
+        *statements, result = expression.body
+        for e in statements:
+            self._compile_statement(e, variables)
+        self._compile_expression(result, variables)
+
     def _compile_variable_value_expression(self, expression: VariableValueExpression, variables: dict[str, dict]):
         variable_address = variables[expression.name]
         self.text.write_instruction(
@@ -292,17 +537,22 @@ class Compiler:
         )
         self.text.write_accumulator_push()
 
+    def _literal_address(self, value: int) -> dict:
+        # value which fits in the instruction doesn't take a data word
+        if OPERAND_MIN <= value <= OPERAND_MAX:
+            return {"type": Addressing.IMMEDIATE, "value": value}
+        return {"type": Addressing.ABSOLUTE, "value": self.data.put_constant(value)}
+
     def _compile_number_literal(self, expression: NumberLiteralExpression):
-        static_address = self.data.put_word(expression.value)
         self.text.write_instruction(
-            {"opcode": Opcode.LD, "address": {"type": Addressing.ABSOLUTE, "value": static_address}},
+            {"opcode": Opcode.LD, "address": self._literal_address(expression.value)},
             debug="number literal [{}]".format(expression.value),
         )
         self.text.write_accumulator_push()
 
     def _compile_string_literal(self, expression: StringLiteralExpression):
         string_address = self.data.put_string(expression.value)
-        static_address = self.data.put_word(string_address)
+        static_address = self.data.put_pointer(string_address)
         self.text.write_instruction(
             {"opcode": Opcode.LD, "address": {"type": Addressing.ABSOLUTE, "value": static_address}},
             debug="string literal [{}]".format(expression.value),
@@ -310,7 +560,9 @@ class Compiler:
         self.text.write_accumulator_push()
 
     def _compile_variable_assignment(self, expression: VariableAssignmentExpression, variables: dict[str, dict]):
-        assert expression.name in variables, "Unknown variable [{}]".format(expression.token)
+        assert expression.name in variables, "Unknown variable [{}] @ {}".format(
+            expression.name, format_position(expression.position)
+        )
         self._compile_expression(expression.value, variables)
         self.text.write_stack_load()
         variable_address = variables[expression.name]
@@ -318,23 +570,48 @@ class Compiler:
 
     def _compile_allocation(self, expression: AllocationExpression):
         buffer_address = self.data.allocate(expression.size)
-        static_address = self.data.put_word(buffer_address)
-        self.text.write_push(debug="allocation of size [{}]".format(expression.size))
+        static_address = self.data.put_pointer(buffer_address)
         self.text.write_instruction(
-            {"opcode": Opcode.LD, "address": {"type": Addressing.ABSOLUTE, "value": static_address}}
+            {"opcode": Opcode.LD, "address": {"type": Addressing.ABSOLUTE, "value": static_address}},
+            debug="allocation of size [{}]".format(expression.size),
         )
+        self.text.write_accumulator_push()
 
-    def _compile_function_call(self, expression: FunctionCallExpression, variables: dict[str, dict]):
+    def _compile_arguments(self, expression: FunctionCallExpression, variables: dict[str, dict]):
         for argument in expression.arguments:
             self._compile_expression(argument, variables)
+
+    def _compile_function_call(self, expression: FunctionCallExpression, variables: dict[str, dict]):
+        if id(expression) in self._tail_calls:
+            self._compile_tail_call(expression, variables)
+            return
+        self._compile_arguments(expression, variables)
         self.text.write_instruction(
             {"opcode": Opcode.CALL, "address": None, "symbol": expression.name},
             debug="function call [{}]".format(expression.name),
         )
         for i in range(len(expression.arguments)):
             self.text.write_pop(debug="local allocation clear")
+        self._write_call_result()
+
+    def _write_call_result(self):
         self.text.write_accumulator_push()
 
+    def _compile_tail_call(self, expression: FunctionCallExpression, variables: dict[str, dict]):
+        """Аргументы записываются на место параметров текущего фрейма, локальные переменные снимаются со стека, и
+        выполняется переход на начало функции: она вернет результат сразу вызвавшему текущую функцию"""
+        self._compile_arguments(expression, variables)
+        for parameter in reversed(self._function.parameters):
+            self.text.write_stack_load()
+            self.text.write_instruction({"opcode": Opcode.ST, "address": variables[parameter]})
+            self.text.write_pop()
+        for i in range(len(self._function.locals)):
+            self.text.write_pop(debug="tail call frame clear")
+        self.text.write_instruction(
+            {"opcode": Opcode.JMP, "address": None, "symbol": expression.name},
+            debug="tail call [{}]".format(expression.name),
+        )
+
     def _compile_binary_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
         if expression.operator == TokenType.KEY_STORE:
             self._compile_store_operator(expression, variables)
@@ -343,59 +620,47 @@ class Compiler:
         elif expression.operator in arithmetic_operators():
             self._compile_arithmetic_operator(expression, variables)
         else:
-            assert False, "Unknown binary operator [{}]".format(expression.token)
+            assert False, "Unknown binary operator [{}] @ {}".format(
+                expression.operator, format_position(expression.position)
+            )
 
-    def _compile_arithmetic_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+    def _compile_operands(self, expression: BinaryOperationExpression, variables: dict[str, dict], debug: str) -> dict:
+        """Левый операнд загружается в аккумулятор, возвращается адрес правого операнда для инструкции операции.
+
+        Правый операнд-литерал читается самой операцией и не сохраняется на стек, иначе он остается на вершине
+        стека, и после операции его нужно снять (`POP`).
+        """
         self._compile_expression(expression.first, variables)
+        if isinstance(expression.second, NumberLiteralExpression):
+            self.text.write_stack_load(debug)
+            return self._literal_address(expression.second.value)
         self._compile_expression(expression.second, variables)
-        arithmetic_opcode = arithmetic_operators()[expression.operator]
         self.text.write_instruction(
             {
                 "opcode": Opcode.LD,
                 "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +2},
             },
-            debug="binary operation [{}]".format(expression.operator),
-        )
-        self.text.write_instruction(
-            {
-                "opcode": arithmetic_opcode,
-                "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +1},
-            }
-        )
-        self.text.write_pop()
-        self.text.write_instruction(
-            {
-                "opcode": Opcode.ST,
-                "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +1},
-            }
+            debug=debug,
         )
+        return STACK_TOP
+
+    def _compile_arithmetic_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        debug = "binary operation [{}]".format(expression.operator)
+        address = self._compile_operands(expression, variables, debug)
+        self.text.write_instruction({"opcode": arithmetic_operators()[expression.operator], "address": address})
+        if address is STACK_TOP:
+            self.text.write_pop()
+        self.text.write_instruction({"opcode": Opcode.ST, "address": STACK_TOP})
 
     def _compile_comparison_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
         assert expression.operator in comparison_operators()
-        self._compile_expression(expression.first, variables)
-        self._compile_expression(expression.second, variables)
-        comparison_opcode = comparison_operators()[expression.operator]
-        self.text.write_instruction(
-            {
-                "opcode": Opcode.LD,
-                "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +2},
-            },
-            debug="binary operation [{}]".format(expression.operator),
-        )
-        self.text.write_instruction(
-            {
-                "opcode": Opcode.SUB,
-                "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +1},
-            }
-        )
-        self.text.write_instruction({"opcode": comparison_opcode})
-        self.text.write_pop()
-        self.text.write_instruction(
-            {
-                "opcode": Opcode.ST,
-                "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +1},
-            }
-        )
+        debug = "binary operation [{}]".format(expression.operator)
+        address = self._compile_operands(expression, variables, debug)
+        self.text.write_instruction({"opcode": Opcode.SUB, "address": address})
+        self.text.write_instruction({"opcode": comparison_operators()[expression.operator]})
+        if address is STACK_TOP:
+            self.text.write_pop()
+        self.text.write_instruction({"opcode": Opcode.ST, "address": STACK_TOP})
 
     def _compile_store_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
         assert expression.operator == TokenType.KEY_STORE
@@ -449,40 +714,226 @@ class Compiler:
             assert False, "Unknown nullary operator"
         self.text.write_accumulator_push()
 
-    def _compile_loop_expression(self, expression: LoopExpression, variables: dict[str, dict]):
-        loop_start_address = self.text.write_nop(debug="loop start")
-        self._compile_expression(expression.condition, variables)
+    def _compile_difference(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        """Разность операндов сравнения в аккумуляторе, операнды снимаются со стека"""
+        address = self._compile_operands(expression, variables, "compare [{}]".format(expression.operator))
+        self.text.write_instruction({"opcode": Opcode.SUB, "address": address})
+        if address is STACK_TOP:
+            self.text.write_pop()
+        self.text.write_pop()
+
+    def _compile_condition_value(self, expression: Expression, variables: dict[str, dict]):
+        self._compile_expression(expression, variables)
         self.text.write_stack_load()
-        loop_after_instruction = {"opcode": Opcode.JZ, "address": None}
-        self.text.write_instruction(loop_after_instruction, debug="jump out of loop")
-        self.text.write_pop(debug="clear compare")
+        self.text.write_pop()
+
+    def _compile_branch(self, condition: Expression, variables: dict[str, dict], debug: str) -> dict:
+        """Переход, если условие истинно, адрес перехода заполняет вызывающий. Стек остается прежним"""
+        if self._is_branch_comparison(condition):
+            self._compile_difference(condition, variables)
+            opcode = branch_operators()[condition.operator]
+        else:
+            self._compile_condition_value(condition, variables)
+            opcode = Opcode.JNZ
+        jump = {"opcode": opcode, "address": None}
+        self.text.write_instruction(jump, debug=debug)
+        return jump
+
+    def _compile_loop_expression(self, expression: LoopExpression, variables: dict[str, dict]):
+        # condition is checked after the body, so an iteration takes one conditional jump
+        condition_jump = {"opcode": Opcode.JMP, "address": None}
+        self.text.write_instruction(condition_jump, debug="jump to loop condition")
+        body_address = len(self.text.instructions)
         for body_expression in expression.body:
-            self._compile_expression(body_expression, variables)
-            self.text.write_pop()
-        self.text.write_instruction(
-            {"opcode": Opcode.JMP, "address": {"type": Addressing.CONTROL_FLOW, "value": loop_start_address}},
-            debug="jump loop begin",
-        )
-        loop_after_address = self.text.write_nop(debug="loop after")
-        loop_after_instruction["address"] = {"type": Addressing.CONTROL_FLOW, "value": loop_after_address}
+            self._compile_statement(body_expression, variables)
+        condition_address = len(self.text.instructions)
+        loop_jump = self._compile_branch(expression.condition, variables, "jump loop begin")
+        loop_jump["address"] = {"type": Addressing.CONTROL_FLOW, "value": body_address}
+        condition_jump["address"] = {"type": Addressing.CONTROL_FLOW, "value": condition_address}
+        # false condition is the result of the loop
+        self._compile_number_literal(NumberLiteralExpression(expression.position, 0))
 
     def _compile_condition(self, expression: ConditionExpression, variables: dict[str, dict]):
-        self._compile_expression(expression.condition, variables)
-        self.text.write_stack_load()
-        false_jump = {"opcode": Opcode.JZ, "address": None}
-        self.text.write_instruction(false_jump, debug="jump if false")
-        self._compile_expression(expression.true_expression, variables)
-        true_jump_out = {"opcode": Opcode.JMP, "address": None}
-        self.text.write_instruction(true_jump_out)
-        false_address = self.text.write_nop(debug="if false")
+        # false branch goes first, so a comparison needs only the jump on its true result
+        true_jump = self._compile_branch(expression.condition, variables, "jump if true")
         self._compile_expression(expression.false_expression, variables)
-        after_address = self.text.write_instruction(
+        false_jump_out = {"opcode": Opcode.JMP, "address": None}
+        self.text.write_instruction(false_jump_out, debug="jump after if")
+        true_jump["address"] = {"type": Addressing.CONTROL_FLOW, "value": len(self.text.instructions)}
+        self._compile_expression(expression.true_expression, variables)
+        false_jump_out["address"] = {"type": Addressing.CONTROL_FLOW, "value": len(self.text.instructions)}
+
+
+class AccumulatorCompiler(Compiler):
+    """Генерация кода, при которой значение выражения остается в аккумуляторе, а не на стеке.
+
+    Левый операнд бинарной операции сохраняется на стек, только если правый нельзя прочитать одной инструкцией
+    (литерал или переменная). Соглашение о вызове функций то же, что и у `Compiler`, поэтому модули,
+    скомпилированные разными способами, линкуются вместе.
+    """
+
+    @staticmethod
+    def _is_operand(e: Expression) -> bool:
+        return isinstance(
+            e, NumberLiteralExpression | StringLiteralExpression | VariableValueExpression | AllocationExpression
+        )
+
+    def _operand_address(self, expression: Expression, variables: dict[str, dict]) -> dict:
+        match expression:
+            case NumberLiteralExpression():
+                return self._literal_address(expression.value)
+            case StringLiteralExpression():
+                static_address = self.data.put_pointer(self.data.put_string(expression.value))
+            case AllocationExpression():
+                static_address = self.data.put_pointer(self.data.allocate(expression.size))
+            case _:
+                return variables[expression.name]
+        return {"type": Addressing.ABSOLUTE, "value": static_address}
+
+    @staticmethod
+    def _instruction_count(e: Expression) -> int:
+        match e:
+            case FunctionCallExpression():
+                return 1 + 3 * len(e.arguments)
+            # comparison in the condition doesn't write its result (1 instruction less than it is counted)
+            case ConditionExpression() | LoopExpression():
+                count = 2 if isinstance(e, ConditionExpression) else 3
+                return count - AccumulatorCompiler._is_branch_comparison(e.condition)
+            case BinaryOperationExpression() if e.operator == TokenType.KEY_STORE:
+                return 5
+            case BinaryOperationExpression():
+                return AccumulatorCompiler._operation_count(e)
+            case UnaryOperatorExpression(operator=TokenType.KEY_LOAD):
+                return 4
+            case EmptyExpression() | FunctionDefinitionExpression() | BlockExpression():
+                return 0
+        return 1
+
+    @staticmethod
+    def _operation_count(e: BinaryOperationExpression) -> int:
+        # operation takes the place of the load of a simple second operand
+        count = int(e.operator in comparison_operators())
+        if AccumulatorCompiler._is_operand(e.second):
+            return count
+        opcode = arithmetic_operators().get(e.operator)
+        return count + (4 if opcode is not None and opcode.is_commutative() else 8)
+
+    def _compile_function(self, expression: FunctionDefinitionExpression, variables: dict[str, dict]):
+        self.text.write_nop(debug="function [{}]".format(expression.name))
+        local_variables_length = len(variables) - len(expression.parameters)
+        for i in range(local_variables_length):
+            self.text.write_push(debug="allocate local variable [{}]".format(i))
+        # result of the last expression stays in AC
+        for e in expression.body:
+            self._compile_expression(e, variables)
+        for i in range(local_variables_length):
+            self.text.write_pop(debug="clear local variable [{}]".format(i))
+        self.text.write_instruction({"opcode": Opcode.RET})
+
+    def _compile_statement(self, expression: Expression, variables: dict[str, dict]):
+        self._compile_expression(expression, variables)
+
+    def _compile_operand(self, expression: Expression, variables: dict[str, dict], debug: str):
+        address = self._operand_address(expression, variables)
+        self.text.write_instruction({"opcode": Opcode.LD, "address": address}, debug=debug)
+
+    def _compile_variable_value_expression(self, expression: VariableValueExpression, variables: dict[str, dict]):
+        self._compile_operand(expression, variables, "variable value [{}]".format(expression.name))
+
+    def _compile_number_literal(self, expression: NumberLiteralExpression):
+        self._compile_operand(expression, {}, "number literal [{}]".format(expression.value))
+
+    def _compile_string_literal(self, expression: StringLiteralExpression):
+        self._compile_operand(expression, {}, "string literal [{}]".format(expression.value))
+
+    def _compile_allocation(self, expression: AllocationExpression):
+        self._compile_operand(expression, {}, "allocation of size [{}]".format(expression.size))
+
+    def _compile_variable_assignment(self, expression: VariableAssignmentExpression, variables: dict[str, dict]):
+        assert expression.name in variables, "Unknown variable [{}] @ {}".format(
+            expression.name, format_position(expression.position)
+        )
+        self._compile_expression(expression.value, variables)
+        self.text.write_instruction({"opcode": Opcode.ST, "address": variables[expression.name]})
+
+    def _compile_arguments(self, expression: FunctionCallExpression, variables: dict[str, dict]):
+        for argument in expression.arguments:
+            self._compile_expression(argument, variables)
+            self.text.write_accumulator_push()
+
+    def _write_call_result(self):
+        # result of the function is already in AC
+        pass
+
+    def _compile_operation(self, opcode: Opcode, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        """Вычисление `first opcode second` в аккумуляторе"""
+        self._compile_expression(expression.first, variables)
+        debug = "binary operation [{}]".format(expression.operator)
+        if self._is_operand(expression.second):
+            address = self._operand_address(expression.second, variables)
+            self.text.write_instruction({"opcode": opcode, "address": address}, debug=debug)
+            return
+        # second operand overwrites AC, so the first one is spilled to the stack
+        self.text.write_accumulator_push(debug=debug)
+        self._compile_expression(expression.second, variables)
+        if not opcode.is_commutative():
+            self.text.write_accumulator_push()
+            self.text.write_instruction(
+                {
+                    "opcode": Opcode.LD,
+                    "address": {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +2},
+                }
+            )
+            self.text.write_instruction({"opcode": opcode, "address": STACK_TOP})
+            self.text.write_pop()
+        else:
+            self.text.write_instruction({"opcode": opcode, "address": STACK_TOP})
+        self.text.write_pop()
+
+    def _compile_arithmetic_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        self._compile_operation(arithmetic_operators()[expression.operator], expression, variables)
+
+    def _compile_comparison_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        self._compile_operation(Opcode.SUB, expression, variables)
+        self.text.write_instruction({"opcode": comparison_operators()[expression.operator]})
+
+    def _compile_store_operator(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        # result is the address, as in the stack code
+        self._compile_expression(expression.first, variables)
+        self.text.write_accumulator_push(debug="binary operation [{}]".format(expression.operator))
+        self._compile_expression(expression.second, variables)
+        self.text.write_instruction(
             {
                 "opcode": Opcode.ST,
-                "address": {"type": Addressing.RELATIVE, "offset": +2, "register": Register.STACK_POINTER},
-            },
-            debug="after if",
+                "address": {"type": Addressing.RELATIVE_INDIRECT, "register": Register.STACK_POINTER, "offset": +1},
+            }
         )
+        self.text.write_stack_load()
         self.text.write_pop()
-        true_jump_out["address"] = {"type": Addressing.CONTROL_FLOW, "value": after_address}
-        false_jump["address"] = {"type": Addressing.CONTROL_FLOW, "value": false_address}
+
+    def _compile_unary_operator(self, expression: UnaryOperatorExpression, variables: dict[str, dict]):
+        self._compile_expression(expression.operand, variables)
+        debug = "unary operation [{}]".format(expression.operator)
+        unary_opcode = unary_operators()[expression.operator]
+        if unary_opcode != Opcode.LD:
+            self.text.write_instruction({"opcode": unary_opcode}, debug=debug)
+            return
+        # indirect addressing takes the address from memory
+        self.text.write_accumulator_push(debug=debug)
+        self.text.write_instruction(
+            {
+                "opcode": Opcode.LD,
+                "address": {"type": Addressing.RELATIVE_INDIRECT, "register": Register.STACK_POINTER, "offset": +1},
+            }
+        )
+        self.text.write_pop()
+
+    def _compile_nullary_operator(self, expression: NullaryOperatorExpression):
+        assert expression.operator == TokenType.KEY_GET, "Unknown nullary operator"
+        self.text.write_instruction({"opcode": Opcode.GET}, debug="nullary operator")
+
+    def _compile_difference(self, expression: BinaryOperationExpression, variables: dict[str, dict]):
+        self._compile_operation(Opcode.SUB, expression, variables)
+
+    def _compile_condition_value(self, expression: Expression, variables: dict[str, dict]):
+        self._compile_expression(expression, variables)
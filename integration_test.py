@@ -1,14 +1,21 @@
 import contextlib
+import functools
 import io
+import json
 import logging
 import os
 import tempfile
 import unittest
+from pathlib import Path
 
+import linker
+import lockstep
 import machine
 import pytest
 import translator
-from lexer import Lexer
+from cache import CompilationCache
+from lexer import Lexer, TokenType, format_position
+from optimizer import ConstantFolder
 from parsing import Parser
 
 
@@ -80,6 +87,59 @@ class TestLexer(unittest.TestCase):
         source = '"hello'
         self._assert_wrong(source)
 
+    def test_positions(self):
+        tokens = Lexer("(setq s \"a b\")\n  (put 'x')").tokenize()
+        positions = [(token.type, token.line, token.offset) for token in tokens]
+        assert positions == [
+            (TokenType.OPEN_BRACKET, 0, 0),
+            (TokenType.KEY_SETQ, 0, 1),
+            (TokenType.VARNAME, 0, 6),
+            (TokenType.STRING_LITERAL, 0, 8),
+            (TokenType.CLOSE_BRACKET, 0, 13),
+            (TokenType.OPEN_BRACKET, 1, 2),
+            (TokenType.KEY_PUT, 1, 3),
+            (TokenType.NUMBER_LITERAL, 1, 7),
+            (TokenType.CLOSE_BRACKET, 1, 10),
+        ]
+
+    def test_multiline_string_literal(self):
+        tokens = Lexer('(setq s "a\nb\nc") (put 1)').tokenize()
+        assert (tokens[3].type, tokens[3].value, tokens[3].line) == (TokenType.STRING_LITERAL, "a\nb\nc", 0)
+        assert [(token.line, token.offset) for token in tokens[4:6]] == [(2, 2), (2, 4)]
+
+    def test_mod_is_whole_word(self):
+        tokens = Lexer("(setq model (mod mode 3))").tokenize()
+        assert [(token.type, token.value) for token in tokens] == [
+            (TokenType.OPEN_BRACKET, "("),
+            (TokenType.KEY_SETQ, "setq"),
+            (TokenType.VARNAME, "model"),
+            (TokenType.OPEN_BRACKET, "("),
+            (TokenType.MOD, "mod"),
+            (TokenType.VARNAME, "mode"),
+            (TokenType.NUMBER_LITERAL, 3),
+            (TokenType.CLOSE_BRACKET, ")"),
+            (TokenType.CLOSE_BRACKET, ")"),
+        ]
+
+    def test_keywords_are_whole_words(self):
+        tokens = Lexer("(order ifx andy 12)").tokenize()
+        assert [token.type for token in tokens] == [
+            TokenType.OPEN_BRACKET,
+            TokenType.VARNAME,
+            TokenType.VARNAME,
+            TokenType.VARNAME,
+            TokenType.NUMBER_LITERAL,
+            TokenType.CLOSE_BRACKET,
+        ]
+
+    def test_bytes_source(self):
+        source = "(defun f (x) (put 'a') (andy 12)) ; comment\n"
+        tokens = Lexer(source).tokenize()
+        for text in (source.encode(), bytearray(source.encode())):
+            assert [(t.type, t.value, t.line, t.offset) for t in Lexer(text).tokenize()] == [
+                (t.type, t.value, t.line, t.offset) for t in tokens
+            ]
+
 
 class TestParser(unittest.TestCase):
     def _assert_wrong(self, source: str):
@@ -133,3 +193,419 @@ class TestParser(unittest.TestCase):
         self._assert_wrong("if)")
         self._assert_wrong("(if 1)")
         self._assert_wrong("(if 1 2)")
+
+    def test_positions(self):
+        root = Parser(Lexer("(setq x\n  (+ x 1))").tokenize()).parse()
+        assignment = root.expressions[0]
+        assert format_position(assignment.position) == "0 6"
+        assert format_position(assignment.value.position) == "1 3"
+        assert not hasattr(assignment, "__dict__")
+
+    def test_forms(self):
+        forms = Parser(Lexer("(setq x 1) 2 (").tokens()).forms()
+        assert repr(next(forms)) == 'VARIABLE ASSIGNMENT [NAME: "x", VALUE: NUMBER LITERAL [VALUE: "1"]]'
+        assert repr(next(forms)) == 'NUMBER LITERAL [VALUE: "2"]'
+        with pytest.raises(AssertionError, match="Out of tokens"):
+            next(forms)
+
+    def test_deep_nesting(self):
+        depth = 100000
+        root = Parser(Lexer("(setq x " + "(not " * depth + "x" + ")" * depth + ")").tokenize()).parse()
+        assert root.depth() == depth + 2
+        assert sum(1 for _ in root.descendants()) == depth + 2
+        with pytest.raises(AssertionError, match="Limit of instruction memory exceeded"):
+            translator.translate("(defun f (x) " + "(f " * depth + "1" + ")" * depth + ")")
+
+
+class TestConstantFolding(unittest.TestCase):
+    def _fold(self, source: str) -> str:
+        return repr(ConstantFolder().fold(Parser(Lexer(source).tokenize()).parse().expressions[0]))
+
+    def test_fold(self):
+        assert self._fold("(+ 1 (- 0 3))") == 'NUMBER LITERAL [VALUE: "-2"]'
+        assert self._fold("(- 0 3)") == 'NUMBER LITERAL [VALUE: "-3"]'
+        assert self._fold("(< (- 0 3) 1)") == 'NUMBER LITERAL [VALUE: "1"]'
+        assert self._fold("(if (not 0) x y)") == 'VARIABLE [VALUE: "x"]'
+        assert self._fold("(+ (and x 0) (or 0 y))") == 'VARIABLE [VALUE: "y"]'
+        assert self._fold("(= x x)") == 'NUMBER LITERAL [VALUE: "1"]'
+        assert self._fold("(* (/ (- 0 17) 5) (mod (- 0 17) 5))") == 'NUMBER LITERAL [VALUE: "6"]'
+        assert self._fold("(/ (* 1 x) 1)") == 'VARIABLE [VALUE: "x"]'
+
+    def test_side_effects(self):
+        assert self._fold("(and (get) 0)").startswith("BINARY")
+        assert self._fold("(or (put 1) (- 0 1))").startswith("BINARY")
+        assert self._fold("(if 0 (put 1) (setq x 1))").startswith("VARIABLE ASSIGNMENT")
+        assert self._fold("(* (get) 0)").startswith("BINARY")
+        # division by zero stops the machine, so it is left for run time
+        assert self._fold("(mod 1 0)").startswith("BINARY")
+        assert self._fold("(* (/ x 0) 0)").startswith("BINARY")
+
+    def test_removed_instructions(self):
+        source = "(setq x 4) (print-num (+ (- x x) (if (< 1 2) (+ x (not (not 0))) (put (- 1 (get))))))"
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib = translator.compile_library(file.read())
+        for backend in translator.Backend:
+            sizes = []
+            for optimize in (False, True):
+                compiler = translator.compilers()[backend](
+                    translator.DATA_SEGMENT_SIZE, translator.TEXT_SEGMENT_SIZE, optimize=optimize
+                )
+                module = compiler.process(Parser(Lexer(source).tokens()).forms())
+                code, data = linker.link([module, stdlib], 2048, 1024, optimize=False)
+                assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "4"
+                sizes.append(len(code))
+            assert compiler.removed_nodes == 16
+            assert compiler.removed_instructions == sizes[0] - sizes[1]
+
+
+class TestInlining(unittest.TestCase):
+    def _run(self, source: str, threshold: int) -> tuple[linker.ObjectModule, str, int]:
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib = translator.compile_library(file.read())
+        compiler = translator.compilers()[translator.Backend.STACK](
+            translator.DATA_SEGMENT_SIZE,
+            translator.TEXT_SEGMENT_SIZE,
+            inline_functions=stdlib.inline_functions,
+            inline_threshold=threshold,
+        )
+        module = compiler.process(Parser(Lexer(source).tokens()).forms())
+        code, data = linker.link([module, stdlib], 2048, 1024)
+        output, _, ticks = machine.simulation(data, code, 2048, 2048, list(map(ord, "abc")), 100000)
+        return module, output, ticks
+
+    def test_inline(self):
+        source = (
+            "(defun sub (a b) (setq c (- a b)) c) (print-num (sub 10 (sub 5 1)))"
+            "(. (put 97) (put (is-not (get)))) (print-num (sub (get) (get)))"
+        )
+        module, output, ticks = self._run(source, 24)
+        assert module.entry().calls == ["print-num"]
+        assert output == "6a\x00-1"
+        plain_module, plain_output, plain_ticks = self._run(source, 0)
+        assert plain_module.entry().calls == ["print-num", "sub", ".", "is-not"]
+        assert output == plain_output
+        assert ticks < plain_ticks
+
+    def test_recursion(self):
+        module, output, _ = self._run("(defun f (n) (if (> n 0) (f (- n 1)) 7)) (print-num (f 2))", 1000)
+        assert module.entry().calls == ["print-num", "f"]
+        assert output == "7"
+
+
+class TestTailCalls(unittest.TestCase):
+    def test_constant_stack(self):
+        source = (
+            "(defun count (n acc) (if (= n 0) acc (count (- n 1) (+ acc 1))))"
+            "(defun even (n) (setq m (- n 1)) (if (= n 0) 1 (odd m)))"
+            "(defun odd (n) (setq m (- n 1)) (if (= n 0) 0 (even m)))"
+            "(print-num (count 3000 0)) (print-num (+ (even 3000) (odd 3000)))"
+        )
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib_source = file.read()
+        for backend in translator.Backend:
+            code, data = translator.translate(source, [translator.compile_library(stdlib_source, backend)], backend)
+            # every frame takes at least 3 words, so 3000 frames don't fit in memory
+            assert "tail call [count]" in [instruction.get("debug") for instruction in code]
+            assert machine.simulation(data, code, 2048, 2048, [], 1000000)[0] == "30001"
+
+
+class TestBranches(unittest.TestCase):
+    def test_fused_comparisons(self):
+        source = (
+            "(setq i 0) (setq n 0) (loop (< i 5) (setq i (+ i 1)) (setq n (+ n (if (> i 2) 10 1))))"
+            "(print-num (+ n (if (= i 5) 100 200))) (print-num (+ 7 (loop (= i 0) 1))) (print-num (if i 3 4))"
+        )
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib_source = file.read()
+        for backend in translator.Backend:
+            module = translator.compile_module(source, backend=backend)
+            opcodes = {instruction["opcode"] for instruction in module.entry().text}
+            # comparisons in conditions don't compute 0 or 1
+            assert not opcodes & {"isneg", "ispos", "iszero"}
+            assert {"jneg", "jpos", "jz", "jnz"} <= opcodes
+            code, data = translator.translate(source, [translator.compile_library(stdlib_source, backend)], backend)
+            assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "13273"
+
+
+class TestBackends(unittest.TestCase):
+    def test_same_output(self):
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib_source = file.read()
+        for name, stdin in (("cat", "foo"), ("hello_user_name", "Alice")):
+            with open("examples/{}.clisp".format(name), encoding="utf-8") as file:
+                source = file.read()
+            results = []
+            for backend in translator.Backend:
+                code, data = translator.translate(source, [translator.compile_library(stdlib_source, backend)], backend)
+                results.append(machine.simulation(data, code, 2048, 2048, list(map(ord, stdin)), 100000))
+            stack, accumulator = results
+            assert stack[0] == accumulator[0]
+            assert accumulator[2] < stack[2] * 0.7
+
+    def test_mixed_libraries(self):
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib = translator.compile_library(file.read())
+        code, data = translator.translate(
+            "(print-num (div 17 5)) (print-num (mod 17 5))", [stdlib], translator.Backend.ACCUMULATOR
+        )
+        assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "32"
+
+
+class TestEngines(unittest.TestCase):
+    def _program(self, source: str):
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            return translator.translate(source + "\n" + file.read())
+
+    def _run(self, control_unit_type, source: str, stdin: str, limit: int):
+        text_segment, data_segment = self._program(source)
+        input_port = machine.InputPort(map(ord, stdin))
+        data_path = machine.DataPath(2048, data_segment, input_port, machine.OutputPort())
+        control_unit = control_unit_type(2048, machine.decode_program(text_segment), data_path)
+        instruction_count = 0
+        with contextlib.suppress(StopIteration):
+            while control_unit.current_tick() < limit:
+                instruction_count += control_unit.step(limit)
+        return data_path.get_output_buffer(), instruction_count, control_unit.current_tick(), repr(data_path)
+
+    def test_same_state(self):
+        source = "(setq buffer (alloc 16)) (read buffer 16) (print buffer) (print-num (+ 100 (- 0 7)))"
+        source += "(setq x 1000) (print-num (* (/ x (- 0 7)) (mod x 7)))"
+        engines = [
+            machine.InstructionControlUnit,
+            machine.JitControlUnit,
+            functools.partial(machine.JitControlUnit, hot_threshold=1),
+        ]
+        for limit in [1, 2, 3, 17, 100, 1001, 5003, 100000]:
+            expected = self._run(machine.ControlUnit, source, "abc", limit)
+            for engine in engines:
+                assert expected == self._run(engine, source, "abc", limit)
+
+
+class TestMemory(unittest.TestCase):
+    def test_allocate_memory(self):
+        data_segment = [1, -(2**32), 2**32 - 1, -1]
+        memory = machine.allocate_memory(machine.MAX_MEMORY_SIZE, data_segment)
+        assert len(memory) == machine.MAX_MEMORY_SIZE
+        assert memory[:5].tolist() == [*data_segment, 0]
+        memory[machine.MAX_MEMORY_SIZE - 1] = machine.overflow(2**32)
+        assert memory[-1] == -(2**32)
+
+
+class TestPorts(unittest.TestCase):
+    def test_input_port(self):
+        port = machine.InputPort(machine.stream_input(io.StringIO("abc"), chunk_size=2))
+        assert [port.read() for _ in range(5)] == [ord("a"), ord("b"), ord("c"), 0, 0]
+
+    def test_output_port_flush(self):
+        sink = io.StringIO()
+        port = machine.OutputPort(sink, buffer_size=2)
+        for char in "hello":
+            port.write(ord(char))
+        assert sink.getvalue() == "hell"
+        assert port.buffer() == [ord("o")]
+        port.flush()
+        assert sink.getvalue() == "hello"
+        assert port.written == 5
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            code_file = os.path.join(tmpdir, "code.o")
+            results_file = os.path.join(tmpdir, "results.json")
+            with contextlib.redirect_stdout(io.StringIO()):
+                translator.main("examples/cat.clisp", code_file)
+            input_files = []
+            for i, stdin in enumerate(["", "a", "hello", "batch\nmode"]):
+                input_files.append(os.path.join(tmpdir, "input_{}.txt".format(i)))
+                with open(input_files[-1], "w", encoding="utf-8") as file:
+                    file.write(stdin)
+
+            results = machine.batch(code_file, input_files, results_file, workers=2)
+
+            text_segment, data_segment = translator.read_code(code_file)
+            for input_file, result in zip(input_files, results):
+                with open(input_file, encoding="utf-8") as file:
+                    output, instruction_count, ticks = machine.simulation(
+                        data_segment, text_segment, 2048, 2048, map(ord, file.read()), 100000000
+                    )
+                assert result == {
+                    "input": input_file,
+                    "output": output,
+                    "instruction_count": instruction_count,
+                    "ticks": ticks,
+                }
+            with open(results_file, encoding="utf-8") as file:
+                assert json.load(file) == results
+
+
+# CI installs NumPy with the dev dependencies, so there the test must not be skipped
+@unittest.skipIf(lockstep.np is None and "CI" not in os.environ, "NumPy is not installed")
+class TestLockstep(unittest.TestCase):
+    def test_same_results(self):
+        with open("examples/hello_user_name.clisp", encoding="utf-8") as file:
+            source = file.read()
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            source += "\n" + file.read()
+        text_segment, data_segment = translator.translate(source)
+        inputs = ["Alice\n", "Bob\n", "", "a much longer name\n", "Bob\n"]
+        for limit in [1, 50, 333, 1000, 100000]:
+            results = lockstep.lockstep_simulation(data_segment, text_segment, 2048, 2048, inputs, limit)
+            expected = [
+                machine.simulation(data_segment, text_segment, 2048, 2048, map(ord, stdin), limit) for stdin in inputs
+            ]
+            assert results == expected
+
+
+class TestBinaryCode(unittest.TestCase):
+    def test_same_as_json(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_file = os.path.join(tmpdir, "code.json")
+            binary_file = os.path.join(tmpdir, "code.o")
+            with contextlib.redirect_stdout(io.StringIO()):
+                translator.main("examples/hello_user_name.clisp", json_file)
+                translator.main("examples/hello_user_name.clisp", binary_file, translator.CodeFormat.BINARY)
+            json_code, json_data = translator.read_code(json_file)
+            binary_code, binary_data = translator.read_code(binary_file)
+            assert binary_data == json_data
+            assert len(binary_code) == len(json_code)
+            for binary_instruction, json_instruction in zip(binary_code, json_code):
+                assert json.loads(json.dumps(binary_instruction)) == json_instruction
+            for engine in machine.Engine:
+                assert machine.simulation(
+                    binary_data, binary_code, 2048, 2048, map(ord, "Alice\n"), 100000, engine
+                ) == machine.simulation(json_data, json_code, 2048, 2048, map(ord, "Alice\n"), 100000, engine)
+
+    def test_wide_literals(self):
+        code, data = translator.translate("(setq x 3000000000) (put (- x 2999999951))")
+        assert 2**31 < 3000000000 <= max(data)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            binary_file = os.path.join(tmpdir, "code.o")
+            translator.write_binary_code(binary_file, code, data)
+            binary_code, binary_data = translator.read_code(binary_file)
+            assert binary_data == data
+            assert machine.simulation(binary_data, binary_code, 2048, 2048, iter([]), 1000)[0] == "1"
+
+
+class TestCompilationCache(unittest.TestCase):
+    def test_cached_translate(self):
+        with open("examples/hello_user_name.clisp", encoding="utf-8") as file:
+            source = file.read()
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib = file.read() + "\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = CompilationCache(tmpdir)
+            code, data = translator.cached_translate(source, stdlib, cache)
+            cached_code, cached_data = translator.cached_translate(source, stdlib, cache)
+            assert (cache.hits, cache.misses) == (1, 1)
+            assert json.dumps(cached_code) == json.dumps(code)
+            assert cached_data == data
+            translator.cached_translate(source + "(put 10)", stdlib, cache)
+            assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = CompilationCache(tmpdir, max_size=100)
+            cache.put("first", [{"opcode": "nop"}], [1] * 20)
+            os.utime(os.path.join(tmpdir, "first.json"), (0, 0))
+            cache.put("second", [{"opcode": "nop"}], [1] * 20)
+            assert cache.get("first") is None
+            assert cache.get("second") == ([{"opcode": "nop"}], [1] * 20)
+
+
+class TestLinker(unittest.TestCase):
+    def test_precompiled_library(self):
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib = translator.compile_library(file.read())
+        assert stdlib.entry() is None
+        assert {"print", "read", "div"} <= set(stdlib.exports())
+        program = translator.compile_module('(print "hi")')
+        assert program.unresolved() == {"print"}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            object_file = os.path.join(tmpdir, "stdlib.json")
+            linker.write_object(object_file, stdlib)
+            library = linker.read_object(object_file)
+            code, data = linker.link([program, library], 2048, 1024)
+        # inlinable functions are kept in the object file
+        assert [repr(function) for function in library.inline_functions] == list(map(repr, stdlib.inline_functions))
+        assert json.dumps([code, data]) == json.dumps(translator.translate('(print "hi")', [stdlib]))
+        assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "hi"
+        # only reachable functions are linked
+        functions = [instruction["debug"] for instruction in code if instruction["opcode"] == "nop"][1:]
+        assert functions == ["function [print]"]
+
+    def test_library_object_file(self):
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib_source = file.read()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source_file = os.path.join(tmpdir, "stdlib.clisp")
+            object_file = translator.library_object_file(source_file, translator.Backend.STACK)
+            library = translator.load_library(source_file, stdlib_source)
+            written = Path(object_file).stat().st_mtime_ns
+            # the second translation reads the object file instead of writing it again
+            loaded = translator.load_library(source_file, stdlib_source)
+            assert Path(object_file).stat().st_mtime_ns == written
+            assert set(loaded.exports()) == set(library.exports())
+            assert [function.name for function in loaded.inline_functions] == [".", "is-not", "div"]
+            code, data = translator.translate("(print-num (div 7 2))", [loaded])
+            assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "3"
+            # object file of another library source is rebuilt
+            assert set(translator.load_library(source_file, "(defun one () 1)").exports()) == {"one"}
+
+    def test_call_graph(self):
+        source = "(defun f (a) (setq b (g a)) (g b)) (defun g (x) x) (f (g 1))"
+        compiler = translator.compilers()[translator.Backend.STACK](
+            translator.DATA_SEGMENT_SIZE, translator.TEXT_SEGMENT_SIZE, optimize=False
+        )
+        module = compiler.process(Parser(Lexer(source).tokens()).forms())
+        calls = {section.name: section.calls for section in module.sections}
+        assert calls == {None: ["f", "g"], "f": ["g"], "g": []}
+
+    def test_constant_pooling(self):
+        source = '(defun f (x) (print "hi") (+ x 70000000)) (print "hi") (print-num (f 70000000))'
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib = translator.compile_library(file.read())
+        code, data = translator.translate(source, [stdlib])
+        assert data.count(70000000) == 1
+        assert data.count(ord("h")) == 1
+        assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "hihi140000000"
+
+    def test_immediate_operands(self):
+        source = "(setq x 8388607) (print-num (- (+ x 8388608) (- 0 8388608)))"
+        with open(translator.STDLIB_FILE, encoding="utf-8") as file:
+            stdlib_source = file.read()
+        for backend in translator.Backend:
+            code, data = translator.translate(source, [translator.compile_library(stdlib_source, backend)], backend)
+            # only the literal which doesn't fit in the instruction takes a data word
+            assert data == [0, 8388608]
+            assert {"type": "immediate", "value": 8388607} in [instruction.get("address") for instruction in code]
+            assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "25165823"
+
+    def test_literal_second_operand(self):
+        source = "(setq x 66) (put (- x 1)) (if (< x 80) (put 65) 0)"
+        for backend in translator.Backend:
+            code, data = translator.translate(source, [], backend)
+            # the operation reads the literal itself, so it is never pushed to the stack
+            assert {"type": "immediate", "value": 1} in [instruction.get("address") for instruction in code]
+            assert {"type": "immediate", "value": 80} in [instruction.get("address") for instruction in code]
+            assert {"opcode": "ld", "address": {"type": "immediate", "value": 1}} not in [
+                {key: instruction.get(key) for key in ("opcode", "address")} for instruction in code
+            ]
+            assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "AA"
+
+    def test_peephole(self):
+        module = translator.compile_module(
+            "(setq x 0) (loop (< x 3) (setq x (+ x 1)) (put (+ 48 x))) (setq b (alloc 2))"
+        )
+        plain, _ = linker.link([module], 2048, 1024, optimize=False)
+        code, data = linker.link([module], 2048, 1024)
+        assert len(code) < len(plain)
+        assert [instruction["index"] for instruction in code] == list(range(len(code)))
+        assert machine.simulation(data, code, 2048, 2048, [], 100000)[0] == "123"
+
+    def test_unresolved_symbol(self):
+        with pytest.raises(AssertionError, match="Unknown function symbol"):
+            translator.translate("(unknown 1)")
+        library = translator.compile_library("(defun twice(x) (+ x x))")
+        with pytest.raises(AssertionError, match="Duplicate function symbol"):
+            translator.translate("(twice 1)", [library, library])
@@ -22,6 +22,12 @@ class Opcode(str, Enum):
     IS_ZERO = "iszero"
     NOP = "nop"
     HALT = "halt"
+    MUL = "mul"
+    DIV = "div"
+    MOD = "mod"
+    JNZ = "jnz"
+    JNEG = "jneg"
+    JPOS = "jpos"
 
     def is_address(self):
         return self in {
@@ -34,20 +40,34 @@ class Opcode(str, Enum):
             Opcode.JMP,
             Opcode.JZ,
             Opcode.CALL,
+            Opcode.MUL,
+            Opcode.DIV,
+            Opcode.MOD,
+            Opcode.JNZ,
+            Opcode.JNEG,
+            Opcode.JPOS,
         }
 
     def is_operand(self):
-        return self in {Opcode.ADD, Opcode.SUB, Opcode.AND, Opcode.OR, Opcode.LD}
+        return self in {Opcode.ADD, Opcode.SUB, Opcode.AND, Opcode.OR, Opcode.LD, Opcode.MUL, Opcode.DIV, Opcode.MOD}
+
+    def is_commutative(self):
+        return self in {Opcode.ADD, Opcode.AND, Opcode.OR, Opcode.MUL}
 
     def __repr__(self):
         return self.name
 
 
+# stable numbering of opcodes for decoded instructions
+OPCODE_NUMBERS = {opcode: number for number, opcode in enumerate(Opcode)}
+
+
 class Addressing(str, Enum):
     ABSOLUTE = "absolute"
     RELATIVE = "relative"
     RELATIVE_INDIRECT = "relative-indirect"
     CONTROL_FLOW = "control-flow"
+    IMMEDIATE = "immediate"
 
     def __repr__(self):
         return self.name
@@ -59,3 +79,27 @@ class Register(str, Enum):
 
     def __repr__(self):
         return self.name
+
+
+# bounds of the value encoded in the instruction (address, offset or immediate operand)
+OPERAND_MAX = 2**23 - 1
+OPERAND_MIN = -(2**23)
+
+# machine word arithmetic wraps around, shared by the simulator and the compiler
+HALF_N = 2**32
+N = HALF_N * 2
+
+
+def overflow(value):
+    return (value + HALF_N) % N - HALF_N
+
+
+# division truncates towards zero, remainder has the sign of the dividend
+def divide(a, b):
+    quotient = abs(a) // abs(b)
+    return overflow(quotient if (a < 0) == (b < 0) else -quotient)
+
+
+def remainder(a, b):
+    rest = abs(a) % abs(b)
+    return rest if a >= 0 else -rest
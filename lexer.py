@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import mmap
 import re
+import sys
+from collections.abc import Iterator
 from enum import Enum
 
 
@@ -17,10 +20,13 @@ class TokenType(str, Enum):
     EQUALS = "T_EQUALS"  # =
     LESS = "T_LESS"  # <
     GREATER = "T_GREATER"  # >
+    MUL = "T_MUL"  # *
+    DIV = "T_DIV"  # /
 
     AND = "T_AND"  # and
     OR = "T_OR"  # or
     NOT = "T_NOT"  # not
+    MOD = "T_MOD"  # mod
 
     KEY_DEFUN = "T_KEY_DEFUN"  # defun
     KEY_LOOP = "T_KEY_LOOP"  # loop
@@ -37,33 +43,57 @@ class TokenType(str, Enum):
         return self.value
 
 
-tokens_patterns = [
-    (r"\(", TokenType.OPEN_BRACKET),
-    (r"\)", TokenType.CLOSE_BRACKET),
-    (r"\+", TokenType.PLUS),
-    (r"-", TokenType.SUB),
-    (r"=", TokenType.EQUALS),
-    (r"<", TokenType.LESS),
-    (r">", TokenType.GREATER),
-    (r"and", TokenType.AND),
-    (r"or", TokenType.OR),
-    (r"not", TokenType.NOT),
-    (r"defun", TokenType.KEY_DEFUN),
-    (r"loop", TokenType.KEY_LOOP),
-    (r"setq", TokenType.KEY_SETQ),
-    (r"alloc", TokenType.KEY_ALLOC),
-    (r"put", TokenType.KEY_PUT),
-    (r"get", TokenType.KEY_GET),
-    (r"load", TokenType.KEY_LOAD),
-    (r"store", TokenType.KEY_STORE),
-    (r"if", TokenType.KEY_IF),
-    (r"'.'", TokenType.CHARACTER_LITERAL),
-    (r'"(.*)"', TokenType.STRING_LITERAL),
-    (r"[+-]?[0-9]+", TokenType.NUMBER_LITERAL),
-    (r"[a-zA-Z\.]\w*", TokenType.VARNAME),
-]
-assert len(tokens_patterns) == len([i for i in TokenType])  # assert that all cases are matched
-tokens_patterns = [(re.compile(pattern), ttype) for pattern, ttype in tokens_patterns]  # compile patterns
+# rest of a word: words end with brackets or whitespace
+WORD_END = r"[^() \n\t]*"
+
+# operators and keywords are whole words, other words are literals and names
+keywords = {
+    "(": TokenType.OPEN_BRACKET,
+    ")": TokenType.CLOSE_BRACKET,
+    "+": TokenType.PLUS,
+    "-": TokenType.SUB,
+    "=": TokenType.EQUALS,
+    "<": TokenType.LESS,
+    ">": TokenType.GREATER,
+    "*": TokenType.MUL,
+    "/": TokenType.DIV,
+    "and": TokenType.AND,
+    "or": TokenType.OR,
+    "not": TokenType.NOT,
+    "mod": TokenType.MOD,
+    "defun": TokenType.KEY_DEFUN,
+    "loop": TokenType.KEY_LOOP,
+    "setq": TokenType.KEY_SETQ,
+    "alloc": TokenType.KEY_ALLOC,
+    "put": TokenType.KEY_PUT,
+    "get": TokenType.KEY_GET,
+    "load": TokenType.KEY_LOAD,
+    "store": TokenType.KEY_STORE,
+    "if": TokenType.KEY_IF,
+}
+literal_types = {TokenType.CHARACTER_LITERAL, TokenType.STRING_LITERAL, TokenType.NUMBER_LITERAL, TokenType.VARNAME}
+assert set(keywords.values()) | literal_types == set(TokenType)  # assert that all cases are matched
+
+# one character operators and brackets, words, character and string literals
+tokens_patterns = [r"[()+\-=<>*/]", r"[a-zA-Z0-9.]" + WORD_END, r"'{char}'", r'"[^"\n]*"']
+
+# string literals may span lines, such a literal has its own group to keep line numbers
+MULTILINE_STRING_PATTERN = r'"[^"]*"'
+
+# groups of the master pattern, comments have no group and spaces are skipped by finditer
+NEWLINE_GROUP = 1
+TOKEN_GROUP = 2
+MULTILINE_STRING_GROUP = 3
+
+
+def _master_pattern(char: str) -> str:
+    tokens_pattern = "|".join(pattern.format(char=char) for pattern in tokens_patterns)
+    return r"(\n)|({})|({})|;[^\n]*|([^ \t\n]{})".format(tokens_pattern, MULTILINE_STRING_PATTERN, WORD_END)
+
+
+master_pattern = re.compile(_master_pattern(r"[^\n]"))
+# for bytes one character is one UTF-8 sequence
+master_bytes_pattern = re.compile(_master_pattern(r"(?:[^\n\x80-\xff]|[\xc0-\xff][\x80-\xbf]+)").encode("latin-1"))
 
 
 def binary_operators():
@@ -72,6 +102,9 @@ def binary_operators():
         TokenType.OR,
         TokenType.PLUS,
         TokenType.SUB,
+        TokenType.MUL,
+        TokenType.DIV,
+        TokenType.MOD,
         TokenType.EQUALS,
         TokenType.LESS,
         TokenType.GREATER,
@@ -87,117 +120,99 @@ def nullary_operators():
     return {TokenType.KEY_GET}
 
 
+# position in source is packed into one integer: line in high bits, column in low bits
+POSITION_OFFSET_BITS = 32
+POSITION_OFFSET_MASK = (1 << POSITION_OFFSET_BITS) - 1
+
+
+def pack_position(line: int, offset: int) -> int:
+    return line << POSITION_OFFSET_BITS | offset
+
+
+def format_position(position: int) -> str:
+    return "{} {}".format(position >> POSITION_OFFSET_BITS, position & POSITION_OFFSET_MASK)
+
+
 class Token:
-    def __init__(self, token, line, offset):
-        self.type = None
-        self.value = None
-        for pattern, token_type in tokens_patterns:
-            match = pattern.match(token)
-            if match:
-                self.type = token_type
-                if token_type == TokenType.STRING_LITERAL:
-                    self.value = token[1:-1]
-                elif token_type == TokenType.NUMBER_LITERAL:
-                    assert token.isdigit()
-                    self.value = int(token)
-                elif token_type == TokenType.CHARACTER_LITERAL:
-                    self.type = TokenType.NUMBER_LITERAL
-                    self.value = ord(token[1:-1])
-                else:
-                    self.value = token
-                break
-        assert self.type is not None, "Unknown token"
-        self.line = line
-        self.offset = offset
+    __slots__ = ("position", "type", "value")
+
+    def __init__(self, token_type: TokenType, value: str | int, position: int):
+        self.type = token_type
+        self.value = value
+        self.position = position
+
+    @property
+    def line(self) -> int:
+        return self.position >> POSITION_OFFSET_BITS
+
+    @property
+    def offset(self) -> int:
+        return self.position & POSITION_OFFSET_MASK
 
     def __repr__(self):
-        return f'Token[{self.type} "{self.value}" @ {self.line} {self.offset}]'
+        return f'Token[{self.type} "{self.value}" @ {format_position(self.position)}]'
+
+
+def _word(token: str) -> tuple[TokenType, str | int] | None:
+    """Тип и значение слова исходного кода, `None` для неизвестного слова"""
+    token_type = keywords.get(token)
+    if token_type is not None:
+        return token_type, sys.intern(token)
+    if token[0] == '"':
+        return TokenType.STRING_LITERAL, token[1:-1]
+    if token[0] == "'":
+        return TokenType.NUMBER_LITERAL, ord(token[1:-1])
+    if token[0].isdigit():
+        return (TokenType.NUMBER_LITERAL, int(token)) if token.isascii() and token.isdigit() else None
+    # names repeat a lot, so equal values share one string
+    return TokenType.VARNAME, sys.intern(token)
 
 
 class Lexer:
-    def __init__(self, text: str):
-        self.ptr = 0
+    """Разбивает исходный код на токены за один проход одним регулярным выражением.
+
+    Исходный код - строка или байты в UTF-8 (в том числе `mmap` файла).
+    """
+
+    def __init__(self, text: str | bytes | bytearray | memoryview | mmap.mmap):
         self.text = text
-        self.line = 0
-        self.offset = 0
 
     def tokenize(self) -> list[Token]:
-        tokens = []
-        while True:
-            token = self._next()
-            if token is None:
-                break
-            tokens.append(token)
-        return tokens
-
-    def _next(self) -> Token | None:
-        if self._skip_empty():
-            return None
-        char = self.text[self.ptr]
-        current_offset = self.offset
-        if char in ["(", ")", "+", "-", "*", "/", "=", "<", ">"]:
-            self.ptr += 1
-            self.offset += 1
-            return Token(char, self.line, current_offset)
-        if char == '"':
-            return Token(self._read_string_literal(), self.line, current_offset)
-        if char == "'":
-            return Token(self._read_character_literal(), self.line, current_offset)
-        return Token(self._read_string(), self.line, current_offset)
-
-    def _read_string(self) -> str:
-        result = ""
-        while not self._eof() and self._cur() not in ["(", ")", " ", "\n", "\t"]:
-            result += self.text[self.ptr]
-            self.ptr += 1
-            self.offset += 1
-        return result
-
-    def _read_character_literal(self):
-        result = ""
-        assert self._cur() == "'"
-        result += self._cur()
-        self.ptr += 1
-        result += self._cur()
-        self.ptr += 1
-        assert self._cur() == "'"
-        result += self._cur()
-        self.ptr += 1
-        return result
-
-    def _read_string_literal(self) -> str:
-        result = '"'
-        self.ptr += 1
-        while not self._eof() and self._cur() != '"':
-            result += self.text[self.ptr]
-            self.ptr += 1
-            self.offset += 1
-        result += self._cur()
-        self.ptr += 1
-        return result
-
-    def _skip_empty(self) -> bool:
-        while not self._eof() and self._cur() in ["\n", " ", "\t", ";"]:
-            if self._cur() == ";":
-                while not self._eof():
-                    if self._cur() == "\n":
-                        self.ptr += 1
-                        self.line += 1
-                        self.offset = 0
-                        break
-                    self.ptr += 1
-            elif self._cur() == "\n":
-                self.line += 1
-                self.offset = 0
-                self.ptr += 1
-            else:
-                self.offset += 1
-                self.ptr += 1
-        return self._eof()
-
-    def _eof(self) -> bool:
-        return self.ptr == len(self.text)
-
-    def _cur(self) -> str:
-        assert not self._eof()
-        return self.text[self.ptr]
+        return list(self.tokens())
+
+    def tokens(self) -> Iterator[Token]:
+        """Ленивый поток токенов, текст разбирается по мере чтения.
+
+        Тип и значение каждого различного слова определяются один раз, повторы берутся из словаря `words`.
+        """
+        binary = not isinstance(self.text, str)
+        pattern = master_bytes_pattern if binary else master_pattern
+        newline = b"\n" if binary else "\n"
+        words = {}
+        line = 0
+        # packed position of a token is line_base plus its index in the text
+        line_base = 0
+        for match in pattern.finditer(self.text):
+            group = match.lastindex
+            if group == TOKEN_GROUP:
+                token = match[0]
+                word = words.get(token)
+                if word is None:
+                    word = _word(token.decode("utf-8") if binary else token)
+                    assert word is not None, "Unknown token [{}] @ {}".format(
+                        token, format_position(line_base + match.start())
+                    )
+                    words[token] = word
+                token_type, value = word
+                yield Token(token_type, value, line_base + match.start())
+            elif group == NEWLINE_GROUP:
+                line += 1
+                line_base = (line << POSITION_OFFSET_BITS) - match.end()
+            elif group == MULTILINE_STRING_GROUP:
+                token = match[0]
+                value = token.decode("utf-8") if binary else token
+                yield Token(TokenType.STRING_LITERAL, value[1:-1], line_base + match.start())
+                line += token.count(newline)
+                line_base = (line << POSITION_OFFSET_BITS) - (match.start() + token.rindex(newline) + 1)
+            elif group is not None:
+                assert False, "Unknown token [{}] @ {}".format(match[0], format_position(line_base + match.start()))
@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import tempfile
+from collections import deque
+from pathlib import Path
+
+import peephole
+from isa import Addressing
+from parsing import FunctionDefinitionExpression, expression_from_dict, expression_to_dict
+
+
+class Section:
+    """Секция объектного модуля - код корня программы (`name` равно None) или одной функции вместе с ее данными.
+
+    Адреса кода и данных в секции отсчитываются от ее начала. Записи перемещения - номера инструкций,
+    адрес которых указывает в код (`text_relocations`) или в данные (`data_relocations`) секции, и номера
+    слов данных, которые хранят адрес в данных секции (`pointer_relocations`). Вызовы функций других
+    секций и переходы хвостовых вызовов хранят имя функции в поле `symbol` и разрешаются при линковке, а имена
+    вызываемых функций (ребра графа вызовов) собраны в `calls`. Неизменяемые блоки данных (числовые и строковые
+    литералы) перечислены в `constants` парами (начало, длина).
+    """
+
+    def __init__(
+        self,
+        name: str | None,
+        text: list[dict],
+        data: list[int],
+        text_relocations: list[int],
+        data_relocations: list[int],
+        pointer_relocations: list[int],
+        constants: list[list[int]],
+        calls: list[str],
+    ):
+        self.name = name
+        self.text = text
+        self.data = data
+        self.text_relocations = text_relocations
+        self.data_relocations = data_relocations
+        self.pointer_relocations = pointer_relocations
+        self.constants = constants
+        self.calls = calls
+
+    @staticmethod
+    def build(
+        name: str | None,
+        text: list[dict],
+        data: list[int],
+        pointers: list[int],
+        constants: list[list[int]],
+        calls: list[str],
+    ) -> Section:
+        text_relocations = []
+        data_relocations = []
+        for index, instruction in enumerate(text):
+            address = instruction.get("address")
+            if address is None:
+                continue
+            if address["type"] == Addressing.CONTROL_FLOW:
+                text_relocations.append(index)
+            elif address["type"] == Addressing.ABSOLUTE:
+                data_relocations.append(index)
+        return Section(name, text, data, text_relocations, data_relocations, pointers, constants, calls)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "text": self.text,
+            "data": self.data,
+            "text_relocations": self.text_relocations,
+            "data_relocations": self.data_relocations,
+            "pointer_relocations": self.pointer_relocations,
+            "constants": self.constants,
+            "calls": self.calls,
+        }
+
+    @staticmethod
+    def from_dict(section: dict) -> Section:
+        return Section(
+            section["name"],
+            section["text"],
+            section["data"],
+            section["text_relocations"],
+            section["data_relocations"],
+            section["pointer_relocations"],
+            section["constants"],
+            section["calls"],
+        )
+
+
+class ObjectModule:
+    """Результат компиляции одного модуля: точка входа (если есть) и функции модуля.
+
+    AST небольших функций (`inline_functions`) нужен компилятору программы для встраивания и записывается в
+    объектный файл вместе с секциями.
+    """
+
+    def __init__(self, sections: list[Section], inline_functions: list[FunctionDefinitionExpression] | None = None):
+        self.sections = sections
+        self.inline_functions = inline_functions or []
+
+    def entry(self) -> Section | None:
+        return next((section for section in self.sections if section.name is None), None)
+
+    def exports(self) -> dict[str, Section]:
+        return {section.name: section for section in self.sections if section.name is not None}
+
+    def unresolved(self) -> set[str]:
+        exports = self.exports()
+        return {symbol for section in self.sections for symbol in section.calls if symbol not in exports}
+
+
+def write_object(filename: str, module: ObjectModule, key: str = ""):
+    """Запись объектного модуля в JSON. Файл пишется атомарно (временный файл и переименование), поэтому его
+    может читать другой транслятор. `key` описывает, из чего собран модуль, и проверяется при чтении"""
+    content = {
+        "key": key,
+        "sections": [section.to_dict() for section in module.sections],
+        "inline_functions": [expression_to_dict(function) for function in module.inline_functions],
+    }
+    path = Path(filename)
+    descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+            json.dump(content, file)
+        Path(temporary).replace(path)
+    except BaseException:
+        Path(temporary).unlink(missing_ok=True)
+        raise
+
+
+def read_object(filename: str, key: str = "") -> ObjectModule | None:
+    """Объектный модуль или None, если файла нет или он записан с другим `key`"""
+    try:
+        with open(filename, encoding="utf-8") as file:
+            content = json.load(file)
+    except FileNotFoundError:
+        return None
+    if content.get("key") != key:
+        return None
+    inline_functions = [expression_from_dict(function) for function in content["inline_functions"]]
+    return ObjectModule([Section.from_dict(section) for section in content["sections"]], inline_functions)
+
+
+def _reachable_sections(modules: list[ObjectModule], entry: Section) -> list[Section]:
+    symbols = {}
+    for module in modules:
+        for name, section in module.exports().items():
+            assert name not in symbols, "Duplicate function symbol [{}]".format(name)
+            symbols[name] = section
+    # breadth-first search over function calls, unused functions are not linked
+    reachable = {id(entry)}
+    queue = deque([entry])
+    while queue:
+        for symbol in queue.popleft().calls:
+            assert symbol in symbols, "Unknown function symbol [{}]".format(symbol)
+            section = symbols[symbol]
+            if id(section) not in reachable:
+                reachable.add(id(section))
+                queue.append(section)
+    # keep order of modules and sections
+    return [section for module in modules for section in module.sections if id(section) in reachable]
+
+
+def _layout_data(section: Section, data: list[int], pool: dict[tuple, int]) -> list[int]:
+    """Размещение данных секции в конце `data`, возвращает новые адреса слов секции.
+
+    Неизменяемые слова - литералы и указатели - размещаются один раз для всей программы: одинаковый блок
+    переиспользуется через `pool`.
+    """
+    blocks = dict(section.constants)
+    blocks.update((index, 1) for index in section.pointer_relocations)
+    pointers = set(section.pointer_relocations)
+    addresses = [0] * (len(section.data) + 1)
+    index = 0
+    while index < len(section.data):
+        length = blocks.get(index, 1)
+        words = section.data[index : index + length]
+        if index in pointers:
+            # pointer to a block which is not placed yet (empty buffer) points to the end of data
+            target = words[0]
+            words = [addresses[target] if target < index else len(data) + target - index]
+        if index in blocks:
+            address = pool.setdefault(tuple(words), len(data))
+            if address == len(data):
+                data.extend(words)
+        else:
+            address = len(data)
+            data.extend(words)
+        for offset in range(length):
+            addresses[index + offset] = address + offset
+        index += length
+    addresses[len(section.data)] = len(data)
+    return addresses
+
+
+def _relocate(section: Section, text_bases: dict, data_addresses: list[int], first_index: int) -> list[dict]:
+    text_base = text_bases[section.name]
+    instructions = [dict(instruction) for instruction in section.text]
+    for index in section.text_relocations:
+        address = instructions[index]["address"]
+        instructions[index]["address"] = {**address, "value": address["value"] + text_base}
+    for index in section.data_relocations:
+        address = instructions[index]["address"]
+        instructions[index]["address"] = {**address, "value": data_addresses[address["value"]]}
+    for index, instruction in enumerate(instructions):
+        if "symbol" in instruction:
+            symbol = instruction.pop("symbol")
+            instruction["address"] = {"type": Addressing.CONTROL_FLOW, "value": text_bases[symbol]}
+        instruction["index"] = first_index + index
+    return instructions
+
+
+def link(
+    modules: list[ObjectModule], text_capacity: int, data_capacity: int, optimize: bool = True
+) -> tuple[list[dict], list[int]]:
+    """Объединение объектных модулей в программу, первым размещается модуль с точкой входа.
+
+    Слинкованный код проходит оконную оптимизацию, если `optimize` не выключен.
+    """
+    entries = [module for module in modules if module.entry() is not None]
+    assert len(entries) == 1, "Program must have exactly one entry module"
+    modules = entries + [module for module in modules if module.entry() is None]
+    sections = _reachable_sections(modules, entries[0].entry())
+
+    text_bases = {}
+    text_size = 0
+    for section in sections:
+        text_bases[section.name] = text_size
+        text_size += len(section.text)
+
+    text = []
+    data = []
+    pool = {}
+    for section in sections:
+        text += _relocate(section, text_bases, _layout_data(section, data, pool), len(text))
+    if optimize:
+        text = peephole.optimize(text)
+        logging.info("instructions removed by peephole: %d", text_size - len(text))
+    assert len(text) <= text_capacity, "Limit of instruction memory exceeded"
+    assert len(data) <= data_capacity, "Limit of data memory exceeded"
+    logging.info("data words saved by pooling: %d", sum(len(section.data) for section in sections) - len(data))
+    return text, data
@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+from isa import OPCODE_NUMBERS, Addressing, Opcode
+from machine import (
+    HALF_N,
+    MAX_MEMORY_SIZE,
+    AluInSel,
+    ControlUnit,
+    DataPath,
+    DecodedInstruction,
+    InputPort,
+    N,
+    OutputPort,
+    decode_program,
+    is_valid_byte,
+)
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only lockstep simulation needs it
+    np = None
+
+
+def overflow(values):
+    # vectorized `machine.overflow`
+    return (values + HALF_N) % N - HALF_N
+
+
+class Lockstep:
+    """Одновременное исполнение одной программы на множестве входов (дорожек).
+
+    Регистры - массивы длины `lanes`, память - матрица `lanes x data_memory_size`.
+    На каждом шаге активные дорожки группируются по значению IP, и инструкция каждой
+    группы исполняется сразу для всех дорожек группы. Остановившиеся дорожки
+    исключаются из активных. Вывод, количество инструкций и тактов каждой дорожки
+    совпадают с `machine.simulation()`.
+    """
+
+    def __init__(
+        self,
+        data_memory_size: int,
+        instruction_memory_size: int,
+        data_segment: list[int],
+        program: Sequence[DecodedInstruction],
+        inputs: list[str],
+    ):
+        assert np is not None, "NumPy is required for lockstep simulation"
+        assert data_memory_size <= MAX_MEMORY_SIZE, "Out of memory bounds"
+        assert data_memory_size >= len(data_segment), "Not enough memory to initialize memory"
+        assert instruction_memory_size <= MAX_MEMORY_SIZE, "Out of memory bounds"
+        assert len(program) < instruction_memory_size, "Not enough instruction memory for program"
+        lanes = len(inputs)
+        self._program = program
+        self._data_memory_size = data_memory_size
+        self._instruction_memory_size = instruction_memory_size
+        self._memory = np.zeros((lanes, data_memory_size), dtype=np.int64)
+        self._memory[:, : len(data_segment)] = data_segment
+
+        # register file, int64 because `overflow` wraps at 2**32
+        self._accumulator = np.zeros(lanes, dtype=np.int64)
+        self._frame_pointer = np.zeros(lanes, dtype=np.int64)
+        self._buffer_register = np.zeros(lanes, dtype=np.int64)
+        self._stack_pointer = np.full(lanes, data_memory_size - 1, dtype=np.int64)
+        self._instruction_pointer = np.zeros(lanes, dtype=np.int64)
+        self._data_register = np.zeros(lanes, dtype=np.int64)
+        self._address_register = np.zeros(lanes, dtype=np.int64)
+        self._registers = {AluInSel.REG_SP: self._stack_pointer, AluInSel.REG_FP: self._frame_pointer}
+
+        # input of all lanes is concatenated, lane reads from input_start + input_position
+        lengths = np.array([len(stdin) for stdin in inputs], dtype=np.int64)
+        self._input = np.array([ord(char) for stdin in inputs for char in stdin], dtype=np.int64)
+        self._input_start = np.cumsum(lengths) - lengths
+        self._input_length = lengths
+        self._input_position = np.zeros(lanes, dtype=np.int64)
+        self._outputs = [[] for _ in range(lanes)]
+
+        self._tick = np.zeros(lanes, dtype=np.int64)
+        self._instruction_count = np.zeros(lanes, dtype=np.int64)
+        self._active = np.arange(lanes)
+
+        executors = {
+            Opcode.ADD: self._run_add,
+            Opcode.SUB: self._run_sub,
+            Opcode.AND: self._run_and,
+            Opcode.OR: self._run_or,
+            Opcode.NOT: self._run_not,
+            Opcode.GET: self._run_get,
+            Opcode.PUT: self._run_put,
+            Opcode.PUSH: self._run_push,
+            Opcode.POP: self._run_pop,
+            Opcode.JMP: self._run_jmp,
+            Opcode.JZ: self._run_jz,
+            Opcode.ST: self._run_st,
+            Opcode.LD: self._run_ld,
+            Opcode.IS_ZERO: self._run_is_zero,
+            Opcode.IS_NEG: self._run_is_neg,
+            Opcode.IS_POS: self._run_is_pos,
+            Opcode.NOP: self._run_nop,
+            Opcode.HALT: self._run_halt,
+            Opcode.CALL: self._run_call,
+            Opcode.RET: self._run_ret,
+            Opcode.MUL: self._run_mul,
+            Opcode.DIV: self._run_div,
+            Opcode.MOD: self._run_mod,
+            Opcode.JNZ: self._run_jnz,
+            Opcode.JNEG: self._run_jneg,
+            Opcode.JPOS: self._run_jpos,
+        }
+        self._executors = [executors[opcode] for opcode in OPCODE_NUMBERS]
+
+    def run(self, limit: int):
+        while len(self._active) > 0:
+            self.step(limit)
+
+    def step(self, limit: int):
+        lanes = self._active
+        addresses = self._instruction_pointer[lanes]
+        assert (addresses >= 0).all(), "Invalid instruction address"
+        if (addresses == addresses[0]).all():
+            self._run_group(lanes, int(addresses[0]), limit)
+            return
+        order = np.argsort(addresses, kind="stable")
+        addresses, lanes = addresses[order], lanes[order]
+        starts = np.flatnonzero(np.diff(addresses)) + 1
+        for group, address in zip(np.split(lanes, starts), addresses[np.r_[0, starts]]):
+            self._run_group(group, int(address), limit)
+
+    def results(self) -> list[tuple[str, int, int]]:
+        return [
+            ("".join(map(chr, output)), int(count), int(tick))
+            for output, count, tick in zip(self._outputs, self._instruction_count, self._tick)
+        ]
+
+    def _run_group(self, lanes, address: int, limit: int):
+        instruction = self._program[address]
+        interrupted = self._tick[lanes] + instruction.ticks > limit
+        if interrupted.any():
+            # instruction is interrupted by limit, finish these lanes tick by tick
+            for lane in lanes[interrupted]:
+                self._finish_lane(int(lane), limit)
+            self._deactivate(lanes[interrupted])
+            lanes = lanes[~interrupted]
+        self._instruction_pointer[lanes] = overflow(self._instruction_pointer[lanes] + 1)
+        if instruction.fetch_address:
+            self._run_address_fetch(lanes, instruction)
+        if instruction.fetch_operand:
+            self._data_register[lanes] = self._data_read(lanes)
+        self._tick[lanes] += instruction.ticks
+        self._executors[instruction.number](lanes)
+        if instruction.opcode != Opcode.HALT:
+            self._instruction_count[lanes] += 1
+
+    def _finish_lane(self, lane: int, limit: int):
+        # scalar model continues lane from the beginning of the instruction
+        position = int(self._input_start[lane] + self._input_position[lane])
+        end = int(self._input_start[lane] + self._input_length[lane])
+        output_port = OutputPort()
+        data_path = DataPath(
+            self._data_memory_size,
+            self._memory[lane].tolist(),
+            InputPort(self._input[position:end].tolist()),
+            output_port,
+        )
+        data_path.load_registers(
+            int(self._accumulator[lane]),
+            int(self._frame_pointer[lane]),
+            int(self._buffer_register[lane]),
+            int(self._stack_pointer[lane]),
+            int(self._instruction_pointer[lane]),
+            int(self._data_register[lane]),
+            int(self._address_register[lane]),
+        )
+        control_unit = ControlUnit(self._instruction_memory_size, self._program, data_path, int(self._tick[lane]))
+        try:
+            while control_unit.current_tick() < limit:
+                self._instruction_count[lane] += control_unit.step(limit)
+        except StopIteration:
+            pass
+        self._tick[lane] = control_unit.current_tick()
+        self._outputs[lane].extend(output_port.buffer())
+
+    def _deactivate(self, lanes):
+        self._active = np.setdiff1d(self._active, lanes, assume_unique=True)
+
+    def _data_read(self, lanes):
+        addresses = self._address_register[lanes]
+        assert (addresses >= 0).all(), "Invalid data address"
+        return self._memory[lanes, addresses]
+
+    def _data_write(self, lanes):
+        addresses = self._address_register[lanes]
+        assert (addresses >= 0).all(), "Invalid data address"
+        self._memory[lanes, addresses] = self._data_register[lanes]
+
+    def _run_address_fetch(self, lanes, instruction: DecodedInstruction):
+        value = instruction.operand
+        match instruction.addressing:
+            case Addressing.ABSOLUTE:
+                self._address_register[lanes] = value
+            case Addressing.CONTROL_FLOW | Addressing.IMMEDIATE:
+                self._data_register[lanes] = value
+            case Addressing.RELATIVE:
+                register = self._registers[instruction.register]
+                self._address_register[lanes] = overflow(register[lanes] + value)
+            case Addressing.RELATIVE_INDIRECT:
+                register = self._registers[instruction.register]
+                self._address_register[lanes] = overflow(register[lanes] + value)
+                self._data_register[lanes] = self._data_read(lanes)
+                self._address_register[lanes] = self._data_register[lanes]
+            case _:
+                assert False, "Unknown address type"
+
+    def _run_add(self, lanes):
+        self._accumulator[lanes] = overflow(self._accumulator[lanes] + self._data_register[lanes])
+
+    def _run_sub(self, lanes):
+        self._accumulator[lanes] = overflow(self._accumulator[lanes] + ~self._data_register[lanes] + 1)
+
+    def _run_and(self, lanes):
+        self._accumulator[lanes] = self._accumulator[lanes] & self._data_register[lanes]
+
+    def _run_or(self, lanes):
+        self._accumulator[lanes] = self._accumulator[lanes] | self._data_register[lanes]
+
+    def _run_not(self, lanes):
+        self._accumulator[lanes] = overflow(~self._accumulator[lanes])
+
+    def _run_get(self, lanes):
+        position = self._input_position[lanes]
+        available = position < self._input_length[lanes]
+        index = np.where(available, self._input_start[lanes] + position, 0)
+        values = np.where(available, self._input[index] if len(self._input) else 0, 0)
+        assert all(map(is_valid_byte, values.tolist())), "Out of byte bounds"
+        self._input_position[lanes] = position + available
+        self._data_register[lanes] = values
+        self._accumulator[lanes] = values
+
+    def _run_put(self, lanes):
+        self._data_register[lanes] = self._accumulator[lanes]
+        for lane, byte in zip(lanes.tolist(), self._data_register[lanes].tolist()):
+            assert is_valid_byte(byte), "Out of byte bounds"
+            self._outputs[lane].append(byte)
+
+    def _run_push(self, lanes):
+        self._stack_pointer[lanes] = overflow(self._stack_pointer[lanes] - 1)
+
+    def _run_pop(self, lanes):
+        self._stack_pointer[lanes] = overflow(self._stack_pointer[lanes] + 1)
+
+    def _run_jmp(self, lanes):
+        self._instruction_pointer[lanes] = self._data_register[lanes]
+
+    def _jump_where(self, lanes, taken):
+        self._instruction_pointer[lanes] = np.where(taken, self._data_register[lanes], self._instruction_pointer[lanes])
+
+    def _run_jz(self, lanes):
+        self._jump_where(lanes, self._accumulator[lanes] == 0)
+
+    def _run_jnz(self, lanes):
+        self._jump_where(lanes, self._accumulator[lanes] != 0)
+
+    def _run_jneg(self, lanes):
+        self._jump_where(lanes, self._accumulator[lanes] < 0)
+
+    def _run_jpos(self, lanes):
+        self._jump_where(lanes, self._accumulator[lanes] > 0)
+
+    def _run_st(self, lanes):
+        self._data_register[lanes] = self._accumulator[lanes]
+        self._data_write(lanes)
+
+    def _run_ld(self, lanes):
+        self._accumulator[lanes] = self._data_register[lanes]
+
+    def _run_is_zero(self, lanes):
+        self._accumulator[lanes] = self._accumulator[lanes] == 0
+
+    def _run_is_neg(self, lanes):
+        self._accumulator[lanes] = self._accumulator[lanes] < 0
+
+    def _run_is_pos(self, lanes):
+        self._accumulator[lanes] = self._accumulator[lanes] > 0
+
+    def _run_mul(self, lanes):
+        # int64 product wraps modulo 2**64, which keeps it modulo 2**33
+        self._accumulator[lanes] = overflow(self._accumulator[lanes] * self._data_register[lanes])
+
+    def _divisors(self, lanes):
+        divisors = self._data_register[lanes]
+        assert (divisors != 0).all(), "Division by zero"
+        return divisors
+
+    def _run_div(self, lanes):
+        divisors = self._divisors(lanes)
+        dividends = self._accumulator[lanes]
+        quotients = np.abs(dividends) // np.abs(divisors)
+        self._accumulator[lanes] = overflow(np.where((dividends < 0) == (divisors < 0), quotients, -quotients))
+
+    def _run_mod(self, lanes):
+        divisors = self._divisors(lanes)
+        dividends = self._accumulator[lanes]
+        rests = np.abs(dividends) % np.abs(divisors)
+        self._accumulator[lanes] = np.where(dividends >= 0, rests, -rests)
+
+    def _run_nop(self, lanes):
+        pass
+
+    def _run_halt(self, lanes):
+        self._deactivate(lanes)
+
+    def _run_call(self, lanes):
+        self._buffer_register[lanes] = self._data_register[lanes]
+        self._data_register[lanes] = self._instruction_pointer[lanes]
+        self._address_register[lanes] = self._stack_pointer[lanes]
+        self._data_write(lanes)
+        self._stack_pointer[lanes] = overflow(self._stack_pointer[lanes] - 1)
+        self._data_register[lanes] = self._frame_pointer[lanes]
+        self._address_register[lanes] = self._stack_pointer[lanes]
+        self._data_write(lanes)
+        self._stack_pointer[lanes] = overflow(self._stack_pointer[lanes] - 1)
+        self._frame_pointer[lanes] = self._stack_pointer[lanes]
+        self._instruction_pointer[lanes] = self._buffer_register[lanes]
+
+    def _run_ret(self, lanes):
+        self._stack_pointer[lanes] = overflow(self._stack_pointer[lanes] + 1)
+        self._address_register[lanes] = self._stack_pointer[lanes]
+        self._frame_pointer[lanes] = self._data_read(lanes)
+        self._stack_pointer[lanes] = overflow(self._stack_pointer[lanes] + 1)
+        self._address_register[lanes] = self._stack_pointer[lanes]
+        self._data_register[lanes] = self._data_read(lanes)
+        self._instruction_pointer[lanes] = self._data_register[lanes]
+
+    def __repr__(self):
+        return "LANES: {} ACTIVE: {} TICKS: {}".format(len(self._tick), len(self._active), self._tick.tolist())
+
+
+def lockstep_simulation(
+    data_segment: list[int],
+    text_segment: Sequence[dict] | Sequence[DecodedInstruction],
+    data_memory_size: int,
+    instruction_memory_size: int,
+    inputs: list[str],
+    limit: int,
+) -> list[tuple[str, int, int]]:
+    """Запуск программы на всех входах `inputs`, результат - (вывод, инструкции, такты) для каждого входа"""
+    lockstep = Lockstep(data_memory_size, instruction_memory_size, data_segment, decode_program(text_segment), inputs)
+    lockstep.run(limit)
+    return lockstep.results()
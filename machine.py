@@ -1,25 +1,37 @@
 from __future__ import annotations
 
+import functools
+import json
 import logging
+import mmap
+import os
 import sys
+from array import array
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-
-from isa import Addressing, Opcode, Register
-from translator import read_code
+from typing import TextIO
+
+from isa import (
+    HALF_N,
+    OPCODE_NUMBERS,
+    OPERAND_MAX,
+    OPERAND_MIN,
+    Addressing,
+    N,
+    Opcode,
+    Register,
+    divide,
+    overflow,
+    remainder,
+)
+from translator import BinaryCode, read_code
 
 MAX_MEMORY_SIZE = 2**24
 INT32_MAX = 2**31 - 1
 INT32_MIN = -(2**31)
 INT8_MAX = 2**7 - 1
 INT8_MIN = -(2**7)
-OPERAND_MAX = 2**23 - 1
-OPERAND_MIN = -(2**23)
-HALF_N = 2**32
-N = HALF_N * 2
-
-
-def overflow(value):
-    return (value + HALF_N) % N - HALF_N
 
 
 def is_valid_word(word: int) -> bool:
@@ -44,6 +56,8 @@ def extract_address_value(address: dict):
             return address["value"]
         case Addressing.CONTROL_FLOW:
             return address["value"]
+        case Addressing.IMMEDIATE:
+            return address["value"]
         case _:
             assert False, "Unknown address type"
 
@@ -92,6 +106,16 @@ class AluOpSig(Enum):
     IS_NEG = 3
     IS_POS = 4
     IS_ZERO = 5
+    MUL = 6
+    DIV = 7
+    MOD = 8
+
+
+class JumpCondition(Enum):
+    ZERO = 0
+    NOT_ZERO = 1
+    NEGATIVE = 2
+    POSITIVE = 3
 
 
 class ExecutionCycle(Enum):
@@ -112,19 +136,330 @@ class ExecutionCycle(Enum):
                 return ExecutionCycle.INSTRUCTION_FETCH
 
 
+class Engine(str, Enum):
+    MICROCODE = "microcode"
+    INSTRUCTION = "instruction"
+    JIT = "jit"
+
+
+class ControlWord:
+    """Управляющее слово микрокоманды: сигналы АЛУ, выбор данных и сигналы чтения/записи."""
+
+    __slots__ = (
+        "condition",
+        "data_selector",
+        "halt",
+        "increment",
+        "invert_left",
+        "invert_right",
+        "latch_command",
+        "left",
+        "operation",
+        "out",
+        "read",
+        "register_right",
+        "right",
+        "write",
+    )
+
+    def __init__(
+        self,
+        left: AluInSel | None = None,
+        right: AluInSel = AluInSel.ZERO,
+        out: AluOutSel | None = None,
+        operation: AluOpSig = AluOpSig.ADD,
+        invert_left: bool = False,
+        invert_right: bool = False,
+        increment: bool = False,
+        register_right: bool = False,
+        data_selector: DataSelector | None = None,
+        read: bool = False,
+        write: bool = False,
+        latch_command: bool = False,
+        condition: JumpCondition | None = None,
+        halt: bool = False,
+    ):
+        self.left = left
+        self.right = right
+        self.out = out
+        self.operation = operation
+        self.invert_left = invert_left
+        self.invert_right = invert_right
+        self.increment = increment
+        self.register_right = register_right  # right alu input is the register of instruction address
+        self.data_selector = data_selector
+        self.read = read
+        self.write = write
+        self.latch_command = latch_command
+        self.condition = condition  # signals are sent only if the condition on accumulator holds
+        self.halt = halt
+
+
+def alu_word(left: AluInSel, right: AluInSel, out: AluOutSel, operation: AluOpSig, **flags) -> ControlWord:
+    return ControlWord(left=left, right=right, out=out, operation=operation, **flags)
+
+
+def move_word(src: AluInSel, dst: AluOutSel, **flags) -> ControlWord:
+    return ControlWord(left=src, out=dst, **flags)
+
+
+def read_word(selector: DataSelector) -> ControlWord:
+    return ControlWord(data_selector=selector, read=True)
+
+
+def write_word(selector: DataSelector) -> ControlWord:
+    return ControlWord(data_selector=selector, write=True)
+
+
+INSTRUCTION_FETCH_MICROCODE = (
+    alu_word(AluInSel.REG_IP, AluInSel.ZERO, AluOutSel.REG_IP, AluOpSig.ADD, increment=True, latch_command=True),
+)
+
+ADDRESS_FETCH_MICROCODE = {
+    Addressing.ABSOLUTE: (move_word(AluInSel.INS_OP, AluOutSel.REG_AR),),
+    Addressing.CONTROL_FLOW: (move_word(AluInSel.INS_OP, AluOutSel.REG_DR),),
+    # operand is taken from the instruction, operand fetch is skipped
+    Addressing.IMMEDIATE: (move_word(AluInSel.INS_OP, AluOutSel.REG_DR),),
+    Addressing.RELATIVE: (
+        alu_word(AluInSel.INS_OP, AluInSel.ZERO, AluOutSel.REG_AR, AluOpSig.ADD, register_right=True),
+    ),
+    Addressing.RELATIVE_INDIRECT: (
+        alu_word(AluInSel.INS_OP, AluInSel.ZERO, AluOutSel.REG_AR, AluOpSig.ADD, register_right=True),
+        read_word(DataSelector.DATA_MEMORY),
+        move_word(AluInSel.REG_DR, AluOutSel.REG_AR),
+    ),
+}
+
+OPERAND_FETCH_MICROCODE = (read_word(DataSelector.DATA_MEMORY),)
+
+EXECUTION_MICROCODE = {
+    Opcode.ADD: (alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.ADD),),
+    Opcode.SUB: (
+        alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.ADD, increment=True, invert_right=True),
+    ),
+    Opcode.AND: (alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.AND),),
+    Opcode.OR: (alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.OR),),
+    Opcode.NOT: (alu_word(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.ADD, invert_left=True),),
+    Opcode.LD: (move_word(AluInSel.REG_DR, AluOutSel.REG_AC),),
+    Opcode.ST: (
+        move_word(AluInSel.REG_AC, AluOutSel.REG_DR),
+        write_word(DataSelector.DATA_MEMORY),
+    ),
+    Opcode.PUT: (
+        move_word(AluInSel.REG_AC, AluOutSel.REG_DR),
+        write_word(DataSelector.IO_PORT),
+    ),
+    Opcode.GET: (
+        read_word(DataSelector.IO_PORT),
+        move_word(AluInSel.REG_DR, AluOutSel.REG_AC),
+    ),
+    Opcode.PUSH: (alu_word(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, invert_right=True),),
+    Opcode.POP: (alu_word(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, increment=True),),
+    Opcode.JMP: (move_word(AluInSel.REG_DR, AluOutSel.REG_IP),),
+    Opcode.JZ: (move_word(AluInSel.REG_DR, AluOutSel.REG_IP, condition=JumpCondition.ZERO),),
+    Opcode.CALL: (
+        move_word(AluInSel.REG_DR, AluOutSel.REG_BR),
+        move_word(AluInSel.REG_IP, AluOutSel.REG_DR),
+        move_word(AluInSel.REG_SP, AluOutSel.REG_AR),
+        write_word(DataSelector.DATA_MEMORY),
+        alu_word(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, invert_right=True),
+        move_word(AluInSel.REG_FP, AluOutSel.REG_DR),
+        move_word(AluInSel.REG_SP, AluOutSel.REG_AR),
+        write_word(DataSelector.DATA_MEMORY),
+        alu_word(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, invert_right=True),
+        move_word(AluInSel.REG_SP, AluOutSel.REG_FP),
+        move_word(AluInSel.REG_BR, AluOutSel.REG_IP),
+    ),
+    Opcode.RET: (
+        alu_word(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, increment=True),
+        move_word(AluInSel.REG_SP, AluOutSel.REG_AR),
+        read_word(DataSelector.DATA_MEMORY),
+        move_word(AluInSel.REG_DR, AluOutSel.REG_FP),
+        alu_word(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, increment=True),
+        move_word(AluInSel.REG_SP, AluOutSel.REG_AR),
+        read_word(DataSelector.DATA_MEMORY),
+        move_word(AluInSel.REG_DR, AluOutSel.REG_IP),
+    ),
+    Opcode.IS_POS: (alu_word(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.IS_POS),),
+    Opcode.IS_NEG: (alu_word(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.IS_NEG),),
+    Opcode.IS_ZERO: (alu_word(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.IS_ZERO),),
+    Opcode.NOP: (ControlWord(),),
+    Opcode.HALT: (ControlWord(halt=True),),
+    Opcode.MUL: (alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.MUL),),
+    Opcode.DIV: (alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.DIV),),
+    Opcode.MOD: (alu_word(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.MOD),),
+    Opcode.JNZ: (move_word(AluInSel.REG_DR, AluOutSel.REG_IP, condition=JumpCondition.NOT_ZERO),),
+    Opcode.JNEG: (move_word(AluInSel.REG_DR, AluOutSel.REG_IP, condition=JumpCondition.NEGATIVE),),
+    Opcode.JPOS: (move_word(AluInSel.REG_DR, AluOutSel.REG_IP, condition=JumpCondition.POSITIVE),),
+}
+assert set(EXECUTION_MICROCODE) == set(Opcode), "Microcode is not defined for all opcodes"
+
+
+def microcode_ticks(microcode: tuple[ControlWord, ...]) -> int:
+    # halt stops the machine before its tick is counted
+    return sum(1 for word in microcode if not word.halt)
+
+
+# ticks of address fetch cycle per addressing mode
+ADDRESS_FETCH_TICKS = {addressing: len(microcode) for addressing, microcode in ADDRESS_FETCH_MICROCODE.items()}
+
+# ticks of execution cycle per opcode
+EXECUTION_TICKS = {opcode: microcode_ticks(microcode) for opcode, microcode in EXECUTION_MICROCODE.items()}
+
+
+def instruction_ticks(opcode: Opcode, addressing: Addressing | None) -> int:
+    ticks = 1 + EXECUTION_TICKS[opcode]  # instruction fetch + execution
+    if opcode.is_address():
+        ticks += ADDRESS_FETCH_TICKS[addressing]
+    if opcode.is_operand() and addressing != Addressing.IMMEDIATE:
+        ticks += 1
+    return ticks
+
+
+class DecodedInstruction:
+    """Инструкция, декодированная при загрузке программы.
+
+    Хранит номер кода операции, тип адресации, селектор регистра и операнд, а также
+    заранее вычисленные признаки циклов выборки адреса и операнда.
+    """
+
+    __slots__ = (
+        "addressing",
+        "fetch_address",
+        "fetch_operand",
+        "microcode",
+        "number",
+        "opcode",
+        "operand",
+        "register",
+        "source",
+        "ticks",
+    )
+
+    def __init__(self, instruction: dict):
+        self.opcode = Opcode(instruction["opcode"])
+        self.number = OPCODE_NUMBERS[self.opcode]
+        self.addressing = None
+        self.register = None
+        self.operand = 0
+        self.fetch_address = self.opcode.is_address()
+        self.fetch_operand = self.opcode.is_operand()
+        if self.fetch_address:
+            address = instruction["address"]
+            self.addressing = Addressing(address["type"])
+            if "register" in address:
+                self.register = register_selector(Register(address["register"]))
+            self.operand = extract_address_value(address)
+            assert is_valid_address_word(self.operand), "Value out of bounds"
+            if self.addressing == Addressing.IMMEDIATE:
+                assert self.fetch_operand, "Immediate operand for {}".format(self.opcode.name)
+                self.fetch_operand = False
+        self.ticks = instruction_ticks(self.opcode, self.addressing)
+        self.microcode = EXECUTION_MICROCODE[self.opcode]
+        self.source = instruction
+
+    def __repr__(self):
+        return repr(self.source)
+
+
+class LazyProgram(Sequence):
+    """Программа в бинарном формате, инструкция декодируется при первом обращении к ней"""
+
+    def __init__(self, code: BinaryCode):
+        self._code = code
+        self._decoded = [None] * len(code)
+
+    def __len__(self) -> int:
+        return len(self._decoded)
+
+    def __getitem__(self, address: int) -> DecodedInstruction:
+        instruction = self._decoded[address]
+        if instruction is None:
+            instruction = self._decoded[address] = DecodedInstruction(self._code[address])
+        return instruction
+
+
+def decode_program(program: Sequence[dict] | Sequence[DecodedInstruction]) -> Sequence[DecodedInstruction]:
+    if isinstance(program, BinaryCode):
+        return LazyProgram(program)
+    if isinstance(program, LazyProgram):
+        return program
+    # already decoded records are reused as is, they are never modified
+    return [
+        instruction if isinstance(instruction, DecodedInstruction) else DecodedInstruction(instruction)
+        for instruction in program
+    ]
+
+
+OUTPUT_BUFFER_SIZE = 4096
+INPUT_CHUNK_SIZE = 4096
+
+
+class InputPort:
+    """Порт ввода: лениво читает символы из итерируемого источника, `0` - конец ввода."""
+
+    def __init__(self, tokens: Iterable[int]):
+        self._tokens = iter(tokens)
+
+    def read(self) -> int:
+        return next(self._tokens, 0)  # EOF
+
+
+class OutputPort:
+    """Порт вывода: накапливает не более `buffer_size` символов и сбрасывает их в `sink`.
+
+    Без `sink` весь вывод остается в буфере порта.
+    """
+
+    def __init__(self, sink: TextIO | None = None, buffer_size: int = OUTPUT_BUFFER_SIZE):
+        self._sink = sink
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self.written = 0
+
+    def write(self, byte: int):
+        self._buffer.append(byte)
+        self.written += 1
+        if self._sink is not None and len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._sink is not None:
+            self._sink.write("".join(map(chr, self._buffer)))
+            self._sink.flush()
+            self._buffer.clear()
+
+    def buffer(self) -> list[int]:
+        return self._buffer
+
+
+def stream_input(file: TextIO, chunk_size: int = INPUT_CHUNK_SIZE) -> Iterator[int]:
+    for chunk in iter(functools.partial(file.read, chunk_size), ""):
+        yield from map(ord, chunk)
+
+
+# memory word is int64: `overflow` wraps at 2**32, so words don't fit into int32
+MEMORY_WORD = "q"
+
+
+def allocate_memory(size: int, data_segment: list[int]) -> memoryview:
+    # anonymous mapping is zero-filled by the OS lazily, page by page on first access
+    memory = memoryview(mmap.mmap(-1, size * array(MEMORY_WORD).itemsize)).cast(MEMORY_WORD)
+    # copy data to memory
+    memory[: len(data_segment)] = array(MEMORY_WORD, data_segment)
+    return memory
+
+
 class DataPath:
-    def __init__(self, data_memory_size: int, data_segment: list[int], input_buffer: list[int]):
+    def __init__(self, data_memory_size: int, data_segment: list[int], input_port: InputPort, output_port: OutputPort):
         assert data_memory_size <= MAX_MEMORY_SIZE, "Out of memory bounds"
         assert data_memory_size >= len(
             data_segment
         ), "Not enough memory to initialize memory, have: {}, need: {}".format(data_memory_size, len(data_segment))
         self._memory_size = data_memory_size
-        self._memory = [0] * data_memory_size
-        # copy data to memory
-        for i, word in enumerate(data_segment):
-            self._memory[i] = word
-        self._input_buffer = input_buffer
-        self._output_buffer = []
+        self._memory = allocate_memory(data_memory_size, data_segment)
+        self._input_port = input_port
+        self._output_port = output_port
 
         # register file
         self._accumulator = 0
@@ -143,17 +478,45 @@ class DataPath:
 
         self._instruction_operand = 0
 
+        # instruction-level transfers, see `execute_instruction`
+        executors = {
+            Opcode.ADD: self._run_add,
+            Opcode.SUB: self._run_sub,
+            Opcode.AND: self._run_and,
+            Opcode.OR: self._run_or,
+            Opcode.NOT: self._run_not,
+            Opcode.GET: self._run_get,
+            Opcode.PUT: self._run_put,
+            Opcode.PUSH: self._run_push,
+            Opcode.POP: self._run_pop,
+            Opcode.JMP: self._run_jmp,
+            Opcode.JZ: self._run_jz,
+            Opcode.ST: self._run_st,
+            Opcode.LD: self._run_ld,
+            Opcode.IS_ZERO: self._run_is_zero,
+            Opcode.IS_NEG: self._run_is_neg,
+            Opcode.IS_POS: self._run_is_pos,
+            Opcode.NOP: self._run_nop,
+            Opcode.HALT: self._run_nop,
+            Opcode.CALL: self._run_call,
+            Opcode.RET: self._run_ret,
+            Opcode.MUL: self._run_mul,
+            Opcode.DIV: self._run_div,
+            Opcode.MOD: self._run_mod,
+            Opcode.JNZ: self._run_jnz,
+            Opcode.JNEG: self._run_jneg,
+            Opcode.JPOS: self._run_jpos,
+        }
+        self._executors = [executors[opcode] for opcode in OPCODE_NUMBERS]
+
     def _port_read(self):
-        if len(self._input_buffer) == 0:
-            self._data_register = 0  # EOF
-        else:
-            byte = self._input_buffer.pop(0)
-            assert is_valid_byte(byte), "Out of byte bounds"
-            self._data_register = byte
+        byte = self._input_port.read()
+        assert is_valid_byte(byte), "Out of byte bounds"
+        self._data_register = byte
 
     def _port_write(self):
         assert is_valid_byte(self._data_register), "Out of byte bounds"
-        self._output_buffer.append(self._data_register)
+        self._output_port.write(self._data_register)
 
     def _data_read(self):
         assert self._address_register >= 0, "Invalid data address"
@@ -212,14 +575,24 @@ class DataPath:
             case _:
                 assert False, "Unknown alu output"
 
-    def zero(self) -> bool:
-        return self._accumulator == 0
+    def condition(self, condition: JumpCondition) -> bool:
+        match condition:
+            case JumpCondition.ZERO:
+                return self._accumulator == 0
+            case JumpCondition.NOT_ZERO:
+                return self._accumulator != 0
+            case JumpCondition.NEGATIVE:
+                return self._accumulator < 0
+            case JumpCondition.POSITIVE:
+                return self._accumulator > 0
+            case _:
+                assert False, "Unknown jump condition"
 
     def instruction_address(self) -> int:
         return self._instruction_pointer
 
     def get_output_buffer(self) -> list[int]:
-        return self._output_buffer
+        return self._output_port.buffer()
 
     def write_signal(self):
         if self._data_selector == DataSelector.DATA_MEMORY:
@@ -280,6 +653,14 @@ class DataPath:
                 value = int(left_operand == 0)
             case AluOpSig.IS_POS:
                 value = int(left_operand > 0)
+            case AluOpSig.MUL:
+                value = left_operand * right_operand
+            case AluOpSig.DIV:
+                assert right_operand != 0, "Division by zero"
+                value = divide(left_operand, right_operand)
+            case AluOpSig.MOD:
+                assert right_operand != 0, "Division by zero"
+                value = remainder(left_operand, right_operand)
             case _:
                 assert False, "Unknown signal"
         if increment:
@@ -287,6 +668,165 @@ class DataPath:
         self._alu_out(value)
         self._clear_alu()
 
+    def registers(self) -> tuple[int, int, int, int, int, int, int]:
+        """Состояние регистров: AC, FP, BR, SP, IP, DR, AR"""
+        return (
+            self._accumulator,
+            self._frame_pointer,
+            self._buffer_register,
+            self._stack_pointer,
+            self._instruction_pointer,
+            self._data_register,
+            self._address_register,
+        )
+
+    def load_registers(
+        self,
+        accumulator: int,
+        frame_pointer: int,
+        buffer_register: int,
+        stack_pointer: int,
+        instruction_pointer: int,
+        data_register: int,
+        address_register: int,
+    ):
+        self._accumulator = accumulator
+        self._frame_pointer = frame_pointer
+        self._buffer_register = buffer_register
+        self._stack_pointer = stack_pointer
+        self._instruction_pointer = instruction_pointer
+        self._data_register = data_register
+        self._address_register = address_register
+
+    def memory(self) -> memoryview:
+        return self._memory
+
+    def execute_instruction(self, instruction: DecodedInstruction):
+        """Все пересылки инструкции за один шаг: выборка адреса и операнда, исполнение"""
+        self._instruction_pointer = overflow(self._instruction_pointer + 1)
+        if instruction.fetch_address:
+            self._run_address_fetch(instruction)
+        if instruction.fetch_operand:
+            self._data_read()
+        self._executors[instruction.number]()
+
+    def _run_address_fetch(self, instruction: DecodedInstruction):
+        value = instruction.operand
+        match instruction.addressing:
+            case Addressing.ABSOLUTE:
+                self._address_register = overflow(value)
+            case Addressing.CONTROL_FLOW | Addressing.IMMEDIATE:
+                self._data_register = overflow(value)
+            case Addressing.RELATIVE:
+                self._address_register = overflow(value + self._alu_operand(instruction.register))
+            case Addressing.RELATIVE_INDIRECT:
+                self._address_register = overflow(value + self._alu_operand(instruction.register))
+                self._data_read()
+                self._address_register = overflow(self._data_register)
+            case _:
+                assert False, "Unknown address type"
+
+    def _run_add(self):
+        self._accumulator = overflow(self._accumulator + self._data_register)
+
+    def _run_sub(self):
+        self._accumulator = overflow(self._accumulator + ~self._data_register + 1)
+
+    def _run_and(self):
+        self._accumulator = overflow(self._accumulator & self._data_register)
+
+    def _run_or(self):
+        self._accumulator = overflow(self._accumulator | self._data_register)
+
+    def _run_not(self):
+        self._accumulator = overflow(~self._accumulator)
+
+    def _run_get(self):
+        self._port_read()
+        self._accumulator = overflow(self._data_register)
+
+    def _run_put(self):
+        self._data_register = overflow(self._accumulator)
+        self._port_write()
+
+    def _run_push(self):
+        self._stack_pointer = overflow(self._stack_pointer - 1)
+
+    def _run_pop(self):
+        self._stack_pointer = overflow(self._stack_pointer + 1)
+
+    def _run_jmp(self):
+        self._instruction_pointer = overflow(self._data_register)
+
+    def _run_jz(self):
+        if self._accumulator == 0:
+            self._instruction_pointer = overflow(self._data_register)
+
+    def _run_jnz(self):
+        if self._accumulator != 0:
+            self._instruction_pointer = overflow(self._data_register)
+
+    def _run_jneg(self):
+        if self._accumulator < 0:
+            self._instruction_pointer = overflow(self._data_register)
+
+    def _run_jpos(self):
+        if self._accumulator > 0:
+            self._instruction_pointer = overflow(self._data_register)
+
+    def _run_st(self):
+        self._data_register = overflow(self._accumulator)
+        self._data_write()
+
+    def _run_ld(self):
+        self._accumulator = overflow(self._data_register)
+
+    def _run_is_zero(self):
+        self._accumulator = int(self._accumulator == 0)
+
+    def _run_is_neg(self):
+        self._accumulator = int(self._accumulator < 0)
+
+    def _run_is_pos(self):
+        self._accumulator = int(self._accumulator > 0)
+
+    def _run_mul(self):
+        self._accumulator = overflow(self._accumulator * self._data_register)
+
+    def _run_div(self):
+        assert self._data_register != 0, "Division by zero"
+        self._accumulator = divide(self._accumulator, self._data_register)
+
+    def _run_mod(self):
+        assert self._data_register != 0, "Division by zero"
+        self._accumulator = remainder(self._accumulator, self._data_register)
+
+    def _run_nop(self):
+        pass
+
+    def _run_call(self):
+        self._buffer_register = overflow(self._data_register)
+        self._data_register = self._instruction_pointer
+        self._address_register = self._stack_pointer
+        self._data_write()
+        self._stack_pointer = overflow(self._stack_pointer - 1)
+        self._data_register = self._frame_pointer
+        self._address_register = self._stack_pointer
+        self._data_write()
+        self._stack_pointer = overflow(self._stack_pointer - 1)
+        self._frame_pointer = self._stack_pointer
+        self._instruction_pointer = self._buffer_register
+
+    def _run_ret(self):
+        self._stack_pointer = overflow(self._stack_pointer + 1)
+        self._address_register = self._stack_pointer
+        self._data_read()
+        self._frame_pointer = overflow(self._data_register)
+        self._stack_pointer = overflow(self._stack_pointer + 1)
+        self._address_register = self._stack_pointer
+        self._data_read()
+        self._instruction_pointer = overflow(self._data_register)
+
     def __repr__(self):
         return "REGISTERS: [AC:{} FP:{} BR:{} SP:{} IP:{} DR:{} AR:{}]".format(
             self._accumulator,
@@ -300,54 +840,68 @@ class DataPath:
 
 
 class ControlUnit:
-    def __init__(self, instruction_memory_size: int, program: list[dict], data_path: DataPath):
+    def __init__(
+        self,
+        instruction_memory_size: int,
+        program: Sequence[DecodedInstruction],
+        data_path: DataPath,
+        tick: int = 0,
+    ):
         assert instruction_memory_size <= MAX_MEMORY_SIZE, "Out of memory bounds"
         assert len(program) < instruction_memory_size, "Not enough instruction memory for program"
         self._instruction_memory = program
         self._data_path = data_path
-        self._tick = 0
+        # a model continued from another one starts at its tick
+        self._tick = tick
         self._command_register = None
         self._execution_cycle = ExecutionCycle.INSTRUCTION_FETCH
+        self._microcode = INSTRUCTION_FETCH_MICROCODE
         self._cycle_tick = 0
 
     def tick(self) -> bool:
-        match self._execution_cycle:
-            case ExecutionCycle.INSTRUCTION_FETCH:
-                self._cycle_tick = self._instruction_fetch(self._cycle_tick)
-            case ExecutionCycle.ADDRESS_FETCH:
-                self._cycle_tick = self._address_fetch(self._cycle_tick)
-            case ExecutionCycle.OPERAND_FETCH:
-                self._cycle_tick = self._operand_fetch(self._cycle_tick)
-            case ExecutionCycle.EXECUTION:
-                self._cycle_tick = self._execute(self._cycle_tick)
+        self._signal(self._microcode[self._cycle_tick])
         self._tick += 1
-        if self._cycle_tick == -1:
+        self._cycle_tick += 1
+        if self._cycle_tick == len(self._microcode):
             self._next_cycle()
-        if self._execution_cycle == ExecutionCycle.INSTRUCTION_FETCH:
-            return True  # begin of new cycle
+            if self._execution_cycle == ExecutionCycle.INSTRUCTION_FETCH:
+                return True  # begin of new cycle
         return False
 
+    def step(self, limit: int) -> int:
+        # one model step is one tick, returns number of completed instructions
+        return int(self.tick())
+
     def current_tick(self):
         return self._tick
 
     def _next_cycle(self):
         self._cycle_tick = 0
         self._execution_cycle = self._execution_cycle.next_cycle()
-        opcode = self._current_instruction()["opcode"]
+        instruction = self._current_instruction()
         # skip address fetch
-        if self._execution_cycle == ExecutionCycle.ADDRESS_FETCH and not opcode.is_address():
+        if self._execution_cycle == ExecutionCycle.ADDRESS_FETCH and not instruction.fetch_address:
             self._execution_cycle = self._execution_cycle.next_cycle()
         # skip operand fetch
-        if self._execution_cycle == ExecutionCycle.OPERAND_FETCH and not opcode.is_operand():
+        if self._execution_cycle == ExecutionCycle.OPERAND_FETCH and not instruction.fetch_operand:
             self._execution_cycle = self._execution_cycle.next_cycle()
+        match self._execution_cycle:
+            case ExecutionCycle.INSTRUCTION_FETCH:
+                self._microcode = INSTRUCTION_FETCH_MICROCODE
+            case ExecutionCycle.ADDRESS_FETCH:
+                self._microcode = ADDRESS_FETCH_MICROCODE[instruction.addressing]
+            case ExecutionCycle.OPERAND_FETCH:
+                self._microcode = OPERAND_FETCH_MICROCODE
+            case ExecutionCycle.EXECUTION:
+                self._microcode = instruction.microcode
 
     def _instruction_address(self) -> int:
         return self._data_path.instruction_address()
 
-    def _accumulator_zero(self) -> bool:
-        return self._data_path.zero()
+    def _condition_holds(self, condition: JumpCondition) -> bool:
+        return self._data_path.condition(condition)
 
-    def _current_instruction(self) -> dict:
+    def _current_instruction(self) -> DecodedInstruction:
         return self._command_register
 
     def _latch_command_register(self):
@@ -355,345 +909,285 @@ class ControlUnit:
         self._command_register = self._instruction_memory[self._instruction_address()]
 
     def _set_instruction_value(self):
-        assert self._current_instruction()["opcode"].is_address()
-        address = self._current_instruction()["address"]
-        self._data_path.set_instruction_address_word(extract_address_value(address))
+        assert self._current_instruction().fetch_address
+        self._data_path.set_instruction_address_word(self._current_instruction().operand)
+
+    def _signal(self, word: ControlWord):
+        if word.halt:
+            raise StopIteration()
+        if word.latch_command:
+            self._latch_command_register()
+        if word.condition is not None and not self._condition_holds(word.condition):
+            return
+        if word.data_selector is not None:
+            self._data_signal(word)
+        if word.left is not None:
+            self._alu_signal(word)
+
+    def _data_signal(self, word: ControlWord):
+        self._data_path.set_data_sel(word.data_selector)
+        if word.read:
+            self._data_path.read_signal()
+        if word.write:
+            self._data_path.write_signal()
+
+    def _alu_signal(self, word: ControlWord):
+        if word.left == AluInSel.INS_OP:
+            self._set_instruction_value()
+        right = self._current_instruction().register if word.register_right else word.right
+        self._data_path.set_left_alu_in_sel(word.left)
+        self._data_path.set_right_alu_in_sel(right)
+        self._data_path.set_alu_out_sel(word.out)
+        self._data_path.alu_signal(
+            word.operation,
+            invert_left=word.invert_left,
+            invert_right=word.invert_right,
+            increment=word.increment,
+        )
 
-    def _alu_call(
-        self,
-        left_sel: AluInSel,
-        right_sel: AluInSel,
-        out_sel: AluOutSel,
-        operation: AluOpSig,
-        increment: bool = False,
-        invert_left: bool = False,
-        invert_right: bool = False,
-    ):
-        self._data_path.set_left_alu_in_sel(left_sel)
-        self._data_path.set_right_alu_in_sel(right_sel)
-        self._data_path.set_alu_out_sel(out_sel)
-        self._data_path.alu_signal(operation, increment=increment, invert_left=invert_left, invert_right=invert_right)
-
-    def _alu_move(self, src: AluInSel, dst: AluOutSel):
-        self._alu_call(src, AluInSel.ZERO, dst, AluOpSig.ADD)
-
-    def _instruction_fetch(self, tick: int) -> int:
-        match tick:
-            case 0:
-                assert self._instruction_address() >= 0, "Invalid instruction address"
-                self._latch_command_register()
-                self._data_path.set_left_alu_in_sel(AluInSel.REG_IP)
-                self._data_path.set_right_alu_in_sel(AluInSel.ZERO)
-                self._data_path.set_alu_out_sel(AluOutSel.REG_IP)
-                self._data_path.alu_signal(AluOpSig.ADD, increment=True)
-                return -1
-            case _:
-                assert False, "Unexpected tick {}".format(tick)
+    def __repr__(self):
+        return "TICK: {:3} CR: {} DATA PATH: {}".format(self._tick, self._current_instruction(), self._data_path)
 
-    def _address_fetch(self, tick: int) -> int:
-        self._set_instruction_value()
-        address = self._current_instruction()["address"]
-        operand_type = address["type"]
-        match operand_type:
-            case Addressing.ABSOLUTE:
-                match tick:
-                    case 0:
-                        self._alu_move(AluInSel.INS_OP, AluOutSel.REG_AR)
-                        return -1
-            case Addressing.CONTROL_FLOW:
-                match tick:
-                    case 0:
-                        self._alu_move(AluInSel.INS_OP, AluOutSel.REG_DR)
-                        return -1
-            case Addressing.RELATIVE:
-                match tick:
-                    case 0:
-                        register = address["register"]
-                        selector = register_selector(register)
-                        self._alu_call(AluInSel.INS_OP, selector, AluOutSel.REG_AR, AluOpSig.ADD)
-                        return -1
-            case Addressing.RELATIVE_INDIRECT:
-                match tick:
-                    case 0:
-                        register = address["register"]
-                        selector = register_selector(register)
-                        self._alu_call(AluInSel.INS_OP, selector, AluOutSel.REG_AR, AluOpSig.ADD)
-                        return tick + 1
-                    case 1:
-                        self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                        self._data_path.read_signal()
-                        return tick + 1
-                    case 2:
-                        self._alu_move(AluInSel.REG_DR, AluOutSel.REG_AR)
-                        return -1
-        assert False, "Unexpected tick or address type {} {}".format(tick, address)
-
-    def _operand_fetch(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                self._data_path.read_signal()
-                return -1
-        assert False, "Unexpected tick {}".format(tick)
-
-    def _execute(self, tick: int) -> int:
-        mapping = {
-            Opcode.ADD: self._execute_add,
-            Opcode.SUB: self._execute_sub,
-            Opcode.AND: self._execute_and,
-            Opcode.OR: self._execute_or,
-            Opcode.NOT: self._execute_not,
-            Opcode.GET: self._execute_get,
-            Opcode.PUT: self._execute_put,
-            Opcode.PUSH: self._execute_push,
-            Opcode.POP: self._execute_pop,
-            Opcode.JMP: self._execute_jmp,
-            Opcode.JZ: self._execute_jz,
-            Opcode.ST: self._execute_st,
-            Opcode.LD: self._execute_ld,
-            Opcode.IS_ZERO: self._execute_is_zero,
-            Opcode.IS_NEG: self._execute_is_neg,
-            Opcode.IS_POS: self._execute_is_pos,
-            Opcode.NOP: self._execute_nop,
-            Opcode.HALT: self._execute_halt,
-            Opcode.CALL: self._execute_call,
-            Opcode.RET: self._execute_ret,
-        }
-        opcode = self._current_instruction()["opcode"]
-        executor = mapping.get(opcode)
-        assert executor is not None, "Unknown opcode: {}".format(opcode)
-        return executor(tick)
-
-    def _execute_jmp(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_move(AluInSel.REG_DR, AluOutSel.REG_IP)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_jz(self, tick: int) -> int:
-        match tick:
-            case 0:
-                if self._accumulator_zero():
-                    self._alu_move(AluInSel.REG_DR, AluOutSel.REG_IP)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_add(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.ADD)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_sub(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(
-                    AluInSel.REG_AC,
-                    AluInSel.REG_DR,
-                    AluOutSel.REG_AC,
-                    AluOpSig.ADD,
-                    increment=True,
-                    invert_right=True,
+
+class InstructionControlUnit(ControlUnit):
+    """Исполняет инструкцию целиком за один шаг модели (`DataPath.execute_instruction`).
+
+    Состояние регистров после каждой инструкции совпадает с микрокодовой моделью,
+    а такты добавляются по таблицам `ADDRESS_FETCH_TICKS` и `EXECUTION_TICKS`.
+    """
+
+    def step(self, limit: int) -> int:
+        assert self._instruction_address() >= 0, "Invalid instruction address"
+        instruction = self._instruction_memory[self._instruction_address()]
+        if self._tick + instruction.ticks > limit:
+            # instruction is interrupted by limit, finish tick by tick
+            while self._tick < limit:
+                if self.tick():
+                    return 1
+            return 0
+        self._command_register = instruction
+        self._tick += instruction.ticks
+        self._data_path.execute_instruction(instruction)
+        if instruction.opcode == Opcode.HALT:
+            raise StopIteration()
+        return 1
+
+
+JIT_HOT_THRESHOLD = 50
+
+# instructions which are never compiled: input/output and halt are left to the interpreter
+JIT_INTERPRETED = {Opcode.GET, Opcode.PUT, Opcode.HALT}
+
+# instructions which end a basic block
+JIT_BLOCK_END = {Opcode.JMP, Opcode.JZ, Opcode.JNZ, Opcode.JNEG, Opcode.JPOS, Opcode.CALL, Opcode.RET}
+
+
+def _ovf(expression: str) -> str:
+    # inlined `overflow` for generated code
+    return "(({}) + {}) % {} - {}".format(expression, HALF_N, N, HALF_N)
+
+
+JIT_REGISTERS = {AluInSel.REG_SP: "sp", AluInSel.REG_FP: "fp"}
+
+JIT_ADDRESS_FETCH = {
+    Addressing.ABSOLUTE: ["ar = {value}"],
+    Addressing.CONTROL_FLOW: ["dr = {value}"],
+    Addressing.IMMEDIATE: ["dr = {value}"],
+    Addressing.RELATIVE: ["ar = " + _ovf("{register} + {operand}")],
+    Addressing.RELATIVE_INDIRECT: [
+        "ar = " + _ovf("{register} + {operand}"),
+        'assert ar >= 0, "Invalid data address"',
+        "dr = mem[ar]",
+        "ar = " + _ovf("dr"),
+    ],
+}
+
+JIT_OPERAND_FETCH = ['assert ar >= 0, "Invalid data address"', "dr = mem[ar]"]
+
+JIT_EXECUTION = {
+    Opcode.ADD: ["ac = " + _ovf("ac + dr")],
+    Opcode.SUB: ["ac = " + _ovf("ac - dr")],
+    Opcode.AND: ["ac = " + _ovf("ac & dr")],
+    Opcode.OR: ["ac = " + _ovf("ac | dr")],
+    Opcode.NOT: ["ac = " + _ovf("~ac")],
+    Opcode.LD: ["ac = " + _ovf("dr")],
+    Opcode.ST: ["dr = ac", 'assert ar >= 0, "Invalid data address"', "mem[ar] = dr"],
+    Opcode.PUSH: ["sp = " + _ovf("sp - 1")],
+    Opcode.POP: ["sp = " + _ovf("sp + 1")],
+    Opcode.JMP: ["ip = " + _ovf("dr")],
+    Opcode.JZ: ["if ac == 0:", "    ip = " + _ovf("dr")],
+    Opcode.JNZ: ["if ac != 0:", "    ip = " + _ovf("dr")],
+    Opcode.JNEG: ["if ac < 0:", "    ip = " + _ovf("dr")],
+    Opcode.JPOS: ["if ac > 0:", "    ip = " + _ovf("dr")],
+    Opcode.IS_ZERO: ["ac = int(ac == 0)"],
+    Opcode.IS_NEG: ["ac = int(ac < 0)"],
+    Opcode.IS_POS: ["ac = int(ac > 0)"],
+    Opcode.MUL: ["ac = " + _ovf("ac * dr")],
+    Opcode.DIV: ['assert dr != 0, "Division by zero"', "ac = divide(ac, dr)"],
+    Opcode.MOD: ['assert dr != 0, "Division by zero"', "ac = remainder(ac, dr)"],
+    Opcode.NOP: [],
+    Opcode.CALL: [
+        "br = " + _ovf("dr"),
+        "dr = {next}",
+        "ar = sp",
+        'assert ar >= 0, "Invalid data address"',
+        "mem[ar] = dr",
+        "sp = " + _ovf("sp - 1"),
+        "dr = fp",
+        "ar = sp",
+        'assert ar >= 0, "Invalid data address"',
+        "mem[ar] = dr",
+        "sp = " + _ovf("sp - 1"),
+        "fp = sp",
+        "ip = br",
+    ],
+    Opcode.RET: [
+        "sp = " + _ovf("sp + 1"),
+        "ar = sp",
+        'assert ar >= 0, "Invalid data address"',
+        "dr = mem[ar]",
+        "fp = " + _ovf("dr"),
+        "sp = " + _ovf("sp + 1"),
+        "ar = sp",
+        'assert ar >= 0, "Invalid data address"',
+        "dr = mem[ar]",
+        "ip = " + _ovf("dr"),
+    ],
+}
+
+# local names of the registers in the order of `DataPath.registers`
+JIT_DATA_PATH_REGISTERS = ["ac", "fp", "br", "sp", "ip", "dr", "ar"]
+
+
+class BasicBlock:
+    __slots__ = ("counter", "end", "function", "start", "ticks")
+
+    def __init__(self, start: int, end: int, ticks: int):
+        self.start = start
+        self.end = end
+        self.ticks = ticks
+        self.counter = 0
+        self.function = None
+
+
+def find_basic_block(program: Sequence[DecodedInstruction], start: int) -> BasicBlock | None:
+    """Базовый блок с началом в `start`, `None` - если инструкция исполняется интерпретатором"""
+    end = start
+    ticks = 0
+    while end < len(program) and program[end].opcode not in JIT_INTERPRETED:
+        ticks += program[end].ticks
+        end += 1
+        if program[end - 1].opcode in JIT_BLOCK_END:
+            break
+    return BasicBlock(start, end, ticks) if end > start else None
+
+
+def compile_basic_block(program: Sequence[DecodedInstruction], block: BasicBlock):
+    registers = ", ".join(JIT_DATA_PATH_REGISTERS)
+    lines = ["def block(dp):", "    mem = dp.memory()", "    {} = dp.registers()".format(registers)]
+    lines.append("    ip = {}".format(block.end))
+    for address in range(block.start, block.end):
+        instruction = program[address]
+        code = []
+        if instruction.fetch_address:
+            code += JIT_ADDRESS_FETCH[instruction.addressing]
+        if instruction.fetch_operand:
+            code += JIT_OPERAND_FETCH
+        code += JIT_EXECUTION[instruction.opcode]
+        lines.append("    # {}: {}".format(address, instruction.opcode.name))
+        for line in code:
+            lines.append(
+                "    "
+                + line.format(
+                    value=overflow(instruction.operand),
+                    operand=instruction.operand,
+                    register=JIT_REGISTERS.get(instruction.register),
+                    next=address + 1,
                 )
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_and(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.AND)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_or(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.REG_DR, AluOutSel.REG_AC, AluOpSig.OR)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_not(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.ADD, invert_left=True)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_get(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._data_path.set_data_sel(DataSelector.IO_PORT)
-                self._data_path.read_signal()
-                return tick + 1
-            case 1:
-                self._alu_move(AluInSel.REG_DR, AluOutSel.REG_AC)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_put(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_move(AluInSel.REG_AC, AluOutSel.REG_DR)
-                return tick + 1
-            case 1:
-                self._data_path.set_data_sel(DataSelector.IO_PORT)
-                self._data_path.write_signal()
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_pop(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, increment=True)
-                return -1
-
-    def _execute_push(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, invert_right=True)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_is_zero(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.IS_ZERO)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_is_pos(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.IS_POS)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_is_neg(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_AC, AluInSel.ZERO, AluOutSel.REG_AC, AluOpSig.IS_NEG)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_st(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_move(AluInSel.REG_AC, AluOutSel.REG_DR)
-                return tick + 1
-            case 1:
-                self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                self._data_path.write_signal()
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_ld(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_move(AluInSel.REG_DR, AluOutSel.REG_AC)
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_nop(self, tick: int) -> int:
-        match tick:
-            case 0:
-                # nothing
-                return -1
-        assert False, "Unknown tick {}".format(tick)
-
-    def _execute_halt(self, tick: int) -> int:
-        raise StopIteration()
-
-    def _execute_call(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_move(AluInSel.REG_DR, AluOutSel.REG_BR)
-                return tick + 1
-            case 1:
-                self._alu_move(AluInSel.REG_IP, AluOutSel.REG_DR)
-                return tick + 1
-            case 2:
-                self._alu_move(AluInSel.REG_SP, AluOutSel.REG_AR)
-                return tick + 1
-            case 3:
-                self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                self._data_path.write_signal()
-                return tick + 1
-            case 4:
-                self._alu_call(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, invert_right=True)
-                return tick + 1
-            case 5:
-                self._alu_move(AluInSel.REG_FP, AluOutSel.REG_DR)
-                return tick + 1
-            case 6:
-                self._alu_move(AluInSel.REG_SP, AluOutSel.REG_AR)
-                return tick + 1
-            case 7:
-                self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                self._data_path.write_signal()
-                return tick + 1
-            case 8:
-                self._alu_call(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, invert_right=True)
-                return tick + 1
-            case 9:
-                self._alu_move(AluInSel.REG_SP, AluOutSel.REG_FP)
-                return tick + 1
-            case 10:
-                self._alu_move(AluInSel.REG_BR, AluOutSel.REG_IP)
-                return -1
-        assert False, "Unexpected tick {}".format(tick)
-
-    def _execute_ret(self, tick: int) -> int:
-        match tick:
-            case 0:
-                self._alu_call(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, increment=True)
-                return tick + 1
-            case 1:
-                self._alu_move(AluInSel.REG_SP, AluOutSel.REG_AR)
-                return tick + 1
-            case 2:
-                self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                self._data_path.read_signal()
-                return tick + 1
-            case 3:
-                self._alu_move(AluInSel.REG_DR, AluOutSel.REG_FP)
-                return tick + 1
-            case 4:
-                self._alu_call(AluInSel.REG_SP, AluInSel.ZERO, AluOutSel.REG_SP, AluOpSig.ADD, increment=True)
-                return tick + 1
-            case 5:
-                self._alu_move(AluInSel.REG_SP, AluOutSel.REG_AR)
-                return tick + 1
-            case 6:
-                self._data_path.set_data_sel(DataSelector.DATA_MEMORY)
-                self._data_path.read_signal()
-                return tick + 1
-            case 7:
-                self._alu_move(AluInSel.REG_DR, AluOutSel.REG_IP)
-                return -1
-        assert False, "Unexpected tick {}".format(tick)
+            )
+    lines.append("    dp.load_registers({})".format(registers))
+    namespace = {"divide": divide, "remainder": remainder}
+    exec(compile("\n".join(lines), "<jit block {}-{}>".format(block.start, block.end), "exec"), namespace)
+    return namespace["block"]
 
-    def __repr__(self):
-        return "TICK: {:3} CR: {} DATA PATH: {}".format(self._tick, self._current_instruction(), self._data_path)
+
+class JitControlUnit(InstructionControlUnit):
+    """Компилирует часто исполняемые базовые блоки в функции Python.
+
+    Блоки разделяются командами перехода, вызова и возврата, а также командами ввода-вывода
+    и остановки, которые всегда исполняются интерпретатором. Блок, вход в который произошел
+    `hot_threshold` раз, компилируется и далее исполняется целиком с заранее посчитанным
+    количеством тактов.
+
+    Блоки находятся по мере исполнения: блок начинается там, куда управление попало после
+    перехода, вызова, возврата или команды интерпретатора, поэтому инструкции `LazyProgram`
+    декодируются только для исполненного кода.
+    """
+
+    def __init__(
+        self,
+        instruction_memory_size: int,
+        program: Sequence[DecodedInstruction],
+        data_path: DataPath,
+        hot_threshold: int = JIT_HOT_THRESHOLD,
+    ):
+        super().__init__(instruction_memory_size, program, data_path)
+        self._hot_threshold = hot_threshold
+        self._blocks = [None] * len(program)
+
+    def step(self, limit: int) -> int:
+        address = self._instruction_address()
+        block = self._blocks[address] if 0 <= address < len(self._blocks) else None
+        if block is None and 0 <= address < len(self._blocks) and self._at_leader():
+            block = self._blocks[address] = find_basic_block(self._instruction_memory, address)
+        if block is not None:
+            if block.function is not None and self._tick + block.ticks <= limit:
+                block.function(self._data_path)
+                self._tick += block.ticks
+                self._command_register = self._instruction_memory[block.end - 1]
+                return block.end - block.start
+            block.counter += 1
+            if block.counter == self._hot_threshold:
+                block.function = compile_basic_block(self._instruction_memory, block)
+        return super().step(limit)
+
+    def _at_leader(self) -> bool:
+        # control got here by a transfer or after the interpreter, not by falling through a block
+        previous = self._command_register
+        return previous is None or previous.opcode in JIT_BLOCK_END or previous.opcode in JIT_INTERPRETED
+
+
+CONTROL_UNITS = {
+    Engine.MICROCODE: ControlUnit,
+    Engine.INSTRUCTION: InstructionControlUnit,
+    Engine.JIT: JitControlUnit,
+}
 
 
 def simulation(
     data_segment: list[int],
-    text_segment: list[dict],
+    text_segment: Sequence[dict] | Sequence[DecodedInstruction],
     data_memory_size: int,
     instruction_memory_size: int,
-    input_tokens: list[int],
+    input_tokens: Iterable[int],
     limit: int,
-):
-    data_path = DataPath(data_memory_size, data_segment, input_tokens)
-    control_unit = ControlUnit(instruction_memory_size, text_segment, data_path)
+    engine: Engine = Engine.MICROCODE,
+    output_sink: TextIO | None = None,
+) -> tuple[str | None, int, int]:
+    """Моделирование программы: вывод, количество инструкций и тактов.
+
+    Если передан `output_sink`, вывод пишется только в него, а вместо вывода возвращается `None`.
+    """
+    output_port = OutputPort(output_sink)
+    data_path = DataPath(data_memory_size, data_segment, InputPort(input_tokens), output_port)
+    control_unit = CONTROL_UNITS[engine](instruction_memory_size, decode_program(text_segment), data_path)
     logging.debug("%s", control_unit)
     instruction_count = 0
     try:
         while control_unit.current_tick() < limit:
-            if control_unit.tick():
-                instruction_count += 1
+            executed = control_unit.step(limit)
+            if executed:
+                instruction_count += executed
                 # log per instruction
                 if instruction_count <= 1000:
                     logging.debug("%s", control_unit)
@@ -701,34 +1195,84 @@ def simulation(
         logging.warning("Input buffer is empty!")
     except StopIteration:
         pass
-    logging.info("output_buffer: %s", data_path.get_output_buffer())
+    output_port.flush()
+    logging.info("output_port: %s bytes written", output_port.written)
+    if output_sink is not None:
+        return None, instruction_count, control_unit.current_tick()
     output = "".join([chr(byte) for byte in data_path.get_output_buffer()])
     return output, instruction_count, control_unit.current_tick()
 
 
-def main(code_file: str, input_file: str):
+def main(code_file: str, input_file: str, engine: Engine = Engine.MICROCODE):
     text_segment, data_segment = read_code(code_file)
     with open(input_file, encoding="utf-8") as file:
-        input_text = file.read()
-        input_tokens = []
-        for char in input_text:
-            input_tokens.append(ord(char))
-
-    output, instruction_count, ticks = simulation(
-        data_segment,
-        text_segment,
-        data_memory_size=2048,
-        instruction_memory_size=2048,
-        input_tokens=input_tokens,
-        limit=100000000,
-    )
+        _, instruction_count, ticks = simulation(
+            data_segment,
+            text_segment,
+            data_memory_size=2048,
+            instruction_memory_size=2048,
+            input_tokens=stream_input(file),
+            limit=100000000,
+            engine=engine,
+            output_sink=sys.stdout,
+        )
 
-    print("".join(output))
+    # output is already written to stdout, end its line before the statistics
+    print()
     print("instruction count: {} ticks: {}".format(instruction_count, ticks))
 
 
+# program state of a batch worker process, filled once by _init_batch_worker
+_batch_program: tuple[list[int], Sequence[DecodedInstruction], Engine] | None = None
+
+
+def _init_batch_worker(code_file: str, engine: Engine):
+    global _batch_program
+    text_segment, data_segment = read_code(code_file)
+    _batch_program = (data_segment, decode_program(text_segment), engine)
+
+
+def _run_batch_input(input_file: str) -> dict:
+    assert _batch_program is not None, "Batch worker is not initialized"
+    data_segment, program, engine = _batch_program
+    with open(input_file, encoding="utf-8") as file:
+        output, instruction_count, ticks = simulation(
+            data_segment,
+            program,
+            data_memory_size=2048,
+            instruction_memory_size=2048,
+            input_tokens=stream_input(file),
+            limit=100000000,
+            engine=engine,
+        )
+    return {"input": input_file, "output": output, "instruction_count": instruction_count, "ticks": ticks}
+
+
+def batch(
+    code_file: str,
+    input_files: list[str],
+    results_file: str,
+    engine: Engine = Engine.JIT,
+    workers: int | None = None,
+) -> list[dict]:
+    """Запуск одной программы на множестве входных файлов в пуле процессов"""
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, len(input_files) // (workers * 4))
+    with ProcessPoolExecutor(workers, initializer=_init_batch_worker, initargs=(code_file, engine)) as pool:
+        results = list(pool.map(_run_batch_input, input_files, chunksize=chunk_size))
+    with open(results_file, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+    return results
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        assert len(sys.argv) >= 4, "Wrong arguments: machine.py batch <code_file> <results_file> <input_file>..."
+        _, _, code_file, results_file, *input_files = sys.argv
+        results = batch(code_file, input_files, results_file)
+        print("inputs: {} instruction count: {}".format(len(results), sum(r["instruction_count"] for r in results)))
+        sys.exit()
     logging.getLogger().setLevel(logging.DEBUG)
-    assert len(sys.argv) == 3, "Wrong arguments: machine.py <code_file> <input_file>"
-    _, code_file, input_file = sys.argv
-    main(code_file, input_file)
+    assert len(sys.argv) in (3, 4), "Wrong arguments: machine.py <code_file> <input_file> [microcode|instruction|jit]"
+    _, code_file, input_file, *engine_name = sys.argv
+    main(code_file, input_file, Engine(*engine_name) if engine_name else Engine.MICROCODE)
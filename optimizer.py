@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import copy
+from collections.abc import Callable
+
+from isa import divide, overflow, remainder
+from lexer import TokenType
+from parsing import (
+    AllocationExpression,
+    BinaryOperationExpression,
+    BlockExpression,
+    ConditionExpression,
+    EmptyExpression,
+    Expression,
+    FunctionCallExpression,
+    FunctionDefinitionExpression,
+    LoopExpression,
+    NumberLiteralExpression,
+    RootExpression,
+    StringLiteralExpression,
+    UnaryOperatorExpression,
+    VariableAssignmentExpression,
+    VariableValueExpression,
+)
+
+# all bits set, identity of `and` and absorbing element of `or`
+ALL_BITS = overflow(-1)
+
+
+def constant_operations() -> dict[TokenType, Callable[[int, int], int]]:
+    """Вычисление операторов над константами так же, как это делает процессор"""
+    return {
+        TokenType.PLUS: lambda a, b: overflow(a + b),
+        TokenType.SUB: lambda a, b: overflow(a - b),
+        TokenType.AND: lambda a, b: overflow(a & b),
+        TokenType.OR: lambda a, b: overflow(a | b),
+        TokenType.MUL: lambda a, b: overflow(a * b),
+        TokenType.DIV: divide,
+        TokenType.MOD: remainder,
+        # comparison is a subtraction and a check of the sign of the result
+        TokenType.EQUALS: lambda a, b: int(overflow(a - b) == 0),
+        TokenType.LESS: lambda a, b: int(overflow(a - b) < 0),
+        TokenType.GREATER: lambda a, b: int(overflow(a - b) > 0),
+    }
+
+
+# division by zero stops the processor, so it is neither computed nor removed
+DIVISIONS = (TokenType.DIV, TokenType.MOD)
+
+
+def left_identities() -> dict[TokenType, int]:
+    """Нейтральные элементы слева: `(op e x)` равно `x`"""
+    return {TokenType.PLUS: 0, TokenType.OR: 0, TokenType.AND: ALL_BITS, TokenType.MUL: 1}
+
+
+def right_identities() -> dict[TokenType, int]:
+    """Нейтральные элементы справа: `(op x e)` равно `x`"""
+    return {
+        TokenType.PLUS: 0,
+        TokenType.SUB: 0,
+        TokenType.OR: 0,
+        TokenType.AND: ALL_BITS,
+        TokenType.MUL: 1,
+        TokenType.DIV: 1,
+    }
+
+
+def _constant(e: Expression) -> int | None:
+    if isinstance(e, NumberLiteralExpression):
+        return overflow(e.value)
+    return None
+
+
+class ConstantFolder:
+    """Свертка констант и алгебраические упрощения в AST.
+
+    Узлы обрабатываются снизу вверх без рекурсии. Выражение с побочными эффектами (вызов, присваивание,
+    ввод-вывод, запись в память, цикл) никогда не удаляется, даже если его значение не нужно.
+    """
+
+    def __init__(self):
+        # ids of nodes with side effects, children are simplified before their parents
+        self._impure = set()
+
+    def fold(self, form: Expression) -> Expression:
+        holder = RootExpression([form])
+        nodes = [holder]
+        for node in nodes:
+            nodes.extend(node.children())
+        # every node goes after its parent, so reversed order visits children first
+        for node in reversed(nodes):
+            node.apply(self._simplify)
+        self._impure.clear()
+        return holder.expressions[0]
+
+    def _simplify(self, e: Expression) -> Expression:
+        e = self._rewrite(e)
+        if not self._is_pure(e):
+            self._impure.add(id(e))
+        return e
+
+    def _rewrite(self, e: Expression) -> Expression:
+        match e:
+            case BinaryOperationExpression() if e.operator in constant_operations():
+                e = self._simplify_binary(e)
+            case UnaryOperatorExpression(operator=TokenType.NOT):
+                e = self._simplify_not(e)
+            case ConditionExpression():
+                condition = _constant(e.condition)
+                if condition is not None:
+                    e = e.true_expression if condition != 0 else e.false_expression
+            case LoopExpression():
+                # loop which is never entered leaves its false condition as a result
+                if _constant(e.condition) == 0:
+                    e = NumberLiteralExpression(e.position, 0)
+        return e
+
+    def _is_pure(self, e: Expression) -> bool:
+        match e:
+            case (
+                NumberLiteralExpression()
+                | StringLiteralExpression()
+                | VariableValueExpression()
+                | AllocationExpression()
+                | EmptyExpression()
+                | ConditionExpression()
+            ):
+                pass
+            case BinaryOperationExpression() if e.operator in constant_operations() and e.operator not in DIVISIONS:
+                pass
+            case UnaryOperatorExpression(operator=TokenType.NOT):
+                pass
+            case _:
+                return False
+        return not any(id(child) in self._impure for child in e.children())
+
+    def _simplify_binary(self, e: BinaryOperationExpression) -> Expression:
+        first, second = _constant(e.first), _constant(e.second)
+        operator = e.operator
+        if first is not None and second is not None and (second != 0 or operator not in DIVISIONS):
+            return NumberLiteralExpression(e.position, constant_operations()[operator](first, second))
+        if first is not None and left_identities().get(operator) == first:
+            return e.second
+        if second is not None and right_identities().get(operator) == second:
+            return e.first
+        # absorbing elements
+        absorbing = {TokenType.AND: 0, TokenType.OR: ALL_BITS, TokenType.MUL: 0}.get(operator)
+        if absorbing is not None and absorbing in (first, second):
+            return self._absorb(e, absorbing)
+        if operator in (TokenType.SUB, TokenType.EQUALS, TokenType.LESS, TokenType.GREATER) and self._same_variable(
+            e.first, e.second
+        ):
+            return NumberLiteralExpression(e.position, int(operator == TokenType.EQUALS))
+        return e
+
+    def _absorb(self, e: BinaryOperationExpression, value: int) -> Expression:
+        # the other operand is computed only for its side effects, so it may be dropped only if it has none
+        if id(e.first) in self._impure or id(e.second) in self._impure:
+            return e
+        return NumberLiteralExpression(e.position, value)
+
+    @staticmethod
+    def _same_variable(first: Expression, second: Expression) -> bool:
+        return (
+            isinstance(first, VariableValueExpression)
+            and isinstance(second, VariableValueExpression)
+            and first.name == second.name
+        )
+
+    @staticmethod
+    def _simplify_not(e: UnaryOperatorExpression) -> Expression:
+        value = _constant(e.operand)
+        if value is not None:
+            return NumberLiteralExpression(e.position, overflow(~value))
+        if isinstance(e.operand, UnaryOperatorExpression) and e.operand.operator == TokenType.NOT:
+            return e.operand.operand
+        return e
+
+
+class Inliner:
+    """Встраивание тел небольших нерекурсивных функций в места вызова.
+
+    Вызов заменяется блоком: аргументы по порядку присваиваются параметрам, затем вычисляется копия тела.
+    Параметры и локальные переменные функции переименовываются в каждом месте вызова, поэтому вложенные
+    вызовы одной функции не портят переменные друг друга. Аргумент неиспользуемого параметра вычисляется
+    только ради побочных эффектов. Размер тела (`size` - число инструкций узла) ограничен `threshold`,
+    функции с циклами не встраиваются.
+    """
+
+    def __init__(self, threshold: int, size: Callable[[Expression], int]):
+        self._threshold = threshold
+        self._size = size
+        self._functions: dict[str, FunctionDefinitionExpression] = {}
+        # call sites are numbered to make names of variables unique
+        self._sites = 0
+
+    def candidates(self) -> list[FunctionDefinitionExpression]:
+        return list(self._functions.values())
+
+    def add(self, function: FunctionDefinitionExpression):
+        """Функция становится доступной для встраивания, если она небольшая и не вызывает сама себя"""
+        self._functions.pop(function.name, None)
+        nodes = [node for e in function.body for node in (e, *e.descendants())]
+        if not function.body or function.name in function.calls or sum(map(self._size, nodes)) > self._threshold:
+            return
+        # every call of a function returns the same buffer, a copy of the body would allocate another one
+        if any(isinstance(node, AllocationExpression | FunctionDefinitionExpression) for node in nodes):
+            return
+        # a loop saves no call overhead worth its copy at every call site
+        if any(isinstance(node, LoopExpression) for node in nodes):
+            return
+        self._functions[function.name] = function
+
+    def inline(self, form: Expression) -> tuple[Expression, list[str], int]:
+        """Возвращает новое выражение, имена созданных переменных и число встроенных вызовов"""
+        holder = RootExpression([form])
+        nodes = [holder]
+        for node in nodes:
+            nodes.extend(node.children())
+        variables = []
+        inlined = 0
+
+        def expand(e: Expression) -> Expression:
+            nonlocal inlined
+            if isinstance(e, FunctionCallExpression):
+                function = self._functions.get(e.name)
+                if function is not None and len(e.arguments) == len(function.parameters):
+                    inlined += 1
+                    return self._expand(e, function, variables)
+            return e
+
+        # arguments are expanded before calls which take them, bodies of functions are already expanded
+        for node in reversed(nodes):
+            node.apply(expand)
+        return holder.expressions[0], variables, inlined
+
+    def _expand(
+        self, call: FunctionCallExpression, function: FunctionDefinitionExpression, variables: list[str]
+    ) -> BlockExpression:
+        self._sites += 1
+        body = copy.deepcopy(function.body)
+        nodes = [node for e in body for node in (e, *e.descendants())]
+        nodes = [node for node in nodes if isinstance(node, VariableValueExpression | VariableAssignmentExpression)]
+        used = {node.name for node in nodes}
+        # parentheses can't be a part of a name in source code
+        names = {
+            name: "{}({})#{}".format(function.name, name, self._sites)
+            for name in [*function.parameters, *function.locals]
+            if name in used
+        }
+        for node in nodes:
+            node.name = names[node.name]
+        variables.extend(names.values())
+        arguments = [
+            VariableAssignmentExpression(argument.position, names[parameter], argument)
+            if parameter in names
+            else argument
+            for parameter, argument in zip(function.parameters, call.arguments)
+        ]
+        return BlockExpression(call.position, [*arguments, *body])
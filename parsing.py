@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+from collections.abc import Iterable, Iterator
 from typing import Callable
 
 from lexer import Token, TokenType, binary_operators, nullary_operators, unary_operators
 
 
 class Expression:
-    def __init__(self, token: Token):
-        self.token = token
+    """Узел AST. Вместо ссылки на токен хранит упакованную позицию в исходном коде (см. `lexer.pack_position`)"""
+
+    __slots__ = ("position",)
+
+    def __init__(self, position: int):
+        self.position = position
 
     def children(self) -> list[Expression]:
         return []
@@ -16,14 +21,42 @@ class Expression:
         return
 
     def apply_traverse(self, f: Callable[[Expression], Expression]):
-        self.apply(f)
-        for node in self.children():
-            node.apply_traverse(f)
+        """Замена всех потомков узла на результат `f` (в порядке `descendants`), без рекурсии"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.apply(f)
+            stack.extend(reversed(node.children()))
+
+    def descendants(self) -> Iterator[Expression]:
+        """Обход потомков узла без рекурсии: сначала дети узла, затем по порядку поддеревья детей"""
+        stack = [self]
+        while stack:
+            children = stack.pop().children()
+            yield from children
+            stack.extend(reversed(children))
+
+    def depth(self) -> int:
+        """Глубина вложенности поддерева, без рекурсии"""
+        result = 0
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            result = max(result, depth)
+            stack.extend((child, depth + 1) for child in node.children())
+        return result
+
+
+def _apply_in_place(expressions: list[Expression], f: Callable[[Expression], Expression]) -> None:
+    for index, expression in enumerate(expressions):
+        expressions[index] = f(expression)
 
 
 class RootExpression(Expression):
+    __slots__ = ("expressions",)
+
     def __init__(self, expressions: list[Expression]):
-        super().__init__(None)
+        super().__init__(0)
         self.expressions = expressions
 
     def __repr__(self) -> str:
@@ -33,12 +66,14 @@ class RootExpression(Expression):
         return self.expressions
 
     def apply(self, f: Callable[[Expression], Expression]) -> None:
-        self.expressions = list(map(f, self.expressions))
+        _apply_in_place(self.expressions, f)
 
 
 class FunctionCallExpression(Expression):
-    def __init__(self, token: Token, name: str, arguments: list[Expression]):
-        super().__init__(token)
+    __slots__ = ("arguments", "name")
+
+    def __init__(self, position: int, name: str, arguments: list[Expression]):
+        super().__init__(position)
         self.name = name
         self.arguments = arguments
 
@@ -49,12 +84,14 @@ class FunctionCallExpression(Expression):
         return self.arguments
 
     def apply(self, f: Callable[[Expression], Expression]) -> None:
-        self.arguments = list(map(f, self.arguments))
+        _apply_in_place(self.arguments, f)
 
 
 class NumberLiteralExpression(Expression):
-    def __init__(self, token: Token, value: int):
-        super().__init__(token)
+    __slots__ = ("value",)
+
+    def __init__(self, position: int, value: int):
+        super().__init__(position)
         self.value = value
 
     def __repr__(self) -> str:
@@ -62,8 +99,10 @@ class NumberLiteralExpression(Expression):
 
 
 class StringLiteralExpression(Expression):
-    def __init__(self, token: Token, value: str):
-        super().__init__(token)
+    __slots__ = ("value",)
+
+    def __init__(self, position: int, value: str):
+        super().__init__(position)
         self.value = value
 
     def __repr__(self) -> str:
@@ -71,8 +110,10 @@ class StringLiteralExpression(Expression):
 
 
 class CharacterLiteralExpression(Expression):
-    def __init__(self, token: Token, value: str):
-        super().__init__(token)
+    __slots__ = ("value",)
+
+    def __init__(self, position: int, value: str):
+        super().__init__(position)
         self.value = value
 
     def __repr__(self) -> str:
@@ -80,8 +121,10 @@ class CharacterLiteralExpression(Expression):
 
 
 class VariableValueExpression(Expression):
-    def __init__(self, token: Token, name: str):
-        super().__init__(token)
+    __slots__ = ("name",)
+
+    def __init__(self, position: int, name: str):
+        super().__init__(position)
         self.name = name
 
     def __repr__(self):
@@ -89,10 +132,12 @@ class VariableValueExpression(Expression):
 
 
 class ConditionExpression(Expression):
+    __slots__ = ("condition", "false_expression", "true_expression")
+
     def __init__(
-        self, token: Token, condition: Expression, true_expression: Expression, false_expression: Expression
+        self, position: int, condition: Expression, true_expression: Expression, false_expression: Expression
     ) -> None:
-        super().__init__(token)
+        super().__init__(position)
         self.condition = condition
         self.true_expression = true_expression
         self.false_expression = false_expression
@@ -110,8 +155,10 @@ class ConditionExpression(Expression):
 
 
 class LoopExpression(Expression):
-    def __init__(self, token: Token, condition: Expression, body: list[Expression]) -> None:
-        super().__init__(token)
+    __slots__ = ("body", "condition")
+
+    def __init__(self, position: int, condition: Expression, body: list[Expression]) -> None:
+        super().__init__(position)
         self.condition = condition
         self.body = body
 
@@ -122,16 +169,21 @@ class LoopExpression(Expression):
         return [self.condition, *self.body]
 
     def apply(self, f: Callable[[Expression], Expression]) -> None:
-        self.body = list(map(f, self.body))
         self.condition = f(self.condition)
+        _apply_in_place(self.body, f)
 
 
 class FunctionDefinitionExpression(Expression):
-    def __init__(self, token: Token, name: str, parameters: list[str], body: list[Expression]) -> None:
-        super().__init__(token)
+    __slots__ = ("body", "calls", "locals", "name", "parameters")
+
+    def __init__(self, position: int, name: str, parameters: list[str], body: list[Expression]) -> None:
+        super().__init__(position)
         self.name = name
         self.parameters = parameters
         self.body = body
+        # filled by semantic analysis: local variables (name -> index) and called functions
+        self.locals: dict[str, int] = {}
+        self.calls: dict[str, None] = {}
 
     def __repr__(self) -> str:
         return 'FUNCTION DEF [NAME: "{}", PARAMETERS: {}, BODY: {}]'.format(self.name, self.parameters, self.body)
@@ -140,12 +192,14 @@ class FunctionDefinitionExpression(Expression):
         return self.body
 
     def apply(self, f: Callable[[Expression], Expression]) -> None:
-        self.body = list(map(f, self.body))
+        _apply_in_place(self.body, f)
 
 
 class VariableAssignmentExpression(Expression):
-    def __init__(self, token: Token, name: str, value: Expression) -> None:
-        super().__init__(token)
+    __slots__ = ("name", "value")
+
+    def __init__(self, position: int, name: str, value: Expression) -> None:
+        super().__init__(position)
         self.name = name
         self.value = value
 
@@ -160,8 +214,10 @@ class VariableAssignmentExpression(Expression):
 
 
 class BinaryOperationExpression(Expression):
-    def __init__(self, token: Token, operator: TokenType, first: Expression, second: Expression) -> None:
-        super().__init__(token)
+    __slots__ = ("first", "operator", "second")
+
+    def __init__(self, position: int, operator: TokenType, first: Expression, second: Expression) -> None:
+        super().__init__(position)
         self.operator = operator
         self.first = first
         self.second = second
@@ -178,8 +234,10 @@ class BinaryOperationExpression(Expression):
 
 
 class UnaryOperatorExpression(Expression):
-    def __init__(self, token: Token, operator: TokenType, operand: Expression) -> None:
-        super().__init__(token)
+    __slots__ = ("operand", "operator")
+
+    def __init__(self, position: int, operator: TokenType, operand: Expression) -> None:
+        super().__init__(position)
         self.operator = operator
         self.operand = operand
 
@@ -194,8 +252,10 @@ class UnaryOperatorExpression(Expression):
 
 
 class NullaryOperatorExpression(Expression):
-    def __init__(self, token: Token, operator: TokenType) -> None:
-        super().__init__(token)
+    __slots__ = ("operator",)
+
+    def __init__(self, position: int, operator: TokenType) -> None:
+        super().__init__(position)
         self.operator = operator
 
     def __repr__(self) -> str:
@@ -203,8 +263,10 @@ class NullaryOperatorExpression(Expression):
 
 
 class AllocationExpression(Expression):
-    def __init__(self, token: Token, size: int) -> None:
-        super().__init__(token)
+    __slots__ = ("size",)
+
+    def __init__(self, position: int, size: int) -> None:
+        super().__init__(position)
         self.size = size
 
     def __repr__(self) -> str:
@@ -212,163 +274,189 @@ class AllocationExpression(Expression):
 
 
 class EmptyExpression(Expression):
-    def __init__(self, token: Token) -> None:
-        super().__init__(token)
+    __slots__ = ()
+
+    def __init__(self, position: int) -> None:
+        super().__init__(position)
+
+
+class BlockExpression(Expression):
+    """Последовательность выражений со значением последнего. Создается компилятором при встраивании функций"""
+
+    __slots__ = ("body",)
+
+    def __init__(self, position: int, body: list[Expression]) -> None:
+        super().__init__(position)
+        self.body = body
+
+    def __repr__(self) -> str:
+        return "BLOCK [BODY: {}]".format(self.body)
+
+    def children(self) -> list[Expression]:
+        return self.body
+
+    def apply(self, f: Callable[[Expression], Expression]) -> None:
+        _apply_in_place(self.body, f)
+
+
+def _slots(expression: Expression) -> list[str]:
+    return [name for cls in reversed(type(expression).__mro__) for name in getattr(cls, "__slots__", ())]
+
+
+def expression_to_dict(expression: Expression) -> dict:
+    """Узел AST со всеми потомками в виде, пригодном для JSON. Рекурсия допустима: так сохраняются только тела
+    встраиваемых функций, глубина которых ограничена их размером"""
+
+    def value_to_json(value):
+        if isinstance(value, Expression):
+            return expression_to_dict(value)
+        if isinstance(value, list):
+            return [value_to_json(item) for item in value]
+        return value
+
+    node = {"node": type(expression).__name__}
+    for name in _slots(expression):
+        node[name] = value_to_json(getattr(expression, name))
+    return node
+
+
+def expression_from_dict(node: dict) -> Expression:
+    """Обратное преобразование `expression_to_dict`"""
+
+    def value_from_json(value):
+        # other dictionaries (variables and calls of a function) never have a string under "node"
+        if isinstance(value, dict) and isinstance(value.get("node"), str):
+            return expression_from_dict(value)
+        if isinstance(value, list):
+            return [value_from_json(item) for item in value]
+        return value
+
+    classes = {cls.__name__: cls for cls in Expression.__subclasses__()}
+    assert node["node"] in classes, "Unknown expression node [{}]".format(node["node"])
+    expression = object.__new__(classes[node["node"]])
+    for name in _slots(expression):
+        setattr(expression, name, value_from_json(node[name]))
+    return expression
+
+
+def raw_operands() -> set[TokenType]:
+    """Ключевые слова, первый операнд которых - токен, а не выражение"""
+    return {TokenType.KEY_DEFUN, TokenType.KEY_SETQ, TokenType.KEY_ALLOC}
 
 
 class Parser:
-    def __init__(self, tokens):
-        self._tokens = tokens
-        self._ptr = 0
+    """Строит AST без рекурсии: элементы незакрытых скобок хранятся в явном стеке,
+    поэтому глубина вложенности ограничена только памятью.
 
-    def _cur_token(self) -> Token:
-        assert self._ptr < len(self._tokens), "Out of tokens"
-        return self._tokens[self._ptr]
+    Токены могут поступать ленивым потоком (`Lexer.tokens`).
+    """
 
-    def _next(self):
-        self._ptr += 1
+    def __init__(self, tokens: Iterable[Token]):
+        self._tokens = tokens
 
     def parse(self) -> RootExpression:
-        return RootExpression(self._parse_expressions())
+        return RootExpression(list(self.forms()))
+
+    def forms(self) -> Iterator[Expression]:
+        """Выражения верхнего уровня по одному, каждое - сразу после его последнего токена"""
+        # items of open brackets, the first one holds a finished expression of root
+        stack = [[]]
+        root = stack[0]
+        raw = raw_operands()
+        tokens = iter(self._tokens)
+        for token in tokens:
+            items = stack[-1]
+            if token.type == TokenType.OPEN_BRACKET:
+                if len(stack) > 1 and len(items) == 2 and items[0].type == TokenType.KEY_DEFUN:
+                    items.append(self._parse_function_parameters(tokens))
+                else:
+                    assert len(stack) == 1 or len(items) > 0, "Unexpected token {}".format(token)
+                    stack.append([])
+            elif token.type == TokenType.CLOSE_BRACKET:
+                assert len(stack) > 1, "Unexpected token {}".format(token)
+                stack.pop()
+                stack[-1].append(self._build_expression(items))
+            elif len(stack) > 1 and (len(items) == 0 or (len(items) == 1 and items[0].type in raw)):
+                items.append(token)
+            else:
+                items.append(self._build_atom(token))
+            if root:
+                yield root.pop()
+        assert len(stack) == 1, "Out of tokens"
+
+    @staticmethod
+    def _build_atom(token: Token) -> Expression:
+        match token.type:
+            case TokenType.VARNAME:
+                return VariableValueExpression(token.position, token.value)
+            case TokenType.NUMBER_LITERAL:
+                return NumberLiteralExpression(token.position, token.value)
+            case TokenType.STRING_LITERAL:
+                return StringLiteralExpression(token.position, token.value)
+            case TokenType.CHARACTER_LITERAL:
+                return CharacterLiteralExpression(token.position, token.value)
+        assert False, "Unexpected token {}".format(token)
 
-    def _parse_expressions(self) -> list[Expression]:
+    @staticmethod
+    def _parse_function_parameters(tokens: Iterator[Token]) -> list[str]:
         result = []
-        while self._ptr != len(self._tokens) and self._cur_token().type != TokenType.CLOSE_BRACKET:
-            result.append(self._parse_expression())
-        return result
-
-    def _parse_expression(self) -> Expression:
-        token = self._cur_token()
-        if token.type == TokenType.OPEN_BRACKET:
-            self._next()
-            result = self._parse_bracketed_expression()
-            token = self._cur_token()
-            assert token.type == TokenType.CLOSE_BRACKET
-            self._next()
-            return result
-        if token.type == TokenType.VARNAME:
-            self._next()
-            return VariableValueExpression(token, token.value)
-        if token.type == TokenType.NUMBER_LITERAL:
-            self._next()
-            return NumberLiteralExpression(token, token.value)
-        if token.type == TokenType.STRING_LITERAL:
-            self._next()
-            return StringLiteralExpression(token, token.value)
-        if token.type == TokenType.CHARACTER_LITERAL:
-            self._next()
-            return CharacterLiteralExpression(token, token.value)
-        assert False, "Unexpected token {}".format(token)
+        for token in tokens:
+            if token.type == TokenType.CLOSE_BRACKET:
+                return result
+            assert token.type == TokenType.VARNAME, "Unexpected token {}".format(token)
+            result.append(token.value)
+        assert False, "Out of tokens"
 
-    def _parse_bracketed_expression(self) -> Expression:
-        token = self._cur_token()
+    def _build_expression(self, items: list) -> Expression:
+        """Узел из элементов закрытой скобки: первый элемент - токен, остальные - выражения,
+        кроме операндов из `raw_operands` (токены) и параметров функции (список имен)"""
+        assert len(items) > 0, "Unexpected token"
+        token = items[0]
         match token.type:
             case TokenType.VARNAME:
-                return self._parse_function_call()
+                return FunctionCallExpression(token.position, token.value, items[1:])
             case TokenType.KEY_IF:
-                return self._parse_if_condition()
+                assert len(items) == 4, "Wrong if condition {}".format(token)
+                return ConditionExpression(token.position, items[1], items[2], items[3])
             case TokenType.KEY_DEFUN:
-                return self._parse_function_definition()
+                return self._build_function_definition(items)
             case TokenType.KEY_SETQ:
-                return self._parse_assignment()
+                return self._build_assignment(items)
             case TokenType.KEY_LOOP:
-                return self._parse_loop_expression()
+                assert len(items) >= 2, "Wrong loop {}".format(token)
+                return LoopExpression(token.position, items[1], items[2:])
             case TokenType.KEY_ALLOC:
-                return self._parse_allocation()
+                assert len(items) == 2, "Wrong allocation {}".format(token)
+                size = items[1]
+                assert isinstance(size, Token), "Wrong allocation size {}".format(token)
+                assert size.type == TokenType.NUMBER_LITERAL, "Wrong allocation size {}".format(size)
+                return AllocationExpression(size.position, size.value)
             case _:
                 if token.type in binary_operators():
-                    return self._parse_binary_operator()
+                    assert len(items) == 3, "Wrong binary operation {}".format(token)
+                    return BinaryOperationExpression(token.position, token.type.value, items[1], items[2])
                 if token.type in unary_operators():
-                    return self._parse_unary_operator()
+                    assert len(items) == 2, "Wrong unary operation {}".format(token)
+                    return UnaryOperatorExpression(token.position, token.type.value, items[1])
                 if token.type in nullary_operators():
-                    return self._parse_nullary_operator()
-        assert False, "Unexpected token"
-
-    def _parse_function_call(self) -> Expression:
-        token = self._cur_token()
-        self._next()
-        args = self._parse_expressions()
-        name = token.value
-        return FunctionCallExpression(token, name, args)
-
-    def _parse_if_condition(self) -> Expression:
-        token = self._cur_token()
-        assert token.type == TokenType.KEY_IF
-        self._next()
-        condition = self._parse_expression()
-        true = self._parse_expression()
-        false = self._parse_expression()
-        return ConditionExpression(token, condition, true, false)
-
-    def _parse_function_definition(self) -> Expression:
-        token = self._cur_token()
-        assert token.type == TokenType.KEY_DEFUN
-        self._next()
-        name = self._cur_token().value
-        self._next()
-        assert self._cur_token().type == TokenType.OPEN_BRACKET
-        self._next()
-        parameters = self._parse_function_parameters()
-        assert self._cur_token().type == TokenType.CLOSE_BRACKET
-        self._next()
-        body = self._parse_expressions()
-        return FunctionDefinitionExpression(token, name, parameters, body)
-
-    def _parse_function_parameters(self) -> list:
-        result = []
-        while self._cur_token().type != TokenType.CLOSE_BRACKET:
-            token = self._cur_token()
-            assert token.type == TokenType.VARNAME
-            result.append(token.value)
-            self._next()
-        return result
+                    assert len(items) == 1, "Wrong nullary operation {}".format(token)
+                    return NullaryOperatorExpression(token.position, token.type)
+        assert False, "Unexpected token {}".format(token)
 
-    def _parse_assignment(self) -> Expression:
-        assert self._cur_token().type == TokenType.KEY_SETQ
-        self._next()
-        token = self._cur_token()
-        assert token.type == TokenType.VARNAME
-        name = token.value
-        self._next()
-        value = self._parse_expression()
-        return VariableAssignmentExpression(token, name, value)
-
-    def _parse_binary_operator(self) -> Expression:
-        token = self._cur_token()
-        assert token.type in binary_operators()
-        operator = token.type.value
-        self._next()
-        first_operand = self._parse_expression()
-        second_operand = self._parse_expression()
-        return BinaryOperationExpression(token, operator, first_operand, second_operand)
-
-    def _parse_unary_operator(self) -> Expression:
-        token = self._cur_token()
-        assert token.type in unary_operators()
-        operator = token.type.value
-        self._next()
-        operand = self._parse_expression()
-        return UnaryOperatorExpression(token, operator, operand)
-
-    def _parse_nullary_operator(self) -> Expression:
-        token = self._cur_token()
-        assert token.type in nullary_operators()
-        self._next()
-        return NullaryOperatorExpression(token, token.type)
-
-    def _parse_loop_expression(self) -> Expression:
-        token = self._cur_token()
-        assert token.type == TokenType.KEY_LOOP
-        self._next()
-        condition = self._parse_expression()
-        body = self._parse_expressions()
-        return LoopExpression(token, condition, body)
-
-    def _parse_allocation(self) -> Expression:
-        token = self._cur_token()
-        assert token.type == TokenType.KEY_ALLOC
-        self._next()
-        token = self._cur_token()
-        assert token.type == TokenType.NUMBER_LITERAL
-        self._next()
-        return AllocationExpression(token, token.value)
+    @staticmethod
+    def _build_function_definition(items: list) -> Expression:
+        token = items[0]
+        assert len(items) >= 3, "Wrong function definition {}".format(token)
+        assert isinstance(items[2], list), "Wrong function parameters {}".format(token)
+        name = items[1]
+        assert isinstance(name, Token), "Wrong function name {}".format(token)
+        assert name.type == TokenType.VARNAME, "Wrong function name {}".format(name)
+        return FunctionDefinitionExpression(token.position, name.value, items[2], items[3:])
+
+    @staticmethod
+    def _build_assignment(items: list) -> Expression:
+        assert len(items) == 3, "Wrong assignment {}".format(items[0])
+        name = items[1]
+        assert isinstance(name, Token), "Wrong variable name {}".format(items[0])
+        assert name.type == TokenType.VARNAME, "Wrong variable name {}".format(name)
+        return VariableAssignmentExpression(name.position, name.value, items[2])
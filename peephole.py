@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+
+from isa import Addressing, Opcode, Register
+
+# rules look at this number of last instructions at most
+MAX_WINDOW = 6
+
+# sp+1 is the top of the stack
+TOP = {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +1}
+SECOND = {"type": Addressing.RELATIVE, "register": Register.STACK_POINTER, "offset": +2}
+
+
+def _is(instruction: dict, opcode: Opcode, address: dict | None = None) -> bool:
+    return instruction["opcode"] == opcode and (address is None or instruction.get("address") == address)
+
+
+def _is_local(instruction: dict) -> bool:
+    """Инструкция не меняет поток управления и не работает со стеком"""
+    if instruction["opcode"] in {
+        Opcode.PUSH,
+        Opcode.POP,
+        Opcode.JMP,
+        Opcode.JZ,
+        Opcode.JNZ,
+        Opcode.JNEG,
+        Opcode.JPOS,
+        Opcode.CALL,
+        Opcode.RET,
+        Opcode.HALT,
+    }:
+        return False
+    address = instruction.get("address")
+    if address is None or address["type"] in {Addressing.ABSOLUTE, Addressing.IMMEDIATE}:
+        return True
+    return address["type"] == Addressing.RELATIVE and address["register"] == Register.FRAME_POINTER
+
+
+def _store_load(window: list[dict]) -> list[dict] | None:
+    # value is still in AC after it is stored
+    store, load = window
+    address = store.get("address")
+    if _is(store, Opcode.ST) and _is(load, Opcode.LD, address) and address["type"] != Addressing.RELATIVE_INDIRECT:
+        return [store]
+    return None
+
+
+def _dead_store(window: list[dict]) -> list[dict] | None:
+    # popped slot is never read again
+    if _is(window[0], Opcode.ST, TOP) and _is(window[-1], Opcode.POP) and all(map(_is_local, window[1:-1])):
+        return window[1:]
+    return None
+
+
+def _push_pop(window: list[dict]) -> list[dict] | None:
+    # stack pointer is restored and the slot is not touched
+    first, *middle, last = window
+    if not all(map(_is_local, middle)):
+        return None
+    if (_is(first, Opcode.PUSH) and _is(last, Opcode.POP)) or (_is(first, Opcode.POP) and _is(last, Opcode.PUSH)):
+        return middle
+    return None
+
+
+def _commutative_operation(window: list[dict]) -> list[dict] | None:
+    # second operand is in AC, the first one is on the top of the stack
+    push, store, load, operation, pop, result = window
+    if (
+        _is(push, Opcode.PUSH)
+        and _is(store, Opcode.ST, TOP)
+        and _is(load, Opcode.LD, SECOND)
+        and Opcode(operation["opcode"]).is_commutative()
+        and _is(operation, operation["opcode"], TOP)
+        and _is(pop, Opcode.POP)
+        and _is(result, Opcode.ST, TOP)
+    ):
+        return [operation, result]
+    return None
+
+
+def peephole_rules() -> list[tuple[int, Callable[[list[dict]], list[dict] | None]]]:
+    """Правила замены: размер окна и функция, которая возвращает замену окна или None"""
+    return [
+        (2, _store_load),
+        (2, _dead_store),
+        (3, _dead_store),
+        (2, _push_pop),
+        (3, _push_pop),
+        (MAX_WINDOW, _commutative_operation),
+    ]
+
+
+def _entry_points(instructions: list[dict]) -> set[int]:
+    """Цели переходов и вызовов, а также точки возврата из функций"""
+    labels = {0}
+    for index, instruction in enumerate(instructions):
+        address = instruction.get("address")
+        if address and address["type"] == Addressing.CONTROL_FLOW:
+            labels.add(address["value"])
+        if instruction["opcode"] == Opcode.CALL:
+            labels.add(index + 1)
+    return labels
+
+
+def _rewrite_tail(result: list[dict], entries: list[list[int]]) -> list[int] | None:
+    """Применяет первое подходящее правило к концу кода, возвращает None, если правил нет, или точки входа
+    удаленного целиком окна"""
+    for size, rule in peephole_rules():
+        if len(result) < size or any(entries[-size + 1 :]):
+            continue
+        replacement = rule(result[-size:])
+        if replacement is None:
+            continue
+        first_entries = entries[-size]
+        del result[-size:], entries[-size:]
+        if not replacement:
+            return first_entries
+        result.extend(replacement)
+        entries.append(first_entries)
+        entries.extend([] for _ in replacement[1:])
+        return []
+    return None
+
+
+def optimize(instructions: list[dict]) -> list[dict]:
+    """Оконная оптимизация слинкованного кода.
+
+    Правила применяются к концу уже обработанного кода после добавления каждой инструкции, поэтому замена
+    может открыть следующую. Окно не может содержать точку входа (цель перехода или возврата из функции)
+    нигде, кроме начала: переход в начало окна переносится на его замену, а если окно удалено целиком - на
+    следующую инструкцию.
+    """
+    labels = _entry_points(instructions)
+    result = []
+    # entry points (old indexes) of every instruction in result
+    entries = []
+    pending = []
+    for index, instruction in enumerate(instructions):
+        result.append(instruction)
+        entries.append([*pending, index] if index in labels else pending)
+        pending = []
+        while (removed := _rewrite_tail(result, entries)) is not None:
+            pending = removed + pending
+    assert not pending, "Entry point at the end of code"
+    addresses = {old: new for new, points in enumerate(entries) for old in points}
+    for new, instruction in enumerate(result):
+        instruction["index"] = new
+        address = instruction.get("address")
+        if address and address["type"] == Addressing.CONTROL_FLOW:
+            instruction["address"] = {**address, "value": addresses[address["value"]]}
+    return result
@@ -1,14 +1,29 @@
 from __future__ import annotations
 
+import contextlib
+import functools
+import hashlib
+import importlib.util
 import json
+import mmap
+import os
+import struct
 import sys
+from array import array
+from collections.abc import Sequence
+from enum import Enum
+from pathlib import Path
 
-from compiler import Compiler
-from isa import Addressing, Opcode, Register
+from cache import CACHE_DIR_VARIABLE, CompilationCache
+from compiler import AccumulatorCompiler, Compiler
+from isa import OPCODE_NUMBERS, Addressing, Opcode, Register
 from lexer import Lexer
+from linker import ObjectModule, link, read_object, write_object
 from parsing import Parser
 
 STDLIB_FILE = "examples/stdlib.clisp"
+DATA_SEGMENT_SIZE = 1024
+TEXT_SEGMENT_SIZE = 2048
 
 
 def write_code(filename: str, instruction_code: list[dict], static_data: list[int]):
@@ -21,7 +36,133 @@ def write_code(filename: str, instruction_code: list[dict], static_data: list[in
         file.write("{" + '"code": ' + code + ',\n "data": ' + data + "}")
 
 
-def read_code(filename: str) -> tuple[list[dict], list[int]]:
+class CodeFormat(str, Enum):
+    JSON = "json"
+    BINARY = "binary"
+
+
+class Backend(str, Enum):
+    """Способ генерации кода: результат выражения на стеке или в аккумуляторе"""
+
+    STACK = "stack"
+    ACCUMULATOR = "accumulator"
+
+
+def compilers() -> dict[Backend, type[Compiler]]:
+    return {Backend.STACK: Compiler, Backend.ACCUMULATOR: AccumulatorCompiler}
+
+
+# binary code: header, text segment of fixed width records, data segment of int64 words and optional debug section
+CODE_MAGIC = b"CLSP"
+CODE_VERSION = 2
+CODE_HEADER = struct.Struct("<4sHHII")  # magic, version, flags, text length, data length
+CODE_INSTRUCTION = struct.Struct("<BBBxi")  # opcode, addressing, register, operand
+CODE_DEBUG_OFFSET = struct.Struct("<I")  # bounds of instruction debug strings, one more than instructions
+CODE_DATA_WORD = "q"  # same as memory words, literals may not fit into int32
+CODE_FLAG_DEBUG = 1
+
+OPCODES = list(Opcode)
+ADDRESSING_NUMBERS = {addressing: number for number, addressing in enumerate(Addressing, 1)}
+ADDRESSINGS = [None, *Addressing]
+REGISTER_NUMBERS = {register: number for number, register in enumerate(Register, 1)}
+REGISTERS = [None, *Register]
+
+
+def _data_words(data) -> array:
+    words = array(CODE_DATA_WORD, data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+def encode_instruction(instruction: dict) -> bytes:
+    opcode = OPCODE_NUMBERS[Opcode(instruction["opcode"])]
+    if "address" not in instruction:
+        return CODE_INSTRUCTION.pack(opcode, 0, 0, 0)
+    address = instruction["address"]
+    addressing = Addressing(address["type"])
+    register = REGISTER_NUMBERS[Register(address["register"])] if "register" in address else 0
+    operand = address["offset"] if "offset" in address else address["value"]
+    return CODE_INSTRUCTION.pack(opcode, ADDRESSING_NUMBERS[addressing], register, operand)
+
+
+def write_binary_code(filename: str, instruction_code: list[dict], static_data: list[int], debug: bool = True):
+    with open(filename, "wb") as file:
+        flags = CODE_FLAG_DEBUG if debug else 0
+        file.write(CODE_HEADER.pack(CODE_MAGIC, CODE_VERSION, flags, len(instruction_code), len(static_data)))
+        file.write(b"".join(map(encode_instruction, instruction_code)))
+        file.write(_data_words(static_data).tobytes())
+        if debug:
+            strings = [instruction.get("debug", "").encode("utf-8") for instruction in instruction_code]
+            end = 0
+            file.write(CODE_DEBUG_OFFSET.pack(end))
+            for string in strings:
+                end += len(string)
+                file.write(CODE_DEBUG_OFFSET.pack(end))
+            file.write(b"".join(strings))
+
+
+class BinaryCode(Sequence):
+    """Текст программы в бинарном формате, инструкция декодируется в словарь при обращении"""
+
+    def __init__(self, buffer):
+        magic, version, flags, text_length, data_length = CODE_HEADER.unpack_from(buffer)
+        assert magic == CODE_MAGIC, "Unknown code format"
+        assert version == CODE_VERSION, "Unsupported code version: {}".format(version)
+        self._buffer = buffer
+        self._length = text_length
+        self._data_start = CODE_HEADER.size + text_length * CODE_INSTRUCTION.size
+        self._data_length = data_length
+        self._debug_start = None
+        if flags & CODE_FLAG_DEBUG:
+            self._debug_start = self._data_start + data_length * array(CODE_DATA_WORD).itemsize
+            self._strings_start = self._debug_start + (text_length + 1) * CODE_DEBUG_OFFSET.size
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> dict:
+        if not 0 <= index < self._length:
+            raise IndexError
+        opcode, addressing, register, operand = CODE_INSTRUCTION.unpack_from(
+            self._buffer, CODE_HEADER.size + index * CODE_INSTRUCTION.size
+        )
+        instruction = {"opcode": OPCODES[opcode]}
+        if addressing:
+            address = {"type": ADDRESSINGS[addressing]}
+            if register:
+                address["register"] = REGISTERS[register]
+                address["offset"] = operand
+            else:
+                address["value"] = operand
+            instruction["address"] = address
+        debug = self._debug(index)
+        if debug:
+            instruction["debug"] = debug
+        instruction["index"] = index
+        return instruction
+
+    def _debug(self, index: int) -> str | None:
+        if self._debug_start is None:
+            return None
+        offset = self._debug_start + index * CODE_DEBUG_OFFSET.size
+        (start,) = CODE_DEBUG_OFFSET.unpack_from(self._buffer, offset)
+        (end,) = CODE_DEBUG_OFFSET.unpack_from(self._buffer, offset + CODE_DEBUG_OFFSET.size)
+        return bytes(self._buffer[self._strings_start + start : self._strings_start + end]).decode("utf-8")
+
+    def data(self) -> list[int]:
+        words = array(CODE_DATA_WORD)
+        words.frombytes(self._buffer[self._data_start : self._data_start + self._data_length * words.itemsize])
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words.tolist()
+
+
+def read_code(filename: str) -> tuple[Sequence[dict], list[int]]:
+    with open(filename, "rb") as file:
+        if file.read(len(CODE_MAGIC)) == CODE_MAGIC:
+            code = BinaryCode(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            return code, code.data()
     with open(filename, encoding="utf-8") as file:
         content = json.loads(file.read())
         code = content["code"]
@@ -36,22 +177,109 @@ def read_code(filename: str) -> tuple[list[dict], list[int]]:
     return code, data
 
 
-def translate(source_code: str) -> tuple[list[dict], list[int]]:
-    lex = Lexer(source_code)
-    tokens = lex.tokenize()
-    ast = Parser(tokens).parse()
-    compiler = Compiler(ast, 1024, 2048)
-    compiler.process()
-    return compiler.text.instructions, compiler.data.layout()
+def compile_module(
+    source_code: str,
+    entry: bool = True,
+    backend: Backend = Backend.STACK,
+    libraries: Sequence[ObjectModule] = (),
+) -> ObjectModule:
+    # tokens and syntax tree of a form are dropped as soon as the form is compiled
+    forms = Parser(Lexer(source_code).tokens()).forms()
+    inline_functions = [function for library in libraries for function in library.inline_functions]
+    compiler = compilers()[backend](DATA_SEGMENT_SIZE, TEXT_SEGMENT_SIZE, entry, inline_functions=inline_functions)
+    return compiler.process(forms)
+
+
+@functools.cache
+def compile_library(source_code: str, backend: Backend = Backend.STACK) -> ObjectModule:
+    # library object is compiled once and shared by all programs, linker doesn't modify it
+    return compile_module(source_code, entry=False, backend=backend)
+
+
+def translate(
+    source_code: str, libraries: Sequence[ObjectModule] = (), backend: Backend = Backend.STACK
+) -> tuple[list[dict], list[int]]:
+    # calling convention doesn't depend on backend, so libraries may be compiled by any of them
+    program = compile_module(source_code, backend=backend, libraries=libraries)
+    return link([program, *libraries], TEXT_SEGMENT_SIZE, DATA_SEGMENT_SIZE)
+
+
+# modules which define the translation result, the cache key depends on their sources
+TRANSLATION_MODULES = ["lexer", "parsing", "optimizer", "compiler", "peephole", "linker", "isa", "translator"]
+
+
+@functools.cache
+def translation_sources_digest() -> str:
+    digest = hashlib.sha256()
+    for name in TRANSLATION_MODULES:
+        with open(importlib.util.find_spec(name).origin, "rb") as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+def translation_settings(backend: Backend) -> str:
+    return json.dumps([translation_sources_digest(), DATA_SEGMENT_SIZE, TEXT_SEGMENT_SIZE, backend])
+
+
+def library_object_file(source_file: str, backend: Backend) -> str:
+    return str(Path(source_file).with_suffix(".{}.o".format(backend.value)))
+
+
+def load_library(source_file: str, source_code: str, backend: Backend = Backend.STACK) -> ObjectModule:
+    """Объектный модуль библиотеки из объектного файла рядом с ее исходным кодом (`library_object_file`).
+
+    Файл собирается заново, если его нет или он собран из другого исходного кода или другой версией транслятора.
+    """
+    object_file = library_object_file(source_file, backend)
+    key = CompilationCache.key(translation_settings(backend), source_code)
+    library = read_object(object_file, key)
+    if library is None:
+        library = compile_module(source_code, entry=False, backend=backend)
+        # library is compiled on every run if its directory is read-only
+        with contextlib.suppress(OSError):
+            write_object(object_file, library, key)
+    return library
+
+
+def cached_translate(
+    source_code: str,
+    stdlib_code: str,
+    cache: CompilationCache,
+    backend: Backend = Backend.STACK,
+    stdlib: ObjectModule | None = None,
+) -> tuple[list[dict], list[int]]:
+    key = cache.key(translation_settings(backend), source_code, stdlib_code)
+    result = cache.get(key)
+    if result is None:
+        result = translate(source_code, [stdlib or compile_library(stdlib_code, backend)], backend)
+        cache.put(key, *result)
+    return result
 
 
-def main(source_file: str, target_file: str):
+def main(
+    source_file: str,
+    target_file: str,
+    code_format: CodeFormat = CodeFormat.JSON,
+    cache_dir: str | None = None,
+    backend: Backend = Backend.STACK,
+):
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_VARIABLE)
     with open(STDLIB_FILE, encoding="utf-8") as file:
         stdlib_source = file.read() + "\n"
     with open(source_file, encoding="utf-8") as file:
-        source_file = file.read() + stdlib_source
-        instruction_code, static_memory = translate(source_file)
-        write_code(target_file, instruction_code, static_memory)
+        source = file.read()
+        source_file = source + stdlib_source
+        stdlib = load_library(STDLIB_FILE, stdlib_source, backend)
+        if cache_dir:
+            instruction_code, static_memory = cached_translate(
+                source, stdlib_source, CompilationCache(cache_dir), backend, stdlib
+            )
+        else:
+            instruction_code, static_memory = translate(source, [stdlib], backend)
+        if code_format == CodeFormat.BINARY:
+            write_binary_code(target_file, instruction_code, static_memory)
+        else:
+            write_code(target_file, instruction_code, static_memory)
         print(
             "source LoC:",
             len(source_file.split("\n")),
@@ -61,6 +289,9 @@ def main(source_file: str, target_file: str):
 
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 3, "Wrong arguments: translator.py <input_file> <target_file>"
-    _, source, target = sys.argv
-    main(source, target)
+    assert len(sys.argv) in (3, 4, 5), (
+        "Wrong arguments: translator.py <input_file> <target_file> [json|binary] [stack|accumulator]"
+    )
+    _, source, target, *options = sys.argv
+    code_format = CodeFormat(options[0]) if options else CodeFormat.JSON
+    main(source, target, code_format, backend=Backend(options[1]) if len(options) > 1 else Backend.STACK)